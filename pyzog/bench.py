@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+"""
+吞吐量测试
+@author zrong
+
+在本地启动一个接收器子进程，再启动多个生产者线程或者进程，通过 get_logging_handler(type_='zmq'|'redis') 创建的 handler 发送日志，
+统计 emit 耗时、端到端延迟、吞吐量以及丢失数量，结果为 JSON，便于比较不同版本和不同配置。
+handler 使用 sequence=true 时，结果中的 sequence 为接收端根据序号统计的丢失、重复和乱序，见 pyzog.seq。
+
+type 为 zmq 时使用 ipc 地址；type 为 redis 时优先在本地启动一个 redis-server，
+没有 redis-server 时使用 fakeredis 的 TcpFakeServer。
+
+bench_formatter 单独测试 fmt 为 json 时 Formatter 的耗时，与 python-json-logger 比较。
+"""
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+from array import array
+from pathlib import Path
+
+import pyzog
+from pyzog.formatter import FastJsonFormatter, JSON_ENCODERS
+from pyzog.logging import get_logging_handler, JSON_LOG_FORMAT
+from pyzog.receiver import ZeroMQReceiver, RedisReceiver
+from pyzog.seq import HEADER, is_sequenced
+
+
+def percentiles(values, qs=(0.5, 0.99, 0.999)):
+    """ 返回 {'p50': .., 'p99': .., 'p999': ..}，单位为秒
+    """
+    if not values:
+        return {}
+    values = sorted(values)
+    result = {}
+    for q in qs:
+        key = 'p' + ('%g' % (q * 100)).replace('.', '')
+        result[key] = values[min(int(q * len(values)), len(values) - 1)]
+    result['max'] = values[-1]
+    return result
+
+
+def make_payload(seq, size):
+    head = b'%d %.6f ' % (seq, time.time())
+    return head + b'x' * max(size - len(head), 0)
+
+
+def _bench_receiver_class(base):
+    class BenchReceiver(base):
+        """ 在写入时记录数量和端到端延迟
+        """
+        received = 0
+        first_ts = 0
+        last_ts = 0
+        latencies = None
+
+        def write(self, name, data):
+            super().write(name, data)
+            now = time.time()
+            if self.latencies is None:
+                self.latencies = array('d')
+                self.first_ts = now
+            self.last_ts = now
+            self.received += 1
+            if is_sequenced(data):
+                data = data[HEADER.size:]
+            try:
+                self.latencies.append(now - float(data.split(b' ', 2)[1]))
+            except (IndexError, ValueError):
+                pass
+    return BenchReceiver
+
+
+def _run_receiver(type_, addr, logpath, receiver_kwargs, expected, ready, stop, results):
+    """ 接收器子进程
+    """
+    if type_ == 'zmq':
+        r = _bench_receiver_class(ZeroMQReceiver)(logpath, addr, None, channels=['bench.'], **receiver_kwargs)
+    else:
+        host, port = addr
+        r = _bench_receiver_class(RedisReceiver)(logpath, host=host, port=port, channels=['bench.*'], **receiver_kwargs)
+    threading.Thread(target=r.start, daemon=True).start()
+    # 等待订阅生效
+    time.sleep(0.5)
+    ready.set()
+    while r.received < expected and not stop.is_set():
+        time.sleep(0.01)
+    r.writers.flush()
+    results.put((r.received, r.first_ts, r.last_ts, (r.latencies or array('d')).tobytes(), r.sequences.get_stats()))
+
+
+def _run_producer(type_, target, index, messages, size, handler_kwargs, results):
+    """ 生产者，在线程或者进程中运行
+    """
+    name = 'bench.%s' % index
+    # 每个生产者使用独立的 handler，get_logger 会让同一个进程中的所有生产者共享一个 zmq socket
+    hdr = get_logging_handler(type_, 'raw', logging.INFO, target, name, **handler_kwargs)
+    log = logging.getLogger(name)
+    log.addHandler(hdr)
+    log.setLevel(logging.INFO)
+    log.propagate = False
+    # ZeroMQ 的 PUB 建立连接需要一点时间
+    time.sleep(0.5)
+    latencies = array('d')
+    perf_counter = time.perf_counter
+    start = time.time()
+    for seq in range(messages):
+        payload = make_payload(seq, size).decode()
+        ts = perf_counter()
+        log.info(payload)
+        latencies.append(perf_counter() - ts)
+    elapsed = time.time() - start
+    log.removeHandler(hdr)
+    hdr.close()
+    results.put((index, start, elapsed, latencies.tobytes()))
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class LocalRedis(object):
+    """ 本地临时的 redis 服务
+    """
+    proc = None
+    server = None
+
+    def __init__(self):
+        self.port = _free_port()
+
+    def start(self):
+        exe = shutil.which('redis-server')
+        if exe is not None:
+            self.proc = subprocess.Popen([exe, '--port', str(self.port), '--save', '', '--appendonly', 'no'],
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        else:
+            try:
+                from fakeredis import TcpFakeServer
+            except ImportError:
+                raise ValueError('bench redis 需要 redis-server 或者 fakeredis！')
+            self.server = TcpFakeServer(('127.0.0.1', self.port), server_type='redis')
+            threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        deadline = time.time() + 10
+        while time.time() < deadline:
+            try:
+                socket.create_connection(('127.0.0.1', self.port), 0.1).close()
+                return
+            except OSError:
+                time.sleep(0.05)
+        raise ValueError('redis 启动失败！')
+
+    def stop(self):
+        if self.proc is not None:
+            self.proc.terminate()
+            self.proc.wait()
+        if self.server is not None:
+            self.server.shutdown()
+
+
+def run_bench(type_='zmq', producers=1, messages=10000, mode='thread', size=200,
+    receiver_kwargs=None, handler_kwargs=None, drain_timeout=10, logpath=None):
+    """ 运行一次测试，返回结果 dict
+    :param type_: zmq/redis
+    :param producers: 生产者的数量
+    :param messages: 每个生产者发送的消息数量
+    :param mode: 生产者使用 thread 或者 process
+    :param size: 每条消息的字节数
+    :param receiver_kwargs: 传递给接收器的参数，例如 get_message_type/sleep_time/buffer_size
+    :param handler_kwargs: 传递给 handler 的参数，例如 async_/sndhwm/policy
+    :param drain_timeout: 发送完成后等待接收器写入的最长时间（秒）
+    :param logpath: 接收器写入的文件夹，不提供则使用临时文件夹并在结束后删除
+    """
+    if type_ not in ('zmq', 'redis'):
+        raise ValueError('bench 仅支持 type 为 zmq/redis')
+    if mode not in ('thread', 'process'):
+        raise ValueError('mode 可选值 thread/process')
+    receiver_kwargs = dict(receiver_kwargs or {})
+    handler_kwargs = dict(handler_kwargs or {})
+    tmpdir = tempfile.mkdtemp(prefix='pyzog-bench-')
+    logpath = logpath or os.path.join(tmpdir, 'logs')
+    ctx = multiprocessing.get_context('spawn')
+    local_redis = None
+    try:
+        if type_ == 'zmq':
+            addr = 'ipc://' + os.path.join(tmpdir, 'bench.sock')
+            target = addr
+        else:
+            local_redis = LocalRedis()
+            local_redis.start()
+            addr = ('127.0.0.1', local_redis.port)
+            target = 'redis://127.0.0.1:%s/0' % local_redis.port
+
+        expected = producers * messages
+        ready, stop, recv_results = ctx.Event(), ctx.Event(), ctx.Queue()
+        recv_proc = ctx.Process(target=_run_receiver, name='pyzog.bench.receiver',
+            args=(type_, addr, logpath, receiver_kwargs, expected, ready, stop, recv_results))
+        recv_proc.start()
+        if not ready.wait(30):
+            raise ValueError('接收器启动失败！')
+
+        if mode == 'thread':
+            prod_results = queue.Queue()
+            workers = [threading.Thread(target=_run_producer,
+                args=(type_, target, i, messages, size, handler_kwargs, prod_results)) for i in range(producers)]
+        else:
+            prod_results = ctx.Queue()
+            workers = [ctx.Process(target=_run_producer,
+                args=(type_, target, i, messages, size, handler_kwargs, prod_results)) for i in range(producers)]
+        for w in workers:
+            w.start()
+        emit_latencies = array('d')
+        starts, ends = [], []
+        for _ in workers:
+            _, start, elapsed, data = prod_results.get()
+            emit_latencies.frombytes(data)
+            starts.append(start)
+            ends.append(start + elapsed)
+        for w in workers:
+            w.join()
+
+        try:
+            received, first_ts, last_ts, data, seq_stats = recv_results.get(timeout=drain_timeout)
+        except queue.Empty:
+            stop.set()
+            received, first_ts, last_ts, data, seq_stats = recv_results.get()
+        recv_proc.join()
+        e2e_latencies = array('d')
+        e2e_latencies.frombytes(data)
+
+        send_start, send_end = min(starts), max(ends)
+        duration = max(last_ts, send_end) - send_start
+        result = {
+            'version': pyzog.__version__,
+            'type': type_,
+            'mode': mode,
+            'producers': producers,
+            'messages': expected,
+            'size': size,
+            'receiver': receiver_kwargs,
+            'handler': handler_kwargs,
+            'send_seconds': send_end - send_start,
+            'send_rate': expected / (send_end - send_start) if send_end > send_start else 0,
+            'throughput': received / duration if duration > 0 else 0,
+            'delivered': received,
+            'lost': expected - received,
+            'loss_rate': (expected - received) / expected if expected else 0,
+            'emit_latency': percentiles(emit_latencies),
+            'e2e_latency': percentiles(e2e_latencies),
+        }
+        if seq_stats:
+            # 只保留汇总的数值，bench 的每个 channel 对应一个生产者
+            result['sequence'] = {k[4:]: v for k, v in seq_stats.items() if not k.startswith('seq_bench')}
+        return result
+    finally:
+        if local_redis is not None:
+            local_redis.stop()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def bench_formatter(records=100000, size=200):
+    """ 测试每个 Formatter 格式化一条日志的耗时，返回结果 dict
+    :param records: 格式化的日志数量
+    :param size: 每条消息的字节数
+    """
+    formatters = {}
+    try:
+        from pythonjsonlogger import jsonlogger
+        formatters['jsonlogger'] = jsonlogger.JsonFormatter(JSON_LOG_FORMAT, timestamp=False)
+    except ImportError:
+        pass
+    for encoder in JSON_ENCODERS:
+        try:
+            formatters['fast_' + encoder] = FastJsonFormatter(JSON_LOG_FORMAT, encoder=encoder)
+        except ImportError:
+            pass
+    record = logging.LogRecord('bench', logging.INFO, __file__, 1, 'x' * size, None, None, func='bench_formatter')
+    result = {'version': pyzog.__version__, 'records': records, 'size': size, 'formatters': {}}
+    for name, formatter in formatters.items():
+        perf_counter = time.perf_counter
+        start = perf_counter()
+        for _ in range(records):
+            formatter.format(record)
+        elapsed = perf_counter() - start
+        result['formatters'][name] = {
+            'seconds': elapsed,
+            'ns_per_record': elapsed / records * 1e9 if records else 0,
+            'records_per_second': records / elapsed if elapsed > 0 else 0,
+        }
+    base = result['formatters'].get('jsonlogger')
+    if base is not None:
+        for stat in result['formatters'].values():
+            stat['speedup'] = base['seconds'] / stat['seconds'] if stat['seconds'] > 0 else 0
+    return result
+
+
+def dump_result(result, output=None):
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    if output:
+        Path(output).write_text(text)
+    return text
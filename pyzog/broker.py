@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""
+ZeroMQ 转发器
+@author zrong
+
+在发送端和接收端之间增加一层转发，所有 ZeroMQHandler 连接到 frontend，
+ZeroMQReceiver 使用 bind=False 连接到 backend，接收端可以水平扩展，发送端只需要一个固定的地址。
+
+- pubsub 模式使用 XSUB/XPUB，接收端的订阅会转发给发送端，每个接收端收到自己订阅的所有日志
+- pipeline 模式使用 PULL/PUSH，日志在多个接收端之间轮流分配，发送端的 ZeroMQHandler 需要使用 PUSH
+
+转发在 libzmq 的 zmq.proxy_steerable 中完成，不经过 python。提供 capture 时，
+所有经过的帧同时发送到这个地址的 PUB socket，可以使用 SUB 连接后实时查看。
+吞吐量计数来自 proxy 的 STATISTICS 命令，单位为帧，每条日志为 [topic, payload] 两帧。
+"""
+import signal
+import threading
+import time
+
+import zmq
+
+from pyzog.logging import get_logger
+from pyzog.stats import StatsExporter, render_prometheus
+
+
+# STATISTICS 命令返回的 8 个计数
+STATISTICS_FIELDS = (
+    'frontend_frames_in', 'frontend_bytes_in', 'frontend_frames_out', 'frontend_bytes_out',
+    'backend_frames_in', 'backend_bytes_in', 'backend_frames_out', 'backend_bytes_out',
+)
+
+
+class Broker(object):
+    """ 基于 zmq.proxy_steerable 的转发器
+    """
+    # 发送端连接的地址，以及接收端连接的地址
+    frontend_addr = None
+    backend_addr = None
+
+    # pubsub/pipeline
+    mode = 'pubsub'
+
+    # 用于实时查看的 PUB 地址
+    capture_addr = None
+
+    # frontend 和 backend 的高水位（消息条数）
+    hwm = None
+
+    # 输出统计信息的间隔（秒）
+    stats_interval = 60
+
+    ctx = None
+    sockets = None
+    thread = None
+
+    # 发送控制命令的 REQ socket
+    client = None
+
+    MODES = {
+        'pubsub': (zmq.XSUB, zmq.XPUB),
+        'pipeline': (zmq.PULL, zmq.PUSH),
+    }
+
+    CONTROL_ADDR = 'inproc://pyzog.broker.control'
+
+    def __init__(self, frontend, backend, mode='pubsub', capture=None, hwm=None,
+        stats_addr=None, stats_file=None, stats_interval=60):
+        """
+        :param frontend: 发送端连接的地址，例如 tcp://*:5011
+        :param backend: 接收端连接的地址，例如 tcp://*:5012
+        :param mode: pubsub/pipeline
+        :param capture: 用于实时查看的 PUB 地址，不提供则不使用
+        :param hwm: frontend 和 backend 的 SNDHWM/RCVHWM
+        :param stats_addr: 提供 Prometheus 文本格式统计信息的 HTTP 地址
+        :param stats_file: 定期写入 JSON 格式统计信息的文件
+        :param stats_interval: 输出统计信息的间隔（秒）
+        """
+        if mode not in self.MODES:
+            raise ValueError('mode must be one of %s!' % '/'.join(self.MODES))
+        self.frontend_addr = frontend
+        self.backend_addr = backend
+        self.mode = mode
+        self.capture_addr = capture
+        self.hwm = hwm
+        self.stats_interval = float(stats_interval)
+        self.lock = threading.Lock()
+        self.exporter = StatsExporter(lambda: render_prometheus(None, self.get_stats(), prefix='pyzog_broker'), self.get_stats,
+            addr=stats_addr, stats_file=stats_file, interval=self.stats_interval)
+        self.logger = get_logger('pyzog', type_='stream', fmt='text')
+
+    def open(self):
+        self.ctx = zmq.Context()
+        front_type, back_type = self.MODES[self.mode]
+        frontend = self.ctx.socket(front_type)
+        backend = self.ctx.socket(back_type)
+        for sock in (frontend, backend):
+            if self.hwm is not None:
+                sock.setsockopt(zmq.SNDHWM, int(self.hwm))
+                sock.setsockopt(zmq.RCVHWM, int(self.hwm))
+            sock.setsockopt(zmq.LINGER, 0)
+        frontend.bind(self.frontend_addr)
+        backend.bind(self.backend_addr)
+        capture = None
+        if self.capture_addr:
+            capture = self.ctx.socket(zmq.PUB)
+            capture.setsockopt(zmq.LINGER, 0)
+            capture.bind(self.capture_addr)
+        control = self.ctx.socket(zmq.REP)
+        control.bind(self.CONTROL_ADDR)
+        self.client = self.ctx.socket(zmq.REQ)
+        self.client.setsockopt(zmq.LINGER, 0)
+        self.client.connect(self.CONTROL_ADDR)
+        self.sockets = (frontend, backend, capture, control)
+
+    def run_proxy(self):
+        try:
+            zmq.proxy_steerable(*self.sockets)
+        except zmq.ContextTerminated:
+            pass
+
+    def command(self, cmd, timeout=1000):
+        """ 向 proxy 发送控制命令，返回应答的帧
+        """
+        with self.lock:
+            if self.client is None:
+                return []
+            self.client.send(cmd)
+            if not self.client.poll(timeout):
+                raise ValueError('broker control %s timeout!' % cmd.decode())
+            return self.client.recv_multipart()
+
+    def get_stats(self):
+        """ 返回 proxy 的吞吐量计数
+        """
+        frames = self.command(b'STATISTICS')
+        return {k: int.from_bytes(v, 'little') for k, v in zip(STATISTICS_FIELDS, frames)}
+
+    def on_sigterm(self, signum, frame):
+        raise SystemExit(0)
+
+    def start(self):
+        """ 启动转发并一直运行，直到收到退出信号
+        """
+        try:
+            signal.signal(signal.SIGTERM, self.on_sigterm)
+            signal.signal(signal.SIGQUIT, self.on_sigterm)
+            self.open()
+            self.thread = threading.Thread(target=self.run_proxy, name='pyzog.broker', daemon=True)
+            self.thread.start()
+            self.logger.warn('Broker %s frontend %s, backend %s, capture %s',
+                self.mode, self.frontend_addr, self.backend_addr, self.capture_addr)
+            if self.exporter.enabled:
+                self.exporter.start()
+            last = self.get_stats()
+            last_ts = time.monotonic()
+            while True:
+                time.sleep(self.stats_interval)
+                stats = self.get_stats()
+                now = time.monotonic()
+                rate = (stats['frontend_frames_in'] - last['frontend_frames_in']) / 2 / (now - last_ts)
+                self.logger.warn('Broker stats: %s, %.1f msg/s', stats, rate)
+                last, last_ts = stats, now
+        except BaseException as e:
+            self.stop()
+            self.logger.error('Broker.Exit:' + repr(e))
+            return e
+
+    def stop(self):
+        if self.exporter.enabled:
+            self.exporter.stop()
+        if self.thread is not None:
+            try:
+                self.command(b'TERMINATE')
+            except (ValueError, zmq.ZMQError):
+                pass
+            self.thread.join(1)
+            self.thread = None
+        with self.lock:
+            for sock in (self.sockets or ()) + (self.client,):
+                if sock is not None:
+                    sock.close(0)
+            self.sockets = None
+            self.client = None
+        if self.ctx is not None:
+            self.ctx.term()
+            self.ctx = None
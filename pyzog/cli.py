@@ -6,20 +6,35 @@
 ###########################################
 
 from pathlib import Path
+from datetime import datetime
 import re
+import json
+import time
 import configparser
+import os
+import sys
 
 from pkg_resources import resource_filename
 import click
-
-from pyzog.receiver import ZeroMQReceiver, RedisReceiver
+import zmq
+
+from pyzog.receiver import ZeroMQReceiver, RedisReceiver, RedisStreamReceiver, MultiReceiver, ZeroMQSource, RedisSource
+from pyzog.shard import ShardSupervisor
+from pyzog.broker import Broker
+from pyzog.route import Rule
+from pyzog.bench import run_bench, bench_formatter, dump_result
+from pyzog.index import query_channel
+from pyzog.grep import grep as grep_logs
+from pyzog.compact import compact as compact_logs, BLOCK_ROWS
 from pyzog.tpl import create_from_jinja
 
 
-TYPE_HELP = '指定服务器类型，可选值 redis/zmq'
+TYPE_HELP = '指定服务器类型，可选值 redis/redis_stream/zmq/broker'
 ADDR_HELP = '服务器地址，形如 tcp://127.0.0.1:5011 或者 password@127.0.0.1:6379/0'
-CHANNELS_HELP = '仅当 type 为 redis 的时候提供，允许指定多个 channel 名称'
-SLEEP_TIME_HELP = '调用 redis.pubsub.get_message 时提供的 sleep_time 参数'
+CHANNELS_HELP = '允许指定多个 channel 名称，type 为 redis 时必须提供，type 为 redis_stream 时代表 stream 的 key，type 为 zmq 时作为订阅前缀，不提供则订阅所有'
+SLEEP_TIME_HELP = 'get-message-type 为 thread/block 时调用 redis.pubsub.get_message 之后 sleep 的时间，poll 不使用'
+WORKERS_HELP = '接收日志的子进程数量，channels 会被分配到各个子进程，不能大于 channels 的数量，仅支持 type 为 redis。不提供则使用配置文件中的 workers，默认为 1'
+GET_MESSAGE_TYPE_HELP = '接收消息的方式，type 为 redis 时可选 poll/thread/block/listen/asyncio，type 为 zmq 时仅 asyncio 有效，其它值均使用阻塞接收'
 
 @click.group(help='执行 pyzog 命令')
 def main():
@@ -42,6 +57,121 @@ def check_addr(type_, addr):
     return addr
 
 
+# pyzog.conf 中可选的 receiver 和 writer 配置及其类型
+RECEIVER_OPTIONS = {
+    'msgpack_render': str,
+    'stats_addr': str,
+    'stats_file': str,
+    'stats_interval': float,
+    'buffer_size': int,
+    'flush_interval': float,
+    'fsync': str,
+    'fsync_interval': float,
+    'rotate_check_interval': float,
+    'max_open_files': int,
+    'idle_timeout': float,
+    'rotate_bytes': int,
+    'rotate_interval': float,
+    'compress': str,
+    'backup_count': int,
+    'max_age': float,
+    'compress_workers': int,
+    'index_every': int,
+    'index_interval': float,
+    'write_workers': int,
+    'write_queue_size': int,
+    'spill_bytes': int,
+    'write_overflow': str,
+}
+
+
+def get_receiver_kwargs(section):
+    """ 从 pyzog.conf 的 section 中读取 receiver 和 writer 的可选配置
+    """
+    return {k: f(section[k]) for k, f in RECEIVER_OPTIONS.items() if k in section}
+
+
+def create_routes(conf):
+    """ 使用 [route:name] 的配置创建路由规则，按照在配置文件中的顺序匹配
+    """
+    routes = []
+    for name in conf.sections():
+        if not name.startswith('route:'):
+            continue
+        section = conf[name]
+        routes.append(Rule(name[len('route:'):],
+            channels=get_channels(section),
+            level=section.get('level'),
+            max_level=section.get('max_level'),
+            match=[line for line in section.get('match', '').splitlines() if line.strip()],
+            to=[dest.strip() for dest in section.get('to', '').split(',') if dest.strip()],
+            drop=section.getboolean('drop', False),
+            continue_=section.getboolean('continue', False)))
+    return routes
+
+
+def get_all_receiver_kwargs(conf):
+    """ [pyzog] 中的可选配置，以及路由规则
+    """
+    kwargs = get_receiver_kwargs(conf['pyzog'])
+    routes = create_routes(conf)
+    if routes:
+        kwargs['routes'] = routes
+    return kwargs
+
+
+def create_broker(section):
+    """ 使用 type 为 broker 的配置创建 Broker
+    """
+    kwargs = {'frontend': section['addr'], 'backend': section['backend']}
+    for k, f in (('mode', str), ('capture', str), ('hwm', int), ('stats_addr', str), ('stats_file', str), ('stats_interval', float)):
+        if section.get(k):
+            kwargs[k] = f(section[k])
+    return Broker(**kwargs)
+
+
+def get_channels(section):
+    return [ch.strip() for ch in section.get('channels', '').split(',') if ch.strip()]
+
+
+def get_socket_type(section):
+    return {'sub': zmq.SUB, 'pull': zmq.PULL}[section.get('socket_type', 'sub').lower()]
+
+
+def create_source(name, section):
+    """ 使用 [source:name] 的配置创建 MultiReceiver 的数据源，type 仅支持 redis/zmq
+    """
+    type_ = section['type']
+    addr = check_addr(type_, validate_addr(None, None, section['addr']))
+    channels = get_channels(section)
+    if type_ == 'zmq':
+        return ZeroMQSource(name, addr.group('scheme') + addr.group('host'), addr.group('port'),
+            socket_type=get_socket_type(section), channels=channels, bind=section.getboolean('bind', True))
+    if type_ == 'redis':
+        if not channels:
+            raise ValueError('source %s 必须提供 channels' % name)
+        kwargs = {k:v for k, v in addr.groupdict().items() if k in ('host', 'port', 'password', 'db') and v is not None}
+        return RedisSource(name, channels=channels, **kwargs)
+    raise ValueError('source %s 不支持的 type: %s' % (name, type_))
+
+
+def create_multi_receiver(conf, logpath):
+    """ 配置文件中有 [source:name] 时，在一个进程中接收所有数据源
+    """
+    sources = [create_source(name[len('source:'):], conf[name]) for name in conf.sections() if name.startswith('source:')]
+    kwargs = get_all_receiver_kwargs(conf)
+    if 'poll_timeout' in conf['pyzog']:
+        kwargs['poll_timeout'] = float(conf['pyzog']['poll_timeout'])
+    return MultiReceiver(logpath, sources, **kwargs)
+
+
+def run_broker(broker):
+    click.echo(click.style('正在启动 pyzog broker %s -> %s...' % (broker.frontend_addr, broker.backend_addr), fg='yellow'))
+    err = broker.start()
+    if not isinstance(err, SystemExit):
+        raise ValueError(str(err))
+
+
 def get_conf(sconf):
     conf = configparser.ConfigParser(inline_comment_prefixes=('#', ';'))
     conf.read_string(sconf.read_text())
@@ -50,55 +180,299 @@ def get_conf(sconf):
 
 @click.command(help='启动 pyzog。请先使用 pyzog genpyzog 生成配置文件。')
 @click.option('-c', '--config_file', required=True, type=click.Path(file_okay=True, readable=True))
-def start(config_file):
+@click.option('-w', '--workers', required=False, type=int, help=WORKERS_HELP)
+def start(config_file, workers):
     try:
         conf = configparser.ConfigParser(inline_comment_prefixes=('#', ';'))
         conf.read_string(Path(config_file).read_text())
 
-        type_ = conf['pyzog']['type']
-        address = conf['pyzog']['addr']
+        multi = any(name.startswith('source:') for name in conf.sections())
+        type_ = 'multi' if multi else conf['pyzog']['type']
+        if type_ == 'broker':
+            run_broker(create_broker(conf['pyzog']))
+            return
         logpath = conf['pyzog']['logpath']
-        channels = conf['pyzog']['channels'].split(',')
+        channels = get_channels(conf['pyzog'])
+        # 多数据源在一个进程中接收，不读取 [pyzog] 中的 workers
+        if multi:
+            if workers is not None and workers > 1:
+                raise ValueError('workers 不支持多数据源')
+            workers = 1
+        elif workers is None:
+            workers = int(conf['pyzog'].get('workers', 1))
 
         logp = Path(logpath)
         if not logp.is_dir() or not logp.exists():
             raise ValueError('%s 不存在！' % logpath)
 
-        addr = check_addr(type_, validate_addr(None, None, address))
         r = None
-        if type_ == 'zmq':
-            r = ZeroMQReceiver(logpath, addr.group('scheme') + addr.group('host'), addr.group('port'))
+        if workers > 1 and type_ != 'redis':
+            raise ValueError('workers 仅支持 type 为 redis')
+        if type_ != 'multi':
+            addr = check_addr(type_, validate_addr(None, None, conf['pyzog']['addr']))
+            receiver_kwargs = get_all_receiver_kwargs(conf)
+        if type_ == 'multi':
+            r = create_multi_receiver(conf, logpath)
+        elif type_ == 'zmq':
+            get_message_type = conf['pyzog'].get('get_message_type', 'block')
+            r = ZeroMQReceiver(logpath, addr.group('scheme') + addr.group('host'), addr.group('port'),
+                socket_type=get_socket_type(conf['pyzog']), channels=channels, get_message_type=get_message_type,
+                bind=conf['pyzog'].getboolean('bind', True), **receiver_kwargs)
         elif type_ == 'redis':
             kwargs = {k:v for k, v in addr.groupdict().items() if k in ('host', 'port', 'password', 'db') and v is not None}
             if not channels:
                 raise ValueError('必须提供 channels')
             kwargs['channels'] = channels
-            kwargs['get_message_type'] = conf['pyzog']['get_message_type']
-            kwargs['sleep_time'] = float(conf['pyzog']['sleep_time'])
+            kwargs['get_message_type'] = conf['pyzog'].get('get_message_type', 'poll')
+            for k in ('sleep_time', 'poll_timeout'):
+                if k in conf['pyzog']:
+                    kwargs[k] = float(conf['pyzog'][k])
+            kwargs.update(receiver_kwargs)
+            click.echo(kwargs)
+            if workers > 1:
+                channels = kwargs.pop('channels')
+                r = ShardSupervisor(RedisReceiver, logpath, channels, workers, **kwargs)
+            else:
+                r = RedisReceiver(logpath, **kwargs)
+        elif type_ == 'redis_stream':
+            kwargs = {k:v for k, v in addr.groupdict().items() if k in ('host', 'port', 'password', 'db') and v is not None}
+            if not channels:
+                raise ValueError('必须提供 channels')
+            kwargs['channels'] = channels
+            for k in ('group', 'consumer', 'count', 'block', 'claim_idle'):
+                if k in conf['pyzog']:
+                    kwargs[k] = conf['pyzog'][k]
+            kwargs.update(receiver_kwargs)
             click.echo(kwargs)
-            r = RedisReceiver(logpath, **kwargs)
+            r = RedisStreamReceiver(logpath, **kwargs)
         else:
             raise ValueError('不支持的 type: %s' % type_)
 
         click.echo(click.style('正在启动 pyzlog %s receiver...' % type_, fg='yellow'))
-        err = r.start()
-        raise ValueError(str(err))
+        if isinstance(r, ShardSupervisor):
+            err = r.start()
+        else:
+            # logrotate 的 postrotate 可以使用 kill -HUP 让 pyzog 立即重新打开日志文件
+            # 多进程模式下由 ShardSupervisor 转发给子进程
+            r.install_signals()
+            try:
+                err = r.start()
+            finally:
+                r.close()
+        # ShardSupervisor 收到退出信号时返回 SystemExit，属于正常退出
+        if not isinstance(err, SystemExit):
+            raise ValueError(str(err))
     except Exception as e:
         click.echo(click.style('EXIT：%s' % e, fg='red'), err=True)
         raise click.Abort()
 
 
+BROKER_HELP = '启动 ZeroMQ 转发器，发送端连接 frontend，接收端连接 backend。可以使用配置文件或者命令行参数'
+
+
+@click.command(help=BROKER_HELP)
+@click.option('-c', '--config_file', required=False, type=click.Path(file_okay=True, readable=True), help='type 为 broker 的 pyzog.conf')
+@click.option('-f', '--frontend', required=False, type=str, help='发送端连接的地址，例如 tcp://*:5011')
+@click.option('-b', '--backend', required=False, type=str, help='接收端连接的地址，例如 tcp://*:5012')
+@click.option('-m', '--mode', required=False, type=click.Choice(['pubsub', 'pipeline'], case_sensitive=False), default='pubsub', help='pubsub 使用 XSUB/XPUB，pipeline 使用 PULL/PUSH')
+@click.option('--capture', required=False, type=str, help='用于实时查看的 PUB 地址')
+@click.option('--hwm', required=False, type=int, help='frontend 和 backend 的高水位')
+@click.option('--stats-addr', required=False, type=str, help='提供 Prometheus 文本格式统计信息的 HTTP 地址')
+def broker(config_file, frontend, backend, mode, capture, hwm, stats_addr):
+    try:
+        if config_file is not None:
+            conf = get_conf(Path(config_file))
+            if conf['pyzog']['type'] != 'broker':
+                raise ValueError('配置文件的 type 必须为 broker')
+            b = create_broker(conf['pyzog'])
+        else:
+            if not frontend or not backend:
+                raise ValueError('请提供 config_file 或者 frontend 和 backend')
+            b = Broker(frontend, backend, mode=mode, capture=capture, hwm=hwm, stats_addr=stats_addr)
+        run_broker(b)
+    except Exception as e:
+        click.echo(click.style('EXIT：%s' % e, fg='red'), err=True)
+        raise click.Abort()
+
+
+BENCH_HELP = '在本地启动接收器和生产者，测试吞吐量、emit 耗时、端到端延迟和丢失数量，输出 JSON'
+HANDLER_OPTION_HELP = '传递给 handler 的参数，形如 async_=true 或 sndhwm=1000，可以提供多次。sequence=true 时按照序号统计丢失'
+
+
+def parse_options(options):
+    """ 将 key=value 形式的参数转换为 dict，value 尽量按照 JSON 解析
+    """
+    result = {}
+    for opt in options:
+        k, sep, v = opt.partition('=')
+        if not sep:
+            raise ValueError('参数格式错误：%s' % opt)
+        try:
+            result[k] = json.loads(v)
+        except ValueError:
+            result[k] = v
+    return result
+
+
+@click.command(help=BENCH_HELP)
+@click.option('-t', '--type', 'type_', required=False, type=click.Choice(['redis', 'zmq'], case_sensitive=False), default='zmq', help=TYPE_HELP)
+@click.option('-p', '--producers', required=False, type=int, default=1, help='生产者数量')
+@click.option('-n', '--messages', required=False, type=int, default=10000, help='每个生产者发送的消息数量')
+@click.option('-m', '--mode', required=False, type=click.Choice(['thread', 'process'], case_sensitive=False), default='thread', help='生产者使用线程或者进程')
+@click.option('-s', '--size', required=False, type=int, default=200, help='每条消息的字节数')
+@click.option('-c', '--config_file', required=False, type=click.Path(file_okay=True, readable=True), help='使用 pyzog.conf 中的 get_message_type/sleep_time 等接收器配置')
+@click.option('-O', '--handler-option', required=False, type=str, multiple=True, help=HANDLER_OPTION_HELP)
+@click.option('-o', '--output', required=False, type=click.Path(), help='将 JSON 结果写入这个文件')
+@click.option('-f', '--formatter', is_flag=True, default=False, help='只测试 fmt 为 json 时各个 Formatter 的耗时，使用 messages 作为格式化的次数')
+def bench(type_, producers, messages, mode, size, config_file, handler_option, output, formatter):
+    try:
+        if formatter:
+            click.echo(dump_result(bench_formatter(messages, size), output))
+            return
+        receiver_kwargs = {}
+        if config_file is not None:
+            conf = get_conf(Path(config_file))
+            receiver_kwargs = get_receiver_kwargs(conf['pyzog'])
+            if 'get_message_type' in conf['pyzog']:
+                receiver_kwargs['get_message_type'] = conf['pyzog']['get_message_type']
+            for k in ('sleep_time', 'poll_timeout'):
+                if type_ == 'redis' and k in conf['pyzog']:
+                    receiver_kwargs[k] = float(conf['pyzog'][k])
+            # 测试时不需要统计信息的输出
+            for k in ('stats_addr', 'stats_file'):
+                receiver_kwargs.pop(k, None)
+        result = run_bench(type_, producers, messages, mode, size,
+            receiver_kwargs=receiver_kwargs, handler_kwargs=parse_options(handler_option))
+        click.echo(dump_result(result, output))
+    except Exception as e:
+        click.echo(click.style('测试错误：%s' % e, fg='red'), err=True)
+        raise click.Abort()
+
+
+def parse_time(value):
+    """ 将时间戳或者 YYYY-mm-dd HH:MM:SS 格式的本地时间转换为时间戳
+    """
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        raise ValueError('时间格式错误：%s' % value)
+
+
+def get_logpath(config_file, logpath):
+    if logpath is not None:
+        return Path(logpath)
+    if config_file is None:
+        raise ValueError('请提供 config_file 或者 logpath')
+    return Path(get_conf(Path(config_file))['pyzog']['logpath'])
+
+
+def close_stdout():
+    """ 输出被 head 等命令提前关闭时，避免退出时再次写入 stdout 出错
+    """
+    os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+
+
+QUERY_HELP = '根据时间索引读取某个 channel 在一段时间内接收到的日志，包括切分和压缩的文件'
+TIME_HELP = '时间戳或者 YYYY-mm-dd HH:MM:SS 格式的本地时间'
+
+
+@click.command(help=QUERY_HELP)
+@click.option('-c', '--config_file', required=False, type=click.Path(file_okay=True, readable=True), help='使用 pyzog.conf 中的 logpath')
+@click.option('-l', '--logpath', required=False, type=click.Path(), help='日志存储文件夹，提供时忽略 config_file')
+@click.option('--channel', required=True, type=str, help='channel 名称，即不带扩展名的文件名')
+@click.option('--from', 'from_', required=True, type=str, help=TIME_HELP)
+@click.option('--to', required=False, type=str, help=TIME_HELP + '，不提供则为当前时间')
+@click.option('--ext', required=False, type=str, default='.log', help='日志文件的扩展名')
+def query(config_file, logpath, channel, from_, to, ext):
+    try:
+        logp = get_logpath(config_file, logpath)
+        start_ts = parse_time(from_)
+        end_ts = parse_time(to) if to else time.time()
+        out = sys.stdout.buffer
+        for chunk in query_channel(logp, channel, start_ts, end_ts, ext):
+            out.write(chunk)
+        out.flush()
+    except BrokenPipeError:
+        close_stdout()
+    except Exception as e:
+        click.echo(click.style('查询错误：%s' % e, fg='red'), err=True)
+        raise click.Abort()
+
+
+GREP_HELP = '在 logpath 的所有日志文件以及切分和压缩的文件中并行搜索 PATTERN（正则表达式）'
+
+
+@click.command(help=GREP_HELP)
+@click.argument('pattern')
+@click.option('-c', '--config_file', required=False, type=click.Path(file_okay=True, readable=True), help='使用 pyzog.conf 中的 logpath')
+@click.option('-l', '--logpath', required=False, type=click.Path(), help='日志存储文件夹，提供时忽略 config_file')
+@click.option('--channel', required=False, type=str, default='*', help='channel 名称的通配符，不提供则搜索所有')
+@click.option('--since', required=False, type=str, help=TIME_HELP + '，只搜索这个时间之后的日志。需要时间索引（index_every/index_interval），没有索引的文件只跳过修改时间更早的文件，不按行过滤')
+@click.option('-f', '--field', required=False, type=str, help='将每一行作为 JSON 解析，只在这个字段中搜索，用于 fmt 为 json 的日志')
+@click.option('-i', '--ignore-case', is_flag=True, default=False, help='忽略大小写')
+@click.option('--count', is_flag=True, default=False, help='只输出每个文件匹配的行数')
+@click.option('-w', '--workers', required=False, type=int, help='进程数量，不提供则使用 CPU 数量')
+@click.option('--no-filename', is_flag=True, default=False, help='输出匹配的行时不带文件名')
+@click.option('--ext', required=False, type=str, default='.log', help='日志文件的扩展名')
+def grep(pattern, config_file, logpath, channel, since, field, ignore_case, count, workers, no_filename, ext):
+    try:
+        logp = get_logpath(config_file, logpath)
+        since_ts = parse_time(since) if since else 0
+        out = sys.stdout.buffer
+        for path, n, lines in grep_logs(logp, pattern, channel, since_ts, field, ignore_case, count, workers, ext=ext):
+            if count:
+                out.write(b'%s:%d\n' % (path.name.encode(), n))
+                continue
+            prefix = b'' if no_filename else path.name.encode() + b':'
+            for line in lines:
+                out.write(prefix + line + b'\n')
+        out.flush()
+    except BrokenPipeError:
+        close_stdout()
+    except Exception as e:
+        click.echo(click.style('搜索错误：%s' % e, fg='red'), err=True)
+        raise click.Abort()
+
+
+COMPACT_HELP = '将切分出的 fmt 为 json 的日志转换为列式存储 name.log.YYYYmmdd-HHMMSS.pzc，使用 pyzog.compact.count_by 统计'
+
+
+@click.command(help=COMPACT_HELP)
+@click.option('-c', '--config_file', required=False, type=click.Path(file_okay=True, readable=True), help='使用 pyzog.conf 中的 logpath')
+@click.option('-l', '--logpath', required=False, type=click.Path(), help='日志存储文件夹，提供时忽略 config_file')
+@click.option('--channel', required=False, type=str, default='*', help='channel 名称的通配符，不提供则转换所有')
+@click.option('-w', '--workers', required=False, type=int, help='进程数量，不提供则使用 CPU 数量')
+@click.option('--block-rows', required=False, type=int, default=BLOCK_ROWS, help='每个 block 的行数')
+@click.option('--codec', required=False, type=click.Choice(['zlib', 'zstd'], case_sensitive=False), help='压缩方式，不提供时安装了 zstandard 则使用 zstd')
+@click.option('--remove', is_flag=True, default=False, help='转换之后删除 segment 及其时间索引')
+@click.option('--force', is_flag=True, default=False, help='已经转换过的 segment 也重新转换')
+@click.option('--ext', required=False, type=str, default='.log', help='日志文件的扩展名')
+def compact(config_file, logpath, channel, workers, block_rows, codec, remove, force, ext):
+    try:
+        logp = get_logpath(config_file, logpath)
+        for source, target, rows, skipped in compact_logs(logp, channel, workers, block_rows, codec, remove, force, ext):
+            click.echo('%s -> %s: %d 行，%d 行无法解析' % (source.name, target.name, rows, skipped))
+    except Exception as e:
+        click.echo(click.style('转换错误：%s' % e, fg='red'), err=True)
+        raise click.Abort()
+
+
 GEN_PYZOG_HELP = '在当前文件夹下生成 pyzog.conf 配置文件'
 
 
 @click.command(help=GEN_PYZOG_HELP)
 @click.option('-n', '--name', required=True, type=str, help='pyzog 实例的名称')
 @click.option('-l', '--logpath', required=True, type=click.Path(), help='提供一个路径，pyzog 接收到的日志将放在这里')
-@click.option('-t', '--type', required=True, type=click.Choice(['redis', 'zmq'], case_sensitive=False), help=TYPE_HELP)
+@click.option('-t', '--type', required=True, type=click.Choice(['redis', 'redis_stream', 'zmq', 'broker'], case_sensitive=False), help=TYPE_HELP)
 @click.option('-a', '--addr', required=True, type=str, callback=validate_addr, help=ADDR_HELP)
-@click.option('-m', '--get-message-type', required=False, type=click.Choice(['thread', 'block', 'listen'], case_sensitive=False), default='thread')
+@click.option('-m', '--get-message-type', required=False, type=click.Choice(['poll', 'thread', 'block', 'listen', 'asyncio'], case_sensitive=False), default='poll', help=GET_MESSAGE_TYPE_HELP)
 @click.option('-s', '--sleep-time', required=False, type=float, default=0.001, help=SLEEP_TIME_HELP)
 @click.option('-c', '--channel', required=False, type=str, multiple=True, help=CHANNELS_HELP)
+@click.option('-b', '--backend', required=False, type=str, help='type 为 broker 时接收端连接的地址')
 def genpyzog(**kwargs):
     try:
         replaceobj = {}
@@ -106,13 +480,15 @@ def genpyzog(**kwargs):
             replaceobj[k] = kwargs.get(k)
         replaceobj['addr'] = kwargs.get('addr').string
 
-        if kwargs.get('type') == 'redis':
+        if kwargs.get('type') in ('redis', 'redis_stream'):
             if not kwargs.get('channel'):
                 raise ValueError('必须提供 channel')
             if not kwargs.get('get_message_type'):
                 raise ValueError('必须提供 get-message-type')
             click.echo(kwargs)
-        for k in ('get_message_type', 'sleep_time', 'channel'):
+        if kwargs.get('type') == 'broker' and not kwargs.get('backend'):
+            raise ValueError('必须提供 backend')
+        for k in ('get_message_type', 'sleep_time', 'channel', 'backend'):
             replaceobj[k] = kwargs.get(k)
 
         cwdpath = Path().cwd().joinpath(kwargs.get('name') + '.conf')
@@ -200,6 +576,11 @@ def genprog(name, config_file, user):
 
 
 main.add_command(start)
+main.add_command(broker)
+main.add_command(bench)
+main.add_command(query)
+main.add_command(grep)
+main.add_command(compact)
 main.add_command(genpyzog)
 main.add_command(gensupe)
 main.add_command(gensys)
@@ -0,0 +1,500 @@
+# -*- coding: utf-8 -*-
+"""
+将切分出的 JSON 日志转换为列式存储
+@author zrong
+
+fmt 为 json 的日志每一行都重复字段名，统计报表（每个 channel、每个级别、每分钟的错误数量）需要解析全部的 JSON。
+compact 将切分出的 segment 转换为 name.log.YYYYmmdd-HHMMSS.pzc，每 block_rows 行为一个 block，每列单独压缩：
+
+- created float64，levelno int16，lineno int32
+- module、funcName 使用字典编码，保存为 uint32，字典在文件末尾
+- message 保存为 uint64 的偏移和 UTF-8 字节
+
+文件格式::
+
+    [MAGIC][block 0 的各列][block 1 的各列]...[压缩的 JSON 元数据][元数据长度 uint64][MAGIC]
+
+元数据中包含每个 block 各列的位置以及 created、levelno、lineno、module、funcName 的最小值和最大值，
+查询时先用最小值和最大值跳过不可能匹配的 block，再用 NumPy 对需要的列做向量化的过滤和分组计数。
+转换不需要 NumPy，查询需要 pip install numpy。无法解析的行不会写入，数量记录在元数据中。
+"""
+import fnmatch
+import json
+import logging
+import multiprocessing
+import os
+import struct
+import sys
+import zlib
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from pyzog.grep import list_files, open_compressed
+from pyzog.index import COMPRESSED_SUFFIXES, index_path
+from pyzog.rotate import SEGMENT_RE
+from pyzog.route import get_level
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+MAGIC = b'PZC1'
+TRAILER = struct.Struct('<Q4s')
+ARCHIVE_SUFFIX = '.pzc'
+
+# 每个 block 的行数
+BLOCK_ROWS = 65536
+
+# 定长的列：(名称, array 的 typecode, numpy 的 dtype)
+COLUMNS = (
+    ('created', 'd', '<f8'),
+    ('levelno', 'h', '<i2'),
+    ('lineno', 'i', '<i4'),
+    ('module', 'I', '<u4'),
+    ('funcName', 'I', '<u4'),
+)
+
+# 使用字典编码的列
+DICT_COLUMNS = ('module', 'funcName')
+
+# 可以用于分组的名称，time 按照 bucket 秒取整
+GROUP_KEYS = ('channel', 'level', 'module', 'funcName', 'lineno', 'time')
+
+
+def _require_numpy():
+    if numpy is None:
+        raise ImportError('querying archives requires numpy, please pip install numpy!')
+
+
+def _compress(data, codec):
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor().compress(data)
+    return zlib.compress(data, 6)
+
+
+def _decompress(data, codec):
+    if codec == 'zstd':
+        if zstandard is None:
+            raise ImportError('reading zstd archives requires zstandard, please pip install zstandard!')
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+
+def archive_path(segment):
+    """ segment 对应的列式存储文件，压缩的 segment 使用压缩前的名称
+    """
+    segment = Path(segment)
+    if segment.suffix in COMPRESSED_SUFFIXES:
+        segment = segment.with_suffix('')
+    return segment.with_name(segment.name + ARCHIVE_SUFFIX)
+
+
+class ArchiveWriter(object):
+    """ 逐行写入一个列式存储文件
+    """
+    # 文件路径
+    path = None
+
+    # channel 名称，查询时用于分组
+    channel = None
+
+    # 每个 block 的行数
+    block_rows = BLOCK_ROWS
+
+    # 压缩方式 zlib/zstd
+    codec = 'zlib'
+
+    # 写入的行数和无法解析的行数
+    rows = 0
+    skipped = 0
+
+    def __init__(self, path, channel, block_rows=BLOCK_ROWS, codec=None):
+        """
+        :param path: 文件路径
+        :param channel: channel 名称
+        :param block_rows: 每个 block 的行数
+        :param codec: zlib/zstd，不提供时安装了 zstandard 则使用 zstd
+        """
+        if codec is None:
+            codec = 'zstd' if zstandard is not None else 'zlib'
+        if codec not in ('zlib', 'zstd'):
+            raise ValueError('codec must be one of zlib/zstd!')
+        if codec == 'zstd' and zstandard is None:
+            raise ImportError('codec zstd requires zstandard, please pip install zstandard!')
+        self.path = Path(path)
+        self.channel = channel
+        self.block_rows = int(block_rows)
+        self.codec = codec
+        self.fo = open(self.path, 'wb')
+        self.fo.write(MAGIC)
+        self.blocks = []
+        # {列名: {值: 编码}}，以及按照编码排列的值
+        self.dictionaries = {name: {} for name in DICT_COLUMNS}
+        self.values = {name: [] for name in DICT_COLUMNS}
+        self.reset()
+
+    def reset(self):
+        self.columns = {name: array(typecode) for name, typecode, _ in COLUMNS}
+        self.messages = []
+
+    def encode(self, name, value):
+        codes = self.dictionaries[name]
+        value = value if isinstance(value, str) else ('' if value is None else str(value))
+        code = codes.get(value)
+        if code is None:
+            code = codes[value] = len(codes)
+            self.values[name].append(value)
+        return code
+
+    def add_line(self, line):
+        """ 添加 fmt 为 json 的一行日志，无法解析时返回 False
+        """
+        if not line.startswith(b'{'):
+            self.skipped += 1
+            return False
+        try:
+            record = orjson.loads(line) if orjson is not None else json.loads(line)
+            created = float(record['created'])
+            lineno = int(record.get('lineno') or 0)
+            levelno = record.get('levelno')
+            if not isinstance(levelno, int):
+                levelno = get_level(record.get('levelname') or record.get('level')) or 0
+            # 自定义的 level 或者 lineno 可能超出列的范围，所有的值都检查通过之后才写入，保证各列长度相同
+            if not -0x8000 <= levelno <= 0x7fff or not -0x80000000 <= lineno <= 0x7fffffff:
+                raise ValueError('levelno or lineno out of range!')
+        except (ValueError, KeyError, TypeError):
+            self.skipped += 1
+            return False
+        message = record.get('message')
+        self.columns['created'].append(created)
+        self.columns['levelno'].append(levelno)
+        self.columns['lineno'].append(lineno)
+        for name in DICT_COLUMNS:
+            self.columns[name].append(self.encode(name, record.get(name)))
+        self.messages.append((message if isinstance(message, str) else json.dumps(message, ensure_ascii=False)).encode())
+        if len(self.messages) >= self.block_rows:
+            self.flush_block()
+        return True
+
+    def write_chunk(self, data):
+        offset = self.fo.tell()
+        data = _compress(data, self.codec)
+        self.fo.write(data)
+        return [offset, len(data)]
+
+    def flush_block(self):
+        n = len(self.messages)
+        if n == 0:
+            return
+        block = {'rows': n, 'columns': {}, 'stats': {}}
+        for name, _, _ in COLUMNS:
+            values = self.columns[name]
+            if name in DICT_COLUMNS:
+                strings = [self.values[name][code] for code in set(values)]
+                block['stats'][name] = [min(strings), max(strings)]
+            else:
+                block['stats'][name] = [min(values), max(values)]
+            if sys.byteorder != 'little':
+                values.byteswap()
+            block['columns'][name] = self.write_chunk(values.tobytes())
+        offsets = array('Q', [0])
+        pos = 0
+        for msg in self.messages:
+            pos += len(msg)
+            offsets.append(pos)
+        if sys.byteorder != 'little':
+            offsets.byteswap()
+        block['columns']['message'] = self.write_chunk(offsets.tobytes() + b''.join(self.messages))
+        self.blocks.append(block)
+        self.rows += n
+        self.reset()
+
+    def close(self):
+        """ 写入最后一个 block 和元数据
+        """
+        if self.fo is None:
+            return
+        self.flush_block()
+        meta = {
+            'version': 1,
+            'channel': self.channel,
+            'codec': self.codec,
+            'rows': self.rows,
+            'skipped': self.skipped,
+            'dictionaries': self.values,
+            'blocks': self.blocks,
+        }
+        data = zlib.compress(json.dumps(meta, ensure_ascii=False).encode())
+        self.fo.write(data)
+        self.fo.write(TRAILER.pack(len(data), MAGIC))
+        self.fo.close()
+        self.fo = None
+
+
+def convert_file(source, channel, target=None, block_rows=BLOCK_ROWS, codec=None):
+    """ 将一个 segment 转换为列式存储，在进程池中运行
+    :param source: segment 的路径，可以是压缩的 segment
+    :param channel: channel 名称
+    :param target: 目标文件，不提供则使用 archive_path
+    :return: (source, target, 行数, 无法解析的行数)
+    """
+    source = Path(source)
+    target = Path(target) if target else archive_path(source)
+    tmp = target.with_name(target.name + '.tmp')
+    writer = ArchiveWriter(tmp, channel, block_rows, codec)
+    try:
+        fo = open_compressed(source) if source.suffix in COMPRESSED_SUFFIXES else open(source, 'rb')
+        with fo:
+            for line in fo:
+                line = line.strip()
+                if line:
+                    writer.add_line(line)
+        writer.close()
+    except BaseException:
+        writer.fo.close()
+        tmp.unlink()
+        raise
+    os.replace(tmp, target)
+    return source, target, writer.rows, writer.skipped
+
+
+def list_compact_tasks(logpath, channel='*', ext='.log', force=False):
+    """ 列出需要转换的 segment，当前正在写入的文件不转换
+    :return: [(segment, channel 名称), ...]
+    """
+    tasks = []
+    for path, _ in list_files(logpath, channel, 0, ext):
+        name, sep, _ = path.name.partition(ext + '.')
+        if not sep or SEGMENT_RE.search(path.name) is None:
+            continue
+        if not force and archive_path(path).exists():
+            continue
+        tasks.append((path, name))
+    return tasks
+
+
+def compact(logpath, channel='*', workers=None, block_rows=BLOCK_ROWS, codec=None, remove=False, force=False, ext='.log'):
+    """ 在进程池中将 logpath 中切分出的 segment 转换为列式存储
+    :param channel: channel 名称的通配符
+    :param workers: 进程数量，为 1 时在当前进程中转换，不提供则使用 CPU 数量
+    :param remove: 转换之后删除 segment 及其时间索引
+    :param force: 已经转换过的 segment 也重新转换
+    :return: (source, target, 行数, 无法解析的行数) 的迭代器，按照 segment 的顺序
+    """
+    tasks = list_compact_tasks(logpath, channel, ext, force)
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(tasks) <= 1:
+        results = (convert_file(path, name, None, block_rows, codec) for path, name in tasks)
+        yield from _finish(results, remove)
+        return
+    with ProcessPoolExecutor(min(workers, len(tasks)), mp_context=multiprocessing.get_context('spawn')) as pool:
+        futures = [pool.submit(convert_file, path, name, None, block_rows, codec) for path, name in tasks]
+        yield from _finish((f.result() for f in futures), remove)
+
+
+def _finish(results, remove):
+    for result in results:
+        if remove:
+            source = result[0]
+            source.unlink()
+            idx = index_path(source)
+            if idx.exists():
+                idx.unlink()
+        yield result
+
+
+class Archive(object):
+    """ 读取一个列式存储文件
+    """
+    # 文件路径
+    path = None
+
+    # 元数据
+    meta = None
+
+    # 查询时被最小值和最大值跳过的 block 数量
+    skipped_blocks = 0
+
+    def __init__(self, path):
+        self.path = Path(path)
+        with open(self.path, 'rb') as fo:
+            if fo.read(len(MAGIC)) != MAGIC:
+                raise ValueError('%s is not a pyzog archive!' % self.path)
+            fo.seek(-TRAILER.size, os.SEEK_END)
+            size, magic = TRAILER.unpack(fo.read(TRAILER.size))
+            if magic != MAGIC:
+                raise ValueError('%s is incomplete!' % self.path)
+            fo.seek(-TRAILER.size - size, os.SEEK_END)
+            self.meta = json.loads(zlib.decompress(fo.read(size)))
+        self.dictionaries = self.meta['dictionaries']
+        self.dtypes = {name: dtype for name, _, dtype in COLUMNS}
+
+    @property
+    def channel(self):
+        return self.meta['channel']
+
+    @property
+    def rows(self):
+        return self.meta['rows']
+
+    def read_chunk(self, fo, block, name):
+        offset, length = block['columns'][name]
+        fo.seek(offset)
+        return _decompress(fo.read(length), self.meta['codec'])
+
+    def read_column(self, fo, block, name):
+        """ 读取一个 block 中的一列，message 返回 str 的列表，其它列返回 numpy 数组
+        """
+        data = self.read_chunk(fo, block, name)
+        if name == 'message':
+            n = block['rows']
+            offsets = numpy.frombuffer(data, '<u8', n + 1)
+            body = data[(n + 1) * 8:]
+            return [body[offsets[i]:offsets[i + 1]].decode() for i in range(n)]
+        return numpy.frombuffer(data, self.dtypes[name])
+
+    def match_block(self, block, since=None, until=None, level=None, module=None, funcName=None):
+        """ 根据最小值和最大值判断 block 中是否可能有匹配的行
+        """
+        stats = block['stats']
+        if since is not None and stats['created'][1] < since:
+            return False
+        if until is not None and stats['created'][0] > until:
+            return False
+        if level is not None and stats['levelno'][1] < level:
+            return False
+        for name, value in (('module', module), ('funcName', funcName)):
+            if value is not None and not stats[name][0] <= value <= stats[name][1]:
+                return False
+        return True
+
+    def scan(self, columns, since=None, until=None, level=None, module=None, funcName=None):
+        """ 过滤每个 block，返回 {列名: 匹配的行的 numpy 数组} 的迭代器，跳过的 block 计入 skipped_blocks
+        :param columns: 需要返回的列
+        :param since: created 的起始时间戳
+        :param until: created 的结束时间戳
+        :param level: 最低级别，名称或者数值
+        :param module: module 等于这个值
+        :param funcName: funcName 等于这个值
+        """
+        _require_numpy()
+        if level is not None:
+            level = get_level(level)
+            if level is None:
+                raise ValueError('unknown level!')
+        codes = {}
+        for name, value in (('module', module), ('funcName', funcName)):
+            if value is not None:
+                try:
+                    codes[name] = self.dictionaries[name].index(value)
+                except ValueError:
+                    # 字典中没有这个值，所有 block 都不可能匹配
+                    self.skipped_blocks += len(self.meta['blocks'])
+                    return
+        filters = [name for name, value in (('created', since), ('created', until), ('levelno', level)) if value is not None]
+        needed = set(columns) | set(filters) | set(codes)
+        with open(self.path, 'rb') as fo:
+            for block in self.meta['blocks']:
+                if not self.match_block(block, since, until, level, module, funcName):
+                    self.skipped_blocks += 1
+                    continue
+                data = {name: self.read_column(fo, block, name) for name in needed if name != 'message'}
+                mask = numpy.ones(block['rows'], dtype=bool)
+                if since is not None:
+                    mask &= data['created'] >= since
+                if until is not None:
+                    mask &= data['created'] <= until
+                if level is not None:
+                    mask &= data['levelno'] >= level
+                for name, code in codes.items():
+                    mask &= data[name] == code
+                if not mask.any():
+                    continue
+                result = {name: data[name][mask] for name in columns if name != 'message'}
+                if 'message' in columns:
+                    messages = self.read_column(fo, block, 'message')
+                    result['message'] = [messages[i] for i in numpy.flatnonzero(mask)]
+                yield result
+
+    def count_by(self, by=('level',), bucket=60, **filters):
+        """ 分组计数
+        :param by: GROUP_KEYS 中的名称，time 代表 created 按照 bucket 秒取整后的时间戳
+        :param bucket: time 分组的间隔（秒）
+        :param filters: 传递给 scan 的过滤条件
+        :return: {(分组的值, ...): 数量}
+        """
+        for key in by:
+            if key not in GROUP_KEYS:
+                raise ValueError('by must be in %s!' % '/'.join(GROUP_KEYS))
+        keys = [key for key in by if key != 'channel']
+        columns = [{'level': 'levelno', 'time': 'created'}.get(key, key) for key in keys]
+        counts = {}
+        # 只按照 channel 分组或者不分组时，使用 created 计数
+        for data in self.scan(columns or ['created'], **filters):
+            if not columns:
+                key = (self.channel,) if by else ()
+                counts[key] = counts.get(key, 0) + len(data['created'])
+                continue
+            arrays = []
+            for key, name in zip(keys, columns):
+                values = data[name]
+                if key == 'time':
+                    values = numpy.floor_divide(values, bucket) * bucket
+                arrays.append(values.astype('<i8'))
+            uniq, group_counts = numpy.unique(numpy.stack(arrays, axis=1), axis=0, return_counts=True)
+            for row, n in zip(uniq.tolist(), group_counts.tolist()):
+                values = iter(row)
+                key = tuple(self.channel if k == 'channel' else self.decode(k, next(values)) for k in by)
+                counts[key] = counts.get(key, 0) + n
+        return counts
+
+    def decode(self, key, value):
+        if key == 'level':
+            return logging.getLevelName(value)
+        if key in DICT_COLUMNS:
+            return self.dictionaries[key][value]
+        return value
+
+
+def find_archives(logpath, channel='*', ext='.log'):
+    """ 列出 logpath 中 channel 匹配的列式存储文件，按照名称排列
+    """
+    archives = []
+    for p in sorted(Path(logpath).glob('*' + ext + '.*' + ARCHIVE_SUFFIX)):
+        name = p.name.partition(ext + '.')[0]
+        if fnmatch.fnmatchcase(name, channel):
+            archives.append(p)
+    return archives
+
+
+def count_by(logpath, by=('channel', 'level'), channel='*', bucket=60, ext='.log', **filters):
+    """ 对 logpath 中所有匹配的列式存储文件分组计数，例如每个 channel 每分钟的错误数量::
+
+        count_by(logpath, by=('channel', 'time'), level='ERROR', since=ts)
+
+    :param by: GROUP_KEYS 中的名称
+    :param channel: channel 名称的通配符
+    :param filters: since/until/level/module/funcName，见 Archive.scan
+    :return: (计数, 跳过的 block 数量)，计数为 {(分组的值, ...): 数量}
+    """
+    counts = {}
+    skipped = 0
+    for p in find_archives(logpath, channel, ext):
+        archive = Archive(p)
+        for key, n in archive.count_by(by, bucket, **filters).items():
+            counts[key] = counts.get(key, 0) + n
+        skipped += archive.skipped_blocks
+    return counts, skipped
@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+"""
+发送端的限流、采样和重复日志合并
+@author zrong
+
+下游依赖故障时，应用可能在一秒内输出成千上万条相同的错误日志，全部发送会拖垮 redis 和接收器。
+ThrottleFilter 挂在 handler 上，在格式化和发送之前丢弃多余的日志：
+
+- 按照概率对 DEBUG/INFO 等级别采样；
+- 在一个时间窗口内相同的日志只发送第一条，窗口结束时由定时器补发一条 "repeated N times" 的日志；
+- 按照 (logger 名称, level) 使用令牌桶限流。
+
+被丢弃的数量记录在计数器中，可以通过 get_stats 获取。
+"""
+import logging
+import random
+import threading
+import time
+
+
+def _get_level(level):
+    if isinstance(level, str):
+        value = logging.getLevelName(level.upper())
+        if not isinstance(value, int):
+            raise ValueError('unknown level %s!' % level)
+        return value
+    return int(level)
+
+
+def _get_level_map(value, default_levels):
+    """ 将数值或者 {level: value} 转换为 {levelno: value}
+    :param default_levels: value 为数值时应用到这些 level，为 None 代表所有 level
+    """
+    if value is None:
+        return {}
+    if isinstance(value, dict):
+        return {_get_level(k): float(v) for k, v in value.items()}
+    if default_levels is None:
+        return {None: float(value)}
+    return {level: float(value) for level in default_levels}
+
+
+class TokenBucket(object):
+    """ 令牌桶，每秒补充 rate 个令牌，最多存放 burst 个
+    """
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.ts = time.monotonic()
+
+    def consume(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.ts) * self.rate)
+        self.ts = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+class ThrottleFilter(logging.Filter):
+    """ 限流、采样和重复日志合并，由 get_logging_handler 添加到 handler 上
+    """
+    # 每个 (logger, level) 每秒允许的日志数量，key 为 levelno，key 为 None 代表所有 level
+    rates = None
+
+    # 令牌桶的容量，为 None 时与 rate 相同
+    burst = None
+
+    # 每个 level 保留的概率，key 为 levelno
+    samples = None
+
+    # 合并相同日志的时间窗口（秒），为 0 代表不合并
+    dedup_window = 0
+
+    # 合并窗口中最多跟踪的不同日志数量，超出后不再合并新的日志
+    dedup_max_keys = 10000
+
+    # 发送汇总日志使用的 handler
+    handler = None
+
+    # 有日志被合并时启动，在窗口结束时补发汇总日志
+    timer = None
+
+    def __init__(self, handler=None, rate_limit=None, rate_burst=None, sample=None, dedup_window=0, dedup_max_keys=10000):
+        """
+        :param handler: 用于补发 "repeated N times" 日志的 handler
+        :param rate_limit: 数值代表每个 (logger, level) 每秒允许的日志数量；也可以是 {level: 数值}，只限制这些 level
+        :param rate_burst: 令牌桶的容量，允许短时间的突发，默认与 rate_limit 相同
+        :param sample: 数值代表 DEBUG/INFO 日志保留的概率，例如 0.1；也可以是 {level: 概率}
+        :param dedup_window: 合并相同日志的时间窗口（秒），为 0 代表不合并
+        :param dedup_max_keys: 合并窗口中最多跟踪的不同日志数量
+        """
+        logging.Filter.__init__(self)
+        self.handler = handler
+        self.rates = _get_level_map(rate_limit, None)
+        self.burst = None if rate_burst is None else float(rate_burst)
+        self.samples = _get_level_map(sample, (logging.DEBUG, logging.INFO))
+        for p in self.samples.values():
+            if not 0 <= p <= 1:
+                raise ValueError('sample must be between 0 and 1!')
+        self.dedup_window = float(dedup_window)
+        self.dedup_max_keys = int(dedup_max_keys)
+        self.buckets = {}
+        # key 为日志内容，value 为 [窗口结束时间, 窗口开始时间, 被合并的数量, 最后一条 LogRecord]
+        self.pending = {}
+        self.next_check = 0
+        self.lock = threading.Lock()
+        self.rate_limited = 0
+        self.sampled_out = 0
+        self.deduplicated = 0
+        self.summaries = 0
+
+    @property
+    def enabled(self):
+        return bool(self.rates or self.samples or self.dedup_window > 0)
+
+    def filter(self, record):
+        if getattr(record, '_pyzog_summary', False):
+            return True
+        now = time.monotonic()
+        summaries = None
+        with self.lock:
+            if self.pending and now >= self.next_check:
+                summaries = self.expire(now)
+            allowed = self.check(record, now)
+        if summaries:
+            self.emit_summaries(summaries)
+        return allowed
+
+    def check(self, record, now):
+        levelno = record.levelno
+        new_key = None
+        sample = self.samples.get(levelno)
+        if sample is not None and random.random() >= sample:
+            self.sampled_out += 1
+            return False
+        if self.dedup_window > 0:
+            key = (record.name, levelno, record.pathname, record.lineno, record.getMessage())
+            item = self.pending.get(key)
+            if item is not None:
+                item[2] += 1
+                item[3] = record
+                self.deduplicated += 1
+                self.schedule(item[0] - now)
+                return False
+            if len(self.pending) < self.dedup_max_keys:
+                if not self.pending:
+                    self.next_check = now + self.dedup_window
+                new_key = key
+        rate = self.rates.get(levelno, self.rates.get(None))
+        if rate is not None:
+            key = (record.name, levelno)
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = TokenBucket(rate, self.burst or max(rate, 1.0))
+            if not bucket.consume(now):
+                self.rate_limited += 1
+                return False
+        if new_key is not None:
+            self.pending[new_key] = [now + self.dedup_window, now, 0, record]
+        return True
+
+    def schedule(self, delay):
+        """ 启动定时器，在持有 self.lock 时调用
+        """
+        if self.timer is not None or self.handler is None:
+            return
+        self.timer = threading.Timer(max(delay, 0), self.on_timer)
+        self.timer.name = 'pyzog.ThrottleFilter'
+        self.timer.daemon = True
+        self.timer.start()
+
+    def on_timer(self):
+        """ 补发已经结束的窗口的汇总日志，还有被合并的日志时继续等待下一个窗口结束
+        """
+        now = time.monotonic()
+        with self.lock:
+            self.timer = None
+            summaries = self.expire(now)
+            waiting = [item[0] for item in self.pending.values() if item[2] > 0]
+            if waiting:
+                self.schedule(min(waiting) - now)
+        self.emit_summaries(summaries)
+
+    def expire(self, now, force=False):
+        """ 移除已经结束的合并窗口，返回需要补发汇总日志的项目
+        """
+        summaries = []
+        next_check = now + self.dedup_window
+        for key, item in list(self.pending.items()):
+            if force or now >= item[0]:
+                del self.pending[key]
+                if item[2] > 0:
+                    summaries.append(item)
+            else:
+                next_check = min(next_check, item[0])
+        self.next_check = next_check
+        return summaries
+
+    def make_summary(self, item):
+        _, start, count, record = item
+        summary = logging.makeLogRecord(record.__dict__)
+        summary.msg = '%s (repeated %d times in %.1fs)'
+        summary.args = (record.getMessage(), count, time.monotonic() - start)
+        summary.exc_info = None
+        summary.exc_text = None
+        summary.stack_info = None
+        summary._pyzog_summary = True
+        return summary
+
+    def emit_summaries(self, summaries):
+        if self.handler is None:
+            return
+        for item in summaries:
+            self.summaries += 1
+            self.handler.handle(self.make_summary(item))
+
+    def flush(self):
+        """ 结束所有的合并窗口并补发汇总日志，在 handler 关闭时调用
+        """
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            summaries = self.expire(time.monotonic(), force=True)
+        self.emit_summaries(summaries)
+
+    def get_stats(self):
+        return {
+            'rate_limited': self.rate_limited,
+            'sampled_out': self.sampled_out,
+            'deduplicated': self.deduplicated,
+            'summaries': self.summaries,
+        }
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+"""
+定义 Formatter 以及接收端对应的解码
+@author zrong
+
+fmt 为 msgpack 时，发送端只将 LogRecord 中的部分字段按固定顺序打包为 msgpack 数组，
+不在应用线程中生成 JSON 字符串。打包结果以 MSGPACK_MAGIC 开头，
+0xC1 在 msgpack 中从未使用，也不可能出现在 UTF-8 文本的开头，接收端据此区分文本和二进制数据。
+
+fmt 为 json 时使用 FastJsonFormatter，在初始化时解析字段列表和需要跳过的 LogRecord 属性，
+默认使用标准库 json 序列化，输出与 python-json-logger 的 JsonFormatter 逐字节相同；
+指定 orjson/ujson 时更快，但分隔符和非 ASCII 字符的转义不同。
+"""
+import base64
+import dataclasses
+import datetime
+import enum
+import json
+import logging
+import re
+import time
+import traceback
+from types import TracebackType
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+MSGPACK_MAGIC = b'\xc1'
+
+# 打包的字段及其顺序，与 pyzog.logging.JSON_LOG_FORMAT 中的字段一致
+MSGPACK_FIELDS = ('levelname', 'module', 'funcName', 'pathname', 'lineno', 'threadName', 'processName', 'created', 'message')
+
+# 接收端对 msgpack 数据的处理方式
+# json 转换为一行 JSON；text 转换为 TEXT_LOG_FORMAT 格式的文本；raw 原样保存到 name.msgpack 文件
+MSGPACK_RENDERS = ('json', 'text', 'raw')
+
+
+def _require_msgpack():
+    if msgpack is None:
+        raise ImportError('fmt msgpack requires msgpack, please pip install msgpack!')
+
+
+class MsgpackFormatter(logging.Formatter):
+    """ 将 LogRecord 打包为 msgpack，format 返回 bytes
+    """
+    def __init__(self):
+        _require_msgpack()
+        logging.Formatter.__init__(self)
+
+    def format(self, record):
+        message = record.getMessage()
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            message = message + '\n' + record.exc_text
+        if record.stack_info:
+            message = message + '\n' + self.formatStack(record.stack_info)
+        return MSGPACK_MAGIC + msgpack.packb([
+            record.levelname, record.module, record.funcName, record.pathname, record.lineno,
+            record.threadName, record.processName, record.created, message])
+
+
+def is_msgpack(data):
+    return data[:1] == MSGPACK_MAGIC
+
+
+def unpack_record(data):
+    """ 将 MsgpackFormatter 的结果解码为 dict，数据无法解码时抛出 ValueError
+    """
+    _require_msgpack()
+    values = msgpack.unpackb(data[1:])
+    if not isinstance(values, list) or len(values) != len(MSGPACK_FIELDS):
+        raise ValueError('invalid msgpack record!')
+    return dict(zip(MSGPACK_FIELDS, values))
+
+
+def render_record(obj, render):
+    """ 将 unpack_record 得到的 dict 转换为一行 bytes
+    :param render: json/text
+    """
+    if render == 'text':
+        ct = time.localtime(obj['created'])
+        asctime = '%s,%03d' % (time.strftime('%Y-%m-%d %H:%M:%S', ct), (obj['created'] - int(obj['created'])) * 1000)
+        # 与 TEXT_LOG_FORMAT 一致
+        return ('\n[%s] %s in %s.%s [%s:%d]:\n%s' % (asctime, obj['levelname'], obj['module'], obj['funcName'],
+            obj['pathname'], obj['lineno'], obj['message'])).encode()
+    return json.dumps(obj, ensure_ascii=False).encode()
+
+
+# 可用的 JSON 序列化方式，按速度排列
+JSON_ENCODERS = ('orjson', 'ujson', 'json')
+
+# 与 python-json-logger 相同，LogRecord 的标准属性不会作为额外字段输出
+RESERVED_ATTRS = frozenset(logging.LogRecord('', 0, '', 0, '', None, None).__dict__) | {'message', 'asctime'}
+
+
+def json_default(obj):
+    """ 无法直接序列化的对象的转换方式，与 python-json-logger 一致
+    """
+    if isinstance(obj, (datetime.date, datetime.time)):
+        return obj.isoformat()
+    if isinstance(obj, BaseException):
+        return '%s: %s' % (obj.__class__.__name__, obj)
+    if isinstance(obj, TracebackType):
+        return ''.join(traceback.format_tb(obj)).strip()
+    if isinstance(obj, enum.Enum):
+        return obj.value
+    if isinstance(obj, enum.EnumMeta):
+        return [e.value for e in obj]
+    if isinstance(obj, (bytes, bytearray)):
+        return base64.urlsafe_b64encode(obj).decode()
+    if dataclasses.is_dataclass(obj) and not isinstance(obj, type):
+        return dataclasses.asdict(obj)
+    if isinstance(obj, type):
+        return obj.__name__
+    try:
+        return str(obj)
+    except Exception:
+        return '__could_not_encode__'
+
+
+def get_json_dumps(encoder=None):
+    """ 获取序列化函数，返回 (名称, 函数)，函数的参数为 dict，返回 str
+    :param encoder: orjson/ujson/json，为 None 时使用已经安装的最快的那个
+    """
+    if encoder is not None and encoder not in JSON_ENCODERS:
+        raise ValueError('encoder must be one of %s!' % '/'.join(JSON_ENCODERS))
+    if encoder in (None, 'orjson') and orjson is not None:
+        def dumps(obj):
+            return orjson.dumps(obj, default=json_default, option=orjson.OPT_NON_STR_KEYS).decode()
+        return 'orjson', dumps
+    if encoder in (None, 'ujson') and ujson is not None:
+        def dumps(obj):
+            return ujson.dumps(obj, default=json_default, ensure_ascii=False, escape_forward_slashes=False)
+        return 'ujson', dumps
+    if encoder not in (None, 'json'):
+        raise ImportError('encoder %s is not installed, please pip install %s!' % (encoder, encoder))
+    return 'json', json.JSONEncoder(default=json_default).encode
+
+
+class FastJsonFormatter(logging.Formatter):
+    """ 将 LogRecord 转换为一行 JSON
+
+    字段列表只在初始化时从 fmt 中解析一次。默认使用标准库 json，输出与 python-json-logger 完全相同；
+    指定 orjson/ujson 时字段、顺序和值相同，但分隔符后没有空格，非 ASCII 字符也不转义，不能与原有的日志逐字节比较。
+    """
+    # fmt 中的字段，按顺序输出
+    fields = None
+
+    # 不作为额外字段输出的 LogRecord 属性
+    skip_fields = None
+
+    # 实际使用的序列化方式
+    encoder = None
+
+    def __init__(self, fmt, encoder='json'):
+        """
+        :param fmt: 形如 JSON_LOG_FORMAT 的字符串，只使用其中 %(name) 的字段名称
+        :param encoder: orjson/ujson/json，为 None 时使用已经安装的最快的那个
+        """
+        logging.Formatter.__init__(self)
+        self.fields = tuple(re.findall(r'%\((.+?)\)', fmt))
+        self.skip_fields = RESERVED_ATTRS | set(self.fields)
+        self.need_asctime = 'asctime' in self.fields
+        self.encoder, self.dumps = get_json_dumps(encoder)
+        self.fallback_dumps = get_json_dumps('json')[1]
+
+    def format(self, record):
+        message_dict = None
+        if isinstance(record.msg, dict):
+            message_dict = record.msg.copy()
+            record.message = ''
+        else:
+            record.message = record.getMessage()
+        if self.need_asctime:
+            record.asctime = self.formatTime(record, self.datefmt)
+        if record.exc_info or record.exc_text or record.stack_info:
+            if message_dict is None:
+                message_dict = {}
+            if record.exc_info and not message_dict.get('exc_info'):
+                message_dict['exc_info'] = self.formatException(record.exc_info)
+            if not message_dict.get('exc_info') and record.exc_text:
+                message_dict['exc_info'] = record.exc_text
+            if record.stack_info and not message_dict.get('stack_info'):
+                message_dict['stack_info'] = self.formatStack(record.stack_info)
+
+        attrs = record.__dict__
+        data = {field: attrs.get(field) for field in self.fields}
+        if message_dict:
+            data.update(message_dict)
+        skip = self.skip_fields
+        for key, value in attrs.items():
+            if key not in skip and not (isinstance(key, str) and key.startswith('_')):
+                data[key] = value
+        try:
+            return self.dumps(data)
+        except (TypeError, OverflowError):
+            # 例如 orjson 不支持超过 64 位的整数
+            return self.fallback_dumps(data)
@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+"""
+在 logpath 中并行搜索日志
+@author zrong
+
+搜索当前的日志文件以及切分出的 segment。较大的文件按照 chunk_size 切分为多个任务，
+每个任务在进程池中使用 mmap 扫描，任务的边界对齐到行首；压缩的 segment 使用流式解压，每个文件一个任务。
+结果按照 channel 名称、segment 时间以及文件中的位置排序后输出，与顺序扫描的结果一致。
+
+提供 field 时，每一行作为 fmt 为 json 的日志解析，只在这个字段的值中搜索。
+
+since 依赖时间索引：有索引的文件从索引中的偏移开始搜索，精度为一个采样间隔；
+没有索引的文件只按照修改时间跳过，否则从头搜索，不会按照每一行的时间过滤。
+"""
+import fnmatch
+import gzip
+import json
+import mmap
+import multiprocessing
+import os
+import re
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from pyzog.index import COMPRESSED_SUFFIXES, INDEX_ENTRY, IndexView, find_range, index_path
+from pyzog.rotate import list_segments
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# 每个任务扫描的字节数
+CHUNK_SIZE = 64 * 1024 * 1024
+
+# 每个进程最多同时提交的任务数量，限制等待输出的结果占用的内存
+PENDING_PER_WORKER = 2
+
+
+def list_files(logpath, channel='*', since=0, ext='.log'):
+    """ 列出需要搜索的文件，返回 [(path, 起始偏移), ...]
+    :param logpath: 日志存储文件夹
+    :param channel: channel 名称的通配符
+    :param since: 只搜索这个时间戳之后的日志，有时间索引时从索引中的偏移开始，
+        没有索引时只跳过修改时间早于 since 的文件，为 0 代表所有
+    :param ext: 日志文件的扩展名
+    """
+    logpath = Path(logpath)
+    names = set()
+    for p in logpath.iterdir():
+        if p.name.endswith(ext):
+            names.add(p.name[:-len(ext)])
+        else:
+            # 当前文件可能已经被关闭，只剩下 segment
+            name, sep, _ = p.name.partition(ext + '.')
+            if sep:
+                names.add(name)
+    files = []
+    for name in sorted(names):
+        if not fnmatch.fnmatchcase(name, channel):
+            continue
+        path = logpath.joinpath(name + ext)
+        for p in list_segments(path) + [path]:
+            if not p.exists():
+                continue
+            start = 0
+            if since > 0:
+                if p.stat().st_mtime + 1 < since:
+                    continue
+                start = get_start_offset(p, since)
+            files.append((p, start))
+    return files
+
+
+def get_start_offset(path, since):
+    """ 使用时间索引找到 since 对应的偏移，没有索引时返回 0
+    """
+    try:
+        with open(index_path(path), 'rb') as fo:
+            size = os.fstat(fo.fileno()).st_size
+            size -= size % INDEX_ENTRY.size
+            if size == 0:
+                return 0
+            with mmap.mmap(fo.fileno(), size, access=mmap.ACCESS_READ) as mm:
+                return find_range(IndexView(mm), since, since)[0]
+    except FileNotFoundError:
+        return 0
+
+
+def make_tasks(files, chunk_size=CHUNK_SIZE):
+    """ 将文件切分为任务，返回 [(path, start, end), ...]，end 为 None 代表文件末尾
+    """
+    tasks = []
+    for path, start in files:
+        if path.suffix in COMPRESSED_SUFFIXES:
+            tasks.append((path, start, None))
+            continue
+        size = path.stat().st_size
+        if size <= start:
+            continue
+        for pos in range(start, size, chunk_size):
+            tasks.append((path, pos, min(pos + chunk_size, size)))
+    return tasks
+
+
+class Matcher(object):
+    """ 判断一行是否匹配
+    """
+    def __init__(self, pattern, field=None, ignore_case=False):
+        flags = re.IGNORECASE if ignore_case else 0
+        self.field = field
+        if field is None:
+            self.regex = re.compile(pattern.encode(), flags | re.MULTILINE)
+        else:
+            self.regex = re.compile(pattern, flags)
+
+    def match_line(self, line):
+        if self.field is None:
+            return self.regex.search(line) is not None
+        try:
+            value = json.loads(line).get(self.field)
+        except (ValueError, AttributeError):
+            return False
+        if value is None:
+            return False
+        return self.regex.search(value if isinstance(value, str) else json.dumps(value, ensure_ascii=False)) is not None
+
+
+def scan_buffer(buf, start, end, matcher, count_only):
+    """ 扫描 buf 中行首位于 [start, end) 的所有行
+    :return: (匹配的行数, 匹配的行)
+    """
+    if start > 0 and buf[start - 1:start] != b'\n':
+        # 行首不在这个范围内的行属于上一个任务
+        pos = buf.find(b'\n', start)
+        start = end if pos < 0 else pos + 1
+    count = 0
+    lines = []
+    if matcher.field is None:
+        # 直接在整块数据上搜索，找到匹配之后再确定所在的行。
+        # 搜索范围限制在 end 所在行的行尾，不扫描后面任务的数据
+        endpos = buf.find(b'\n', end - 1) if end > 0 else 0
+        if endpos < 0:
+            endpos = len(buf)
+        pos = start
+        while pos < end:
+            m = matcher.regex.search(buf, pos, endpos)
+            if m is None:
+                break
+            line_start = buf.rfind(b'\n', 0, m.start()) + 1
+            if line_start >= end:
+                break
+            line_end = buf.find(b'\n', m.start())
+            if line_end < 0:
+                line_end = len(buf)
+            count += 1
+            if not count_only:
+                lines.append(bytes(buf[line_start:line_end]))
+            pos = line_end + 1
+        return count, lines
+    pos = start
+    while pos < end:
+        line_end = buf.find(b'\n', pos)
+        if line_end < 0:
+            line_end = len(buf)
+        line = buf[pos:line_end]
+        if matcher.match_line(line):
+            count += 1
+            if not count_only:
+                lines.append(bytes(line))
+        pos = line_end + 1
+    return count, lines
+
+
+def open_compressed(path):
+    if path.suffix == '.zst':
+        if zstandard is None:
+            raise ImportError('reading %s requires zstandard, please pip install zstandard!' % path)
+        return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True)
+    return gzip.open(path, 'rb')
+
+
+def scan_task(task, pattern, field, ignore_case, count_only):
+    """ 在进程池中运行，扫描一个任务
+    """
+    path, start, end = task
+    matcher = Matcher(pattern, field, ignore_case)
+    if end is None:
+        # 压缩的文件逐行扫描
+        count = 0
+        lines = []
+        pos = 0
+        with open_compressed(path) as fo:
+            for line in fo:
+                line_start, pos = pos, pos + len(line)
+                if line_start < start:
+                    continue
+                line = line.rstrip(b'\n')
+                if matcher.match_line(line):
+                    count += 1
+                    if not count_only:
+                        lines.append(line)
+        return count, lines
+    with open(path, 'rb') as fo:
+        with mmap.mmap(fo.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return scan_buffer(mm, start, end, matcher, count_only)
+
+
+def grep(logpath, pattern, channel='*', since=0, field=None, ignore_case=False, count_only=False,
+    workers=None, chunk_size=CHUNK_SIZE, ext='.log'):
+    """ 搜索 logpath 中的日志，按照顺序返回结果
+    :param pattern: 正则表达式
+    :param channel: channel 名称的通配符
+    :param since: 只搜索这个时间戳之后的日志，需要时间索引，见 list_files
+    :param field: 在 fmt 为 json 的日志的这个字段中搜索
+    :param count_only: 只统计数量
+    :param workers: 进程数量，为 1 时在当前进程中扫描，不提供则使用 CPU 数量
+    :return: (path, 匹配的行数, 匹配的行) 的迭代器，每个文件一项
+    """
+    tasks = make_tasks(list_files(logpath, channel, since, ext), chunk_size)
+    args = (pattern, field, ignore_case, count_only)
+    workers = workers or os.cpu_count() or 1
+    if workers == 1 or len(tasks) <= 1:
+        results = (scan_task(task, *args) for task in tasks)
+        yield from _merge(tasks, results)
+        return
+    workers = min(workers, len(tasks))
+    with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        yield from _merge(tasks, _ordered_results(pool, tasks, args, workers * PENDING_PER_WORKER))
+
+
+def _ordered_results(pool, tasks, args, limit):
+    """ 按照任务的顺序返回结果，最多同时提交 limit 个任务
+    """
+    futures = deque()
+    for task in tasks:
+        if len(futures) >= limit:
+            yield futures.popleft().result()
+        futures.append(pool.submit(scan_task, task, *args))
+    while futures:
+        yield futures.popleft().result()
+
+
+def _merge(tasks, results):
+    """ 将同一个文件的多个任务的结果合并
+    """
+    current = None
+    count = 0
+    lines = []
+    for (path, _, _), (n, matched) in zip(tasks, results):
+        if path != current:
+            if current is not None:
+                yield current, count, lines
+            current, count, lines = path, 0, []
+        count += n
+        lines.extend(matched)
+    if current is not None:
+        yield current, count, lines
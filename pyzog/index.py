@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""
+日志文件的时间索引
+@author zrong
+
+接收端为每个日志文件维护一个 name.log.idx 文件，每隔 index_every 条日志或者 index_interval 秒
+记录一次接收时间和这条日志在文件中的字节偏移。索引项的格式为::
+
+    [接收时间 float64][偏移 uint64]
+
+查询某个时间段时，在 mmap 的索引上二分查找起止偏移，只读取日志文件中对应的字节范围。
+范围的精度为一个采样间隔，结果可能多出前后最多一个间隔的日志，但不会遗漏。
+
+切分出的 segment 的索引命名为 segment.idx，压缩后的 segment 也使用这个索引，偏移为解压后的偏移。
+"""
+import bisect
+import gzip
+import mmap
+import os
+import struct
+import time
+from pathlib import Path
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+INDEX_SUFFIX = '.idx'
+INDEX_ENTRY = struct.Struct('<dQ')
+
+# 压缩的 segment 的扩展名
+COMPRESSED_SUFFIXES = ('.gz', '.zst')
+
+# 读取日志时每次输出的字节数
+CHUNK_SIZE = 1024 * 1024
+
+
+def index_path(path):
+    """ 日志文件或者 segment 对应的索引文件，压缩的 segment 使用压缩前的名称
+    """
+    path = Path(path)
+    if path.suffix in COMPRESSED_SUFFIXES:
+        path = path.with_suffix('')
+    return path.with_name(path.name + INDEX_SUFFIX)
+
+
+class TimeIndex(object):
+    """ 写入端的索引，由 FileWriter 调用
+    """
+    # 索引文件路径
+    path = None
+
+    # 每隔多少条日志记录一次，为 0 代表不按数量记录
+    every = 1000
+
+    # 每隔多少秒记录一次，为 0 代表不按时间记录
+    interval = 1.0
+
+    # 距离上次记录的日志数量和时间
+    count = 0
+    last_ts = 0
+
+    fd = None
+
+    def __init__(self, path, every=1000, interval=1.0, truncate=False):
+        """
+        :param path: 索引文件路径
+        :param truncate: 是否清空已有的索引，日志文件为空时已有的索引已经失效
+        """
+        self.path = Path(path)
+        self.every = int(every)
+        self.interval = float(interval)
+        self.pending = bytearray()
+        flags = os.O_WRONLY | os.O_APPEND | os.O_CREAT
+        if truncate:
+            flags |= os.O_TRUNC
+        self.fd = os.open(str(self.path), flags, 0o666)
+
+    def add(self, offset):
+        """ 在写入一条日志之前调用
+        :param offset: 这条日志在文件中的偏移
+        """
+        self.count += 1
+        # 第一条日志总是记录
+        if self.last_ts and (self.every <= 0 or self.count < self.every):
+            if self.interval <= 0:
+                return
+            ts = time.time()
+            if ts - self.last_ts < self.interval:
+                return
+        else:
+            ts = time.time()
+        self.count = 0
+        self.last_ts = ts
+        self.pending += INDEX_ENTRY.pack(ts, offset)
+
+    def flush(self):
+        """ 在日志写入磁盘之后调用，保证索引不会指向还没有写入的位置
+        """
+        if self.pending:
+            os.write(self.fd, self.pending)
+            self.pending.clear()
+
+    def close(self):
+        if self.fd is None:
+            return
+        self.flush()
+        os.close(self.fd)
+        self.fd = None
+
+    def move(self, target):
+        """ 日志文件被切分为 segment 时，索引也一起改名
+        """
+        self.close()
+        os.rename(str(self.path), str(target))
+
+
+class IndexView(object):
+    """ 将 mmap 的索引文件作为时间戳的序列，用于 bisect
+    """
+    def __init__(self, buf):
+        self.buf = buf
+
+    def __len__(self):
+        return len(self.buf) // INDEX_ENTRY.size
+
+    def __getitem__(self, i):
+        return INDEX_ENTRY.unpack_from(self.buf, i * INDEX_ENTRY.size)[0]
+
+    def offset(self, i):
+        return INDEX_ENTRY.unpack_from(self.buf, i * INDEX_ENTRY.size)[1]
+
+
+def find_range(view, start_ts, end_ts):
+    """ 在索引中二分查找
+    :return: (起始偏移, 结束偏移)，结束偏移为 None 代表文件末尾
+    """
+    n = len(view)
+    i = bisect.bisect_right(view, start_ts) - 1
+    start = view.offset(i) if i >= 0 else 0
+    j = bisect.bisect_right(view, end_ts)
+    end = view.offset(j) if j < n else None
+    return start, end
+
+
+def read_range(path, start, end):
+    """ 读取日志文件中 [start, end) 的字节，压缩的 segment 使用流式解压
+    :return: bytes 的迭代器
+    """
+    path = Path(path)
+    if path.suffix in COMPRESSED_SUFFIXES:
+        if path.suffix == '.zst':
+            if zstandard is None:
+                raise ImportError('reading %s requires zstandard, please pip install zstandard!' % path)
+            fo = zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True)
+        else:
+            fo = gzip.open(path, 'rb')
+        with fo:
+            # 压缩的文件只能从头解压，跳过 start 之前的数据
+            skip = start
+            while skip > 0:
+                data = fo.read(min(skip, CHUNK_SIZE))
+                if not data:
+                    return
+                skip -= len(data)
+            remain = None if end is None else end - start
+            while remain is None or remain > 0:
+                data = fo.read(CHUNK_SIZE if remain is None else min(remain, CHUNK_SIZE))
+                if not data:
+                    return
+                if remain is not None:
+                    remain -= len(data)
+                yield data
+        return
+    with open(path, 'rb') as fo:
+        size = os.fstat(fo.fileno()).st_size
+        if size == 0:
+            return
+        with mmap.mmap(fo.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            end = size if end is None else min(end, size)
+            for pos in range(start, end, CHUNK_SIZE):
+                yield mm[pos:min(pos + CHUNK_SIZE, end)]
+
+
+def query_file(path, start_ts, end_ts):
+    """ 读取一个日志文件或者 segment 中接收时间在 [start_ts, end_ts] 之间的日志
+    :return: bytes 的迭代器，没有索引或者时间不重合时为空
+    """
+    idx = index_path(path)
+    try:
+        with open(idx, 'rb') as fo:
+            size = os.fstat(fo.fileno()).st_size
+            size -= size % INDEX_ENTRY.size
+            if size == 0:
+                return
+            with mmap.mmap(fo.fileno(), size, access=mmap.ACCESS_READ) as mm:
+                view = IndexView(mm)
+                # 最后一条日志的时间不会晚于文件的修改时间，文件系统的 mtime 精度较低，留出 1 秒
+                if view[0] > end_ts or os.stat(path).st_mtime + 1 < start_ts:
+                    return
+                start, end = find_range(view, start_ts, end_ts)
+    except FileNotFoundError:
+        return
+    yield from read_range(path, start, end)
+
+
+def query_channel(logpath, channel, start_ts, end_ts, ext='.log'):
+    """ 按照时间顺序读取一个 channel 的所有 segment 和当前文件
+    :param logpath: 日志存储文件夹
+    :param channel: 文件名，不带扩展名
+    :return: bytes 的迭代器
+    """
+    # 避免循环导入
+    from pyzog.rotate import list_segments
+    path = Path(logpath).joinpath(channel + ext)
+    for p in list_segments(path) + [path]:
+        if p.exists():
+            yield from query_file(p, start_ts, end_ts)
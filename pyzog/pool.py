@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+接收端的写入线程池
+@author zrong
+
+默认由接收消息的线程直接写入文件，磁盘变慢或者 fsync 卡住时接收也会停止，
+redis 的 pubsub 连接可能因为超过 client-output-buffer-limit 被断开。
+
+使用 WriterPool 后，接收线程只把 (channel, payload) 放入队列，由 workers 个写入线程完成解码、路由和写入。
+每个 channel 固定由同一个写入线程处理，同一个 channel 的日志保持接收的顺序。
+
+每个队列的正常容量为 queue_size 条，超出后继续在内存中保存，直到超出的部分达到 spill_bytes，
+此时按照 overflow 处理：block 让接收线程等待，drop 丢弃。队列的最高水位、溢出的数量和字节数、
+等待和丢弃的数量都记录在统计信息中，可以在丢失日志之前发现写入跟不上接收。
+"""
+import threading
+import time
+import zlib
+from collections import deque
+
+
+class WriterShard(object):
+    """ 一个写入线程和它的队列
+    """
+    def __init__(self):
+        # [(name, data, 是否为溢出部分), ...]
+        self.items = deque()
+        self.cond = threading.Condition()
+        # 溢出部分的字节数
+        self.spill_bytes = 0
+        # 队列的最高水位
+        self.high_water = 0
+        # 正在写入的数量，用于 wait
+        self.busy = 0
+        self.thread = None
+
+
+class WriterPool(object):
+    """ 按照 channel 分片的写入线程池
+    """
+    # 写入线程数量
+    workers = 2
+
+    # 每个队列的正常容量（条）
+    queue_size = 10000
+
+    # 所有队列超出正常容量后最多在内存中保存的字节数，平均分配给每个队列
+    spill_bytes = 64 * 1024 * 1024
+
+    # 超出 spill_bytes 时的处理方式 block/drop
+    overflow = 'block'
+
+    # 写入线程每次从队列中取出的最大数量
+    batch_size = 1000
+
+    # 统计计数
+    spilled = 0
+    dropped = 0
+    blocked = 0
+    blocked_seconds = 0.0
+    errors = 0
+
+    OVERFLOW_POLICIES = ('block', 'drop')
+
+    def __init__(self, handle, workers=2, queue_size=10000, spill_bytes=64 * 1024 * 1024, overflow='block', logger=None):
+        """
+        :param handle: 在写入线程中调用的函数，参数为 (name, data)
+        :param workers: 写入线程数量
+        :param queue_size: 每个队列的正常容量（条）
+        :param spill_bytes: 超出正常容量后最多在内存中保存的字节数
+        :param overflow: 超出 spill_bytes 时的处理方式 block/drop
+        :param logger: 记录写入错误的 logger
+        """
+        if overflow not in self.OVERFLOW_POLICIES:
+            raise ValueError('overflow must be one of %s!' % '/'.join(self.OVERFLOW_POLICIES))
+        self.handle = handle
+        self.workers = int(workers)
+        if self.workers < 1:
+            raise ValueError('workers must be greater than 0!')
+        self.queue_size = int(queue_size)
+        self.spill_bytes = int(spill_bytes)
+        self.shard_spill_bytes = self.spill_bytes // self.workers
+        self.overflow = overflow
+        self.logger = logger
+        self.shards = [WriterShard() for _ in range(self.workers)]
+        # channel 对应的 shard 的缓存
+        self.assigned = {}
+        self.stopped = False
+        # 多个写入线程共用的 errors 计数
+        self.lock = threading.Lock()
+
+    def start(self):
+        for i, shard in enumerate(self.shards):
+            if shard.thread is None:
+                shard.thread = threading.Thread(target=self._run, args=(shard,), name='pyzog.WriterPool.%s' % i, daemon=True)
+                shard.thread.start()
+
+    def get_shard(self, name):
+        shard = self.assigned.get(name)
+        if shard is None:
+            if len(self.assigned) >= 100000:
+                self.assigned.clear()
+            shard = self.assigned[name] = self.shards[zlib.crc32(name.encode()) % self.workers]
+        return shard
+
+    def submit(self, name, data):
+        """ 在接收线程中调用，将一条日志放入 name 对应的队列
+        :return: 是否放入队列，overflow 为 drop 时可能返回 False
+        """
+        shard = self.get_shard(name)
+        with shard.cond:
+            spill = len(shard.items) >= self.queue_size
+            if spill and shard.spill_bytes + len(data) > self.shard_spill_bytes:
+                if self.overflow == 'drop':
+                    self.dropped += 1
+                    return False
+                self.blocked += 1
+                ts = time.perf_counter()
+                while not self.stopped and len(shard.items) >= self.queue_size \
+                    and shard.spill_bytes + len(data) > self.shard_spill_bytes:
+                    shard.cond.wait(1)
+                self.blocked_seconds += time.perf_counter() - ts
+                spill = len(shard.items) >= self.queue_size
+            if spill:
+                self.spilled += 1
+                shard.spill_bytes += len(data)
+            shard.items.append((name, data, spill))
+            if len(shard.items) > shard.high_water:
+                shard.high_water = len(shard.items)
+            shard.cond.notify_all()
+        return True
+
+    def _run(self, shard):
+        while True:
+            with shard.cond:
+                while not shard.items and not self.stopped:
+                    shard.cond.wait()
+                if not shard.items:
+                    return
+                batch = []
+                while shard.items and len(batch) < self.batch_size:
+                    item = shard.items.popleft()
+                    if item[2]:
+                        shard.spill_bytes -= len(item[1])
+                    batch.append(item)
+                shard.busy = len(batch)
+                shard.cond.notify_all()
+            for name, data, _ in batch:
+                try:
+                    self.handle(name, data)
+                except Exception as e:
+                    with self.lock:
+                        self.errors += 1
+                    if self.logger is not None:
+                        self.logger.error('WriterPool write %s error: %r', name, e)
+            with shard.cond:
+                shard.busy = 0
+                shard.cond.notify_all()
+
+    def wait(self, timeout=None):
+        """ 等待已经放入队列的日志全部写入，例如在 XACK 之前调用
+        :return: 是否在 timeout 之前全部写入
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for shard in self.shards:
+            with shard.cond:
+                while shard.items or shard.busy:
+                    remain = None if deadline is None else deadline - time.monotonic()
+                    if remain is not None and remain <= 0:
+                        return False
+                    shard.cond.wait(remain)
+        return True
+
+    def get_queue_depth(self):
+        return sum(len(shard.items) for shard in self.shards)
+
+    def get_stats(self):
+        return {
+            'write_queue_depth': self.get_queue_depth(),
+            'write_queue_high_water': max(shard.high_water for shard in self.shards),
+            'write_spilled': self.spilled,
+            'write_spill_bytes': sum(shard.spill_bytes for shard in self.shards),
+            'write_dropped': self.dropped,
+            'write_blocked': self.blocked,
+            'write_blocked_seconds': self.blocked_seconds,
+            'write_errors': self.errors,
+        }
+
+    def close(self):
+        """ 写入队列中剩余的日志后停止所有写入线程
+        """
+        self.stopped = True
+        for shard in self.shards:
+            with shard.cond:
+                shard.cond.notify_all()
+        for shard in self.shards:
+            if shard.thread is not None:
+                shard.thread.join()
+                shard.thread = None
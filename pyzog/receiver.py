@@ -4,12 +4,25 @@
 @author zrong
 """
 import zmq
+import zmq.asyncio
 import redis
+import redis.asyncio
 from pathlib import Path
 import time
 import socket
+import re
+import asyncio
+import signal
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatchcase
 
 from pyzog.logging import get_logger
+from pyzog.writer import WriterManager
+from pyzog.formatter import MSGPACK_RENDERS, is_msgpack, unpack_record, render_record
+from pyzog.stats import Stats, StatsExporter, render_prometheus
+from pyzog.route import Router
+from pyzog.pool import WriterPool
+from pyzog.seq import SequenceTracker, is_sequenced
 
 
 class Receiver(object):
@@ -18,34 +31,259 @@ class Receiver(object):
     # 日志存储文件夹
     logpath = None
 
-    # 所有的日志搜集器
-    loggers = None
+    # 所有日志文件的写入器
+    writers = None
 
     # pyzog 自身专用的 logger
     logger = None
 
-    def __init__(self, logpath):
+    # asyncio 模式下写入文件使用的线程池，只有一个线程以保证写入顺序
+    executor = None
+
+    # asyncio 模式下已经交给线程池、还没有写入完成的批次数量
+    pending_batches = 0
+
+    # asyncio 模式下一次最多从 socket 中取出的消息数量
+    batch_size = 1000
+
+    # 收到 msgpack 数据时的处理方式 json/text/raw
+    msgpack_render = 'json'
+
+    # 统计信息
+    stats = None
+
+    # 通过 HTTP 或者文件输出统计信息
+    exporter = None
+
+    # 路由规则，为 None 时每个 channel 写入同名的文件
+    router = None
+
+    # 写入线程池，为 None 时在接收线程中直接写入
+    pool = None
+
+    # 检查发送端的序号，统计丢失、重复和乱序，见 pyzog.seq
+    sequences = None
+
+    def __init__(self, logpath, msgpack_render='json', stats_addr=None, stats_file=None, stats_interval=10, routes=None,
+        write_workers=0, write_queue_size=10000, spill_bytes=64 * 1024 * 1024, write_overflow='block', **kwargs):
+        """
+        :param logpath: 日志存储文件夹
+        :param msgpack_render: 收到 fmt 为 msgpack 的数据时的处理方式，
+            json/text 转换为对应格式的文本后写入 name.log，raw 原样写入 name.msgpack
+        :param stats_addr: 提供 Prometheus 文本格式统计信息的 HTTP 地址，形如 127.0.0.1:9108
+        :param stats_file: 定期写入 JSON 格式统计信息的文件
+        :param stats_interval: 写入 stats_file 的间隔（秒）
+        :param routes: pyzog.route.Rule 列表，按照规则将日志写入其它文件或者丢弃
+        :param write_workers: 写入线程数量，为 0 代表在接收线程中直接写入，见 pyzog.pool
+        :param write_queue_size: 每个写入线程的队列的正常容量（条）
+        :param spill_bytes: 队列超出正常容量后最多在内存中保存的字节数
+        :param write_overflow: 超出 spill_bytes 时的处理方式 block/drop
+        :param kwargs: 传递给 WriterManager，例如 buffer_size/flush_interval/fsync/rotate_check_interval
+        """
         if isinstance(logpath, str):
             self.logpath = Path(logpath)
         else:
             self.logpath = logpath
+        if msgpack_render not in MSGPACK_RENDERS:
+            raise ValueError('msgpack_render must be one of %s!' % '/'.join(MSGPACK_RENDERS))
+        self.msgpack_render = msgpack_render
+        if routes:
+            self.router = Router(routes)
         self.logpath.mkdir(parents=True, exist_ok=True)
-        self.loggers = {}
+        self.writers = WriterManager(self.logpath, **kwargs)
         self.logger = get_logger('pyzog', type_='stream', fmt='text')
+        if int(write_workers) > 0:
+            self.pool = WriterPool(self.write_now, write_workers, write_queue_size, spill_bytes, write_overflow, logger=self.logger)
+        self.sequences = SequenceTracker()
+        self.stats = Stats()
+        self.stats.gauges['writer_buffer_bytes'] = self.writers.get_buffered_bytes
+        self.stats.gauges['writer_queue_depth'] = self.get_queue_depth
+        self.exporter = StatsExporter(self.render_metrics, self.render_stats,
+            addr=stats_addr, stats_file=stats_file, interval=stats_interval)
 
     def start(self):
         raise ValueError('Implement start!')
 
-    def get_logger(self, name):
-        log = self.loggers.get(name)
-        if log is None:
-            log = get_logger(name, target=self.logpath, type_='file', fmt='raw')
-            self.loggers[name] = log
-        return log
+    def start_background(self):
+        """ 启动 writer 的后台线程和写入线程池，以及统计信息的输出
+        """
+        self.writers.start()
+        if self.pool is not None:
+            self.pool.start()
+        if self.exporter.enabled:
+            self.exporter.start()
+
+    def write(self, name, data):
+        """ 将 data 追加到 name 对应的日志文件，提供了路由规则时写入规则指定的文件。
+        使用写入线程池时只放入队列。带有序号的日志在这里检查序号并去掉信封
+        :param name: channel 名称，默认作为文件名，不要带扩展名
+        :param data: bytes
+        """
+        if is_sequenced(data):
+            data = self.sequences.feed(name, data)
+        if self.pool is not None:
+            self.pool.submit(name, data)
+        else:
+            self.write_now(name, data)
+
+    def write_now(self, name, data):
+        """ 解码、路由并写入，使用写入线程池时在写入线程中调用
+        """
+        ts = time.perf_counter()
+        size = len(data)
+        if is_msgpack(data):
+            obj = None
+            line = None
+            try:
+                if self.msgpack_render != 'raw' or (self.router is not None and self.router.needs_record):
+                    obj = unpack_record(data)
+                if self.msgpack_render != 'raw':
+                    lag = time.time() - obj['created']
+                    line = render_record(obj, self.msgpack_render)
+            except (ImportError, ValueError, TypeError, KeyError) as e:
+                # 一条无法解码的数据不应该让接收器退出
+                self.stats.on_decode_error()
+                self.logger.error('Receiver.write_now channel: %s, decode msgpack error: %r', name, e)
+                return
+            dests = self.route(name, data, obj)
+            if line is None:
+                # msgpack 数据自带长度，连续写入即可使用 msgpack.Unpacker 读取
+                for dest in dests:
+                    self.writers.write(dest, data[1:], ext='.msgpack', separator=b'')
+            else:
+                self.stats.on_lag(max(lag, 0))
+                for dest in dests:
+                    self.writers.write(dest, line)
+        else:
+            for dest in self.route(name, data):
+                self.writers.write(dest, data)
+        self.stats.on_message(name, size, time.perf_counter() - ts)
+
+    def route(self, name, data, obj=None):
+        """ 返回需要写入的文件名列表
+        """
+        if self.router is None:
+            return (name,)
+        return self.router.route(name, data, obj)
+
+    def on_redis_connect(self, connection):
+        """ 作为 redis 的 redis_connect_func，统计连接次数
+        """
+        self.stats.connects += 1
+        connection.on_connect()
+
+    async def on_redis_connect_async(self, connection):
+        self.stats.connects += 1
+        await connection.on_connect()
+
+    def get_queue_depth(self):
+        """ asyncio 模式下等待写入的批次数量，以及写入线程池中等待写入的日志数量
+        """
+        depth = 0
+        depth += self.pending_batches
+        if self.pool is not None:
+            depth += self.pool.get_queue_depth()
+        return depth
+
+    def render_metrics(self):
+        return render_prometheus(self.stats, self.get_stats())
+
+    def render_stats(self):
+        result = self.stats.to_dict()
+        result['summary'] = self.get_stats()
+        return result
+
+    def install_signals(self):
+        """ SIGHUP 让 writer 检查 logrotate；SIGTERM/SIGQUIT 让 start 退出，以便 close 写入缓冲区。
+        只能在主线程中调用
+        """
+        def on_exit(signum, frame):
+            raise SystemExit(signum)
+        self.writers.install_sighup()
+        signal.signal(signal.SIGTERM, on_exit)
+        signal.signal(signal.SIGQUIT, on_exit)
+
+    def close_writers(self):
+        """ 写入线程池中剩余的日志后，将缓冲区写入磁盘并关闭所有文件
+        """
+        if self.pool is not None:
+            self.pool.close()
+        self.writers.close()
+
+    def close(self):
+        """ 将缓冲区写入磁盘并关闭所有文件
+        """
+        if self.executor is not None:
+            self.executor.shutdown()
+        self.close_writers()
+        self.exporter.stop()
+
+    def get_stats(self):
+        """ 返回接收器的统计信息，只包括数值
+        """
+        stats = self.writers.get_stats()
+        stats.update(self.stats.summary())
+        if self.pool is not None:
+            stats.update(self.pool.get_stats())
+        if self.router is not None:
+            stats.update(self.router.get_stats())
+        stats.update(self.sequences.get_stats())
+        return stats
+
+    def on_receive(self, msg):
+        raise ValueError('Implement on_receive!')
+
+    def receive_batch(self, batch):
+        for msg in batch:
+            self.on_receive(msg)
+
+    async def dispatch(self, batch):
+        """ asyncio 模式下将一批消息交给线程池写入，写入完成之前不会继续读取
+        """
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='pyzog.writer')
+        self.pending_batches += 1
+        try:
+            await asyncio.get_running_loop().run_in_executor(self.executor, self.receive_batch, batch)
+        finally:
+            self.pending_batches -= 1
+
+
+class ChannelMatcher(object):
+    """ 按照 channels 过滤 zmq 的 topic，ZeroMQReceiver 和 ZeroMQSource 共用
+
+    SUB 已经按照前缀订阅，只有 prefix* 形式的 channel 不需要再次匹配；
+    PULL 没有订阅，收到的所有消息都需要匹配。
+    """
+    def __init__(self, channels, subscribed=True):
+        """
+        :param channels: channel 列表，为空代表接收所有
+        :param subscribed: socket 是否已经按照 channels 的前缀订阅
+        """
+        self.prefixes = [ZeroMQReceiver.get_prefix(ch) for ch in channels if ZeroMQReceiver.is_prefix_pattern(ch)]
+        self.names = set(ch for ch in channels if ZeroMQReceiver.is_exact_name(ch))
+        self.patterns = [ch for ch in channels
+            if not ZeroMQReceiver.is_prefix_pattern(ch) and not ZeroMQReceiver.is_exact_name(ch)]
+        # 不需要在 python 中匹配
+        self.match_all = not channels or (subscribed and not self.names and not self.patterns)
+
+    def match(self, topic):
+        if self.match_all or topic in self.names:
+            return True
+        for prefix in self.prefixes:
+            if topic.startswith(prefix):
+                return True
+        for ch in self.patterns:
+            if fnmatchcase(topic, ch):
+                return True
+        return False
 
 
 class ZeroMQReceiver(Receiver):
     """ 接收 ZeroMQ 发来的数据并写入 logpath 文件夹
+
+    发送方以 [topic, payload] 两帧发送，topic 为 logger 名称。
+    SUB socket 只订阅 channels 对应的前缀，过滤在 libzmq 中完成。
     """
     # zmq 上下文
     ctx = None
@@ -59,36 +297,126 @@ class ZeroMQReceiver(Receiver):
     # ZeroMQ 的模式，默认为订阅模式
     socket_type = zmq.SUB
 
-    def __init__(self, logpath, host, port, socket_type=zmq.SUB):
-        super().__init__(logpath)
-        self.addr = host + ':' + str(port)
+    # 订阅的 channel，支持 fnmatch 风格的通配符，为空代表订阅所有
+    channels = None
+
+    # 接收消息的方式 block/asyncio
+    get_message_type = 'block'
+
+    # 监听 addr，为 False 时连接到 addr，例如连接到 pyzog broker 的 backend
+    bind = True
+
+    # 按照 channels 再次过滤 topic，见 ChannelMatcher
+    matcher = None
+
+    def __init__(self, logpath, host, port, socket_type=zmq.SUB, channels=None, get_message_type='block', bind=True, **kwargs):
+        """
+        :param socket_type: zmq.SUB 或者 zmq.PULL，连接到 pipeline 模式的 broker 时使用 zmq.PULL
+        :param bind: 监听 addr，为 False 时连接到 addr
+        """
+        super().__init__(logpath, **kwargs)
+        self.bind = bind
+        # port 为 None 时 host 即为完整的地址，例如 ipc:///tmp/pyzog.sock
+        self.addr = host if port is None else host + ':' + str(port)
         self.socket_type = socket_type
+        self.get_message_type = get_message_type
+        self.channels = channels or []
+        self.matcher = ChannelMatcher(self.channels, subscribed=socket_type == zmq.SUB)
+
+    @staticmethod
+    def get_prefix(channel):
+        """ 获取 channel 中第一个通配符之前的部分，作为 zmq 的订阅前缀
+        """
+        matchobj = re.search(r'[\*\?\[]', channel)
+        return channel if matchobj is None else channel[:matchobj.start()]
+
+    @classmethod
+    def is_prefix_pattern(cls, channel):
+        """ channel 是否能完全用前缀订阅表达，例如 pyzog.*
+        pyzog.app 这样的完整名称也按前缀订阅，但会收到 pyzog.application，需要再比较整个名称
+        """
+        return channel == cls.get_prefix(channel) + '*'
+
+    @classmethod
+    def is_exact_name(cls, channel):
+        """ channel 是否为不包含通配符的完整名称
+        """
+        return channel == cls.get_prefix(channel)
+
+    def subscribe(self):
+        if self.socket_type != zmq.SUB:
+            return
+        if not self.channels:
+            self.socket.setsockopt(zmq.SUBSCRIBE, b'')
+            return
+        for ch in self.channels:
+            self.socket.setsockopt(zmq.SUBSCRIBE, self.get_prefix(ch).encode())
+
+    def open_socket(self):
+        if self.bind:
+            self.socket.bind(self.addr)
+        else:
+            self.socket.connect(self.addr)
+
+    def match(self, topic):
+        return self.matcher.match(topic)
 
     def start(self):
         """ 开始接收
         """
         try:
-            self.ctx = zmq.Context()
-            self.socket = self.ctx.socket(self.socket_type)
-
-            self.socket.bind(self.addr)
-            self.logger.warn("ZeroMQ listen addr: %s" % self.addr)
-            while True:
-                msg = self.socket.recv_string()
-                if msg:
-                    self.on_receive(msg)
+            self.start_background()
+            if self.get_message_type == 'asyncio':
+                asyncio.run(self.sub_asyncio())
+            else:
+                self.sub_block()
         except Exception as e:
+            self.close_writers()
             self.logger.error('Exit:' + repr(e))
             return e
 
-    def on_receive(self, msg):
-        logname = 'mjptest'
-        log = self.get_logger(logname)
-        log.info(msg)
+    def sub_block(self):
+        self.ctx = zmq.Context()
+        self.socket = self.ctx.socket(self.socket_type)
+        self.subscribe()
+
+        self.open_socket()
+        self.logger.warn("ZeroMQ %s addr: %s, channels is %s" % ('listen' if self.bind else 'connect', self.addr, self.channels))
+        while True:
+            frames = self.socket.recv_multipart(copy=False)
+            if frames:
+                self.on_receive(frames)
+
+    async def sub_asyncio(self):
+        """ 使用 zmq.asyncio 接收，每次取出 socket 中所有已经到达的消息后批量写入
+        """
+        self.ctx = zmq.asyncio.Context()
+        self.socket = self.ctx.socket(self.socket_type)
+        self.subscribe()
+
+        self.open_socket()
+        self.logger.warn("ZeroMQ %s addr: %s, channels is %s, use asyncio" % ('listen' if self.bind else 'connect', self.addr, self.channels))
+        while True:
+            batch = [await self.socket.recv_multipart(copy=False)]
+            while len(batch) < self.batch_size and self.socket.getsockopt(zmq.EVENTS) & zmq.POLLIN:
+                batch.append(await self.socket.recv_multipart(copy=False))
+            await self.dispatch(batch)
+
+    def on_receive(self, frames):
+        if len(frames) != 2:
+            self.logger.error('ZeroMQReceiver.on_receive frames count: %s', len(frames))
+            return
+        logname = frames[0].bytes.decode()
+        if not self.match(logname):
+            return
+        self.write(logname, frames[1].bytes)
 
 
 class RedisReceiver(Receiver):
     """ 接收 Redis PUBLISH 发来的数据并写入 logpath 文件夹
+
+    get_message_type 为 poll 时阻塞在 socket 上等待消息，被唤醒后在内层循环中取出所有已经到达的消息，
+    然后再次阻塞，不需要调整 sleep_time。空闲和忙碌的时间以及 CPU 时间记录在统计信息中。
     """
     # redis 实例
     r = None
@@ -108,13 +436,30 @@ class RedisReceiver(Receiver):
     ping_interval = 60
     thread = None
     sleep_time = 0.0005
-    get_message_type = 'thread'
+    get_message_type = 'poll'
+
+    # get_message_type 为 poll 时每次阻塞等待的最长时间（秒），超时后检查连接
+    poll_timeout = 1.0
+
+    # get_message_type 为 poll 时的计数
+    # 唤醒次数，空闲（阻塞等待）和忙碌（处理消息）的时间，以及两者消耗的 CPU 时间（秒）
+    poll_wakeups = 0
+    poll_idle_seconds = 0.0
+    poll_busy_seconds = 0.0
+    poll_idle_cpu_seconds = 0.0
+    poll_busy_cpu_seconds = 0.0
 
     # tcp_keep = {socket.TCP_KEEPIDLE: 120, socket.TCP_KEEPCNT: 2, socket.TCP_KEEPINTVL: 30}
     tcp_keep = None
 
-    def __init__(self, logpath, host='localhost', port=6379, password=None, db=0, channels=['pyzog.*'], get_message_type='thread', sleep_time=0.0005):
-        super().__init__(logpath)
+    def __init__(self, logpath, host='localhost', port=6379, password=None, db=0, channels=['pyzog.*'], get_message_type='poll',
+        sleep_time=0.0005, poll_timeout=1.0, **kwargs):
+        """
+        :param get_message_type: poll/thread/block/listen/asyncio
+        :param sleep_time: get_message_type 为 thread/block 时每次 get_message 之后 sleep 的时间（秒）
+        :param poll_timeout: get_message_type 为 poll 时每次阻塞等待的最长时间（秒）
+        """
+        super().__init__(logpath, **kwargs)
         self.host = host
         self.port = port
         self.password = password
@@ -122,17 +467,28 @@ class RedisReceiver(Receiver):
         self.channels = channels
         self.get_message_type = get_message_type
         self.sleep_time = sleep_time
+        self.poll_timeout = float(poll_timeout)
+        if get_message_type == 'poll':
+            for k in ('poll_wakeups', 'poll_idle_seconds', 'poll_busy_seconds', 'poll_idle_cpu_seconds', 'poll_busy_cpu_seconds'):
+                self.stats.gauges[k] = lambda k=k: getattr(self, k)
 
     def start(self):
         """ 开始接收
         """
         try:
+            self.start_background()
+            self.logger.warn('RedisReceiver use %s to get_message, channels is %s, sleep_time is %s, poll_timeout is %s',
+                self.get_message_type, self.channels, self.sleep_time, self.poll_timeout)
+            if self.get_message_type == 'asyncio':
+                asyncio.run(self.sub_asyncio())
+                return
             self.init_redis()
             fun = getattr(self, 'sub_' + self.get_message_type)
-            self.logger.warn('RedisReceiver use %s to get_message, channels is %s, sleep_time is %s', self.get_message_type, self.channels, self.sleep_time)
             fun()
         except Exception as e:
-            self.pub.close()
+            self.close_writers()
+            if isinstance(self.pub, redis.client.PubSub):
+                self.pub.close()
             self.logger.error('RedisReceiver.Exit:' + repr(e))
             return e
 
@@ -140,10 +496,39 @@ class RedisReceiver(Receiver):
         self.r = redis.Redis(host=self.host, port=self.port, password=self.password, db=self.db,
             health_check_interval=self.ping_interval,
             socket_keepalive=True,
-            socket_keepalive_options=self.tcp_keep)
+            socket_keepalive_options=self.tcp_keep,
+            redis_connect_func=self.on_redis_connect)
         self.pub = self.r.pubsub(ignore_subscribe_messages=True)
         self.logger.warn("RedisReceiver.init_redis %s:%s:%s/%s" % (self.password or '', self.host, self.port, self.db))
 
+    async def sub_asyncio(self):
+        """ 使用 redis.asyncio 接收，阻塞等待消息而不是固定 sleep，
+        每次取出所有已经到达的消息后批量写入
+        """
+        self.r = redis.asyncio.Redis(host=self.host, port=self.port, password=self.password, db=self.db,
+            health_check_interval=self.ping_interval,
+            socket_keepalive=True,
+            socket_keepalive_options=self.tcp_keep,
+            redis_connect_func=self.on_redis_connect_async)
+        self.pub = self.r.pubsub(ignore_subscribe_messages=True)
+        self.logger.warn("RedisReceiver.sub_asyncio %s:%s:%s/%s" % (self.password or '', self.host, self.port, self.db))
+        try:
+            await self.pub.psubscribe(*self.channels)
+            while True:
+                msg = await self.pub.get_message(ignore_subscribe_messages=True, timeout=self.ping_interval)
+                if msg is None:
+                    continue
+                batch = [msg]
+                while len(batch) < self.batch_size:
+                    msg = await self.pub.get_message(ignore_subscribe_messages=True, timeout=0)
+                    if msg is None:
+                        break
+                    batch.append(msg)
+                await self.dispatch(batch)
+        finally:
+            await self.pub.aclose()
+            await self.r.aclose()
+
     def sub_block(self):
         self.pub.psubscribe(*self.channels)
         while True:
@@ -151,6 +536,31 @@ class RedisReceiver(Receiver):
             self.check_message(msg)
             time.sleep(self.sleep_time)
 
+    def sub_poll(self):
+        """ 阻塞在 socket 上等待消息，唤醒后取出所有已经到达的消息再继续等待
+        """
+        self.pub.psubscribe(*self.channels)
+        perf_counter = time.perf_counter
+        thread_time = time.thread_time
+        wall_ts, cpu_ts = perf_counter(), thread_time()
+        while True:
+            msg = self.pub.get_message(timeout=self.poll_timeout)
+            wake_ts, wake_cpu = perf_counter(), thread_time()
+            self.poll_idle_seconds += wake_ts - wall_ts
+            self.poll_idle_cpu_seconds += wake_cpu - cpu_ts
+            count = 0
+            while msg is not None and count < self.batch_size:
+                self.check_message(msg)
+                count += 1
+                msg = self.pub.get_message(timeout=0)
+            # 没有消息时也需要定期检查连接
+            self.check_message(msg)
+            if count > 0:
+                self.poll_wakeups += 1
+            wall_ts, cpu_ts = perf_counter(), thread_time()
+            self.poll_busy_seconds += wall_ts - wake_ts
+            self.poll_busy_cpu_seconds += cpu_ts - wake_cpu
+
     def sub_listen(self):
         self.pub.psubscribe(*self.channels)
         for message in self.pub.listen():
@@ -182,8 +592,472 @@ class RedisReceiver(Receiver):
         channel = msg.get('channel')
         data = msg.get('data')
         if isinstance(channel, bytes) and isinstance(data, bytes):
-            logname = channel.decode()
-            log = self.get_logger(logname)
-            log.info(data.decode())
+            self.write(channel.decode(), data)
         else:
             self.logger.error('RedisReceiver.on_receive channel: %s, data: %s, type: %s', channel, data, msg.get('type'))
+
+
+class RedisStreamReceiver(Receiver):
+    """ 使用 consumer group 读取 Redis Streams 中的数据并写入 logpath 文件夹
+
+    每批数据写入文件之后才会 XACK，进程退出时未确认的数据保存在 pending 列表中，
+    重启后首先处理自己的 pending 数据，然后定期使用 XAUTOCLAIM 接管其他已退出接收器的 pending 数据。
+    多个接收器使用同一个 group 和不同的 consumer 即可分担负载。
+    """
+    # redis 实例
+    r = None
+
+    # redis 配置
+    host = None
+    port = None
+    password = None
+    db = 0
+
+    # 读取的 stream key，不支持通配符
+    channels = None
+
+    # consumer group 名称和 consumer 名称
+    group = 'pyzog'
+    consumer = None
+
+    # XREADGROUP 的 COUNT 和 BLOCK（毫秒）参数
+    count = 100
+    block = 1000
+
+    # pending 数据空闲超过这个时间（毫秒）后会被接管
+    claim_idle = 60000
+
+    # 检查 pending 数据的间隔（秒）
+    claim_interval = 30
+    claim_ts = 0
+
+    # 保存 log 内容的字段名
+    field = b'data'
+
+    # 统计计数
+    acked_count = 0
+    claimed_count = 0
+
+    tcp_keep = None
+    ping_interval = 60
+
+    def __init__(self, logpath, host='localhost', port=6379, password=None, db=0, channels=['pyzog'],
+        group='pyzog', consumer=None, count=100, block=1000, claim_idle=60000, **kwargs):
+        """
+        :param channels: stream key 列表
+        :param group: consumer group 名称
+        :param consumer: consumer 名称，默认为主机名，重启后使用同样的名称才能继续处理自己的 pending 数据
+        :param count: 每次 XREADGROUP 最多读取的条数
+        :param block: XREADGROUP 阻塞等待的时间（毫秒）
+        :param claim_idle: pending 数据空闲超过这个时间（毫秒）后会被接管
+        """
+        super().__init__(logpath, **kwargs)
+        self.host = host
+        self.port = port
+        self.password = password
+        self.db = db
+        self.channels = channels
+        self.group = group
+        self.consumer = consumer or socket.gethostname()
+        self.count = int(count)
+        self.block = int(block)
+        self.claim_idle = int(claim_idle)
+
+    def start(self):
+        """ 开始接收
+        """
+        try:
+            self.start_background()
+            self.init_redis()
+            self.logger.warn('RedisStreamReceiver streams is %s, group is %s, consumer is %s', self.channels, self.group, self.consumer)
+            self.read_pending()
+            while True:
+                self.read_group()
+                ts = time.time()
+                if ts - self.claim_ts > self.claim_interval:
+                    self.claim_ts = ts
+                    self.claim_pending()
+        except Exception as e:
+            self.close_writers()
+            self.logger.error('RedisStreamReceiver.Exit:' + repr(e))
+            return e
+
+    def init_redis(self):
+        self.r = redis.Redis(host=self.host, port=self.port, password=self.password, db=self.db,
+            health_check_interval=self.ping_interval,
+            socket_keepalive=True,
+            socket_keepalive_options=self.tcp_keep,
+            redis_connect_func=self.on_redis_connect)
+        for stream in self.channels:
+            try:
+                self.r.xgroup_create(stream, self.group, id='0', mkstream=True)
+            except redis.ResponseError as e:
+                # group 已经存在
+                if 'BUSYGROUP' not in str(e):
+                    raise
+        self.logger.warn("RedisStreamReceiver.init_redis %s:%s:%s/%s" % (self.password or '', self.host, self.port, self.db))
+
+    def read_pending(self):
+        """ 处理本 consumer 之前已经读取但没有确认的数据
+        """
+        while True:
+            resp = self.r.xreadgroup(self.group, self.consumer, {s: '0' for s in self.channels}, count=self.count)
+            if not any(entries for _, entries in resp):
+                return
+            self.on_receive(resp)
+
+    def read_group(self):
+        resp = self.r.xreadgroup(self.group, self.consumer, {s: '>' for s in self.channels}, count=self.count, block=self.block)
+        if resp:
+            self.on_receive(resp)
+
+    def claim_pending(self):
+        """ 接管其他 consumer 空闲超时的 pending 数据
+        """
+        for stream in self.channels:
+            start_id = '0-0'
+            while True:
+                resp = self.r.xautoclaim(stream, self.group, self.consumer, self.claim_idle, start_id=start_id, count=self.count)
+                start_id, entries = resp[0], resp[1]
+                if entries:
+                    self.claimed_count += len(entries)
+                    self.on_receive([(stream.encode(), entries)])
+                if start_id in (b'0-0', '0-0'):
+                    break
+
+    def on_receive(self, resp):
+        """ 写入一批数据，写入磁盘之后再 XACK
+        :param resp: [(stream, [(id, fields), ...]), ...]
+        """
+        acks = []
+        for stream, entries in resp:
+            name = stream.decode() if isinstance(stream, bytes) else stream
+            ids = []
+            for entry_id, fields in entries:
+                ids.append(entry_id)
+                # 被裁剪掉的 pending 数据 fields 为 None
+                data = fields.get(self.field) if fields else None
+                if isinstance(data, bytes):
+                    self.write(name, data)
+                else:
+                    self.logger.error('RedisStreamReceiver.on_receive stream: %s, id: %s, fields: %s', name, entry_id, fields)
+            if ids:
+                acks.append((name, ids))
+        if not acks:
+            return
+        # 使用写入线程池时等待这一批日志写入文件
+        if self.pool is not None:
+            self.pool.wait()
+        # 路由规则可能将日志写入其它文件，此时写入所有文件
+        self.writers.flush(None if self.router is not None else [name for name, _ in acks])
+        pipe = self.r.pipeline(transaction=False)
+        for name, ids in acks:
+            pipe.xack(name, self.group, *ids)
+            self.acked_count += len(ids)
+        pipe.execute()
+
+    def get_stats(self):
+        stats = super().get_stats()
+        stats['acked'] = self.acked_count
+        stats['claimed'] = self.claimed_count
+        return stats
+
+
+class ZeroMQSource(object):
+    """ MultiReceiver 中的一个 ZeroMQ 数据源，配置与 ZeroMQReceiver 相同
+    """
+    # [source:name] 中的 name
+    name = None
+
+    # 监听或者连接的地址
+    addr = None
+
+    # zmq.SUB 或者 zmq.PULL
+    socket_type = zmq.SUB
+
+    # 订阅的 channel，支持 fnmatch 风格的通配符，为空代表订阅所有
+    channels = None
+
+    # 监听 addr，为 False 时连接到 addr
+    bind = True
+
+    socket = None
+
+    # 收到的消息数量和出错的次数
+    received = 0
+    errors = 0
+
+    def __init__(self, name, host, port, socket_type=zmq.SUB, channels=None, bind=True):
+        self.name = name
+        self.addr = host if port is None else host + ':' + str(port)
+        self.socket_type = socket_type
+        self.channels = channels or []
+        self.bind = bind
+        self.matcher = ChannelMatcher(self.channels, subscribed=socket_type == zmq.SUB)
+
+    def open(self, receiver, ctx):
+        self.socket = ctx.socket(self.socket_type)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        if self.socket_type == zmq.SUB:
+            for prefix in [ZeroMQReceiver.get_prefix(ch) for ch in self.channels] or ['']:
+                self.socket.setsockopt(zmq.SUBSCRIBE, prefix.encode())
+        if self.bind:
+            self.socket.bind(self.addr)
+        else:
+            self.socket.connect(self.addr)
+        receiver.logger.warn('MultiReceiver source %s: ZeroMQ %s addr: %s, channels is %s',
+            self.name, 'listen' if self.bind else 'connect', self.addr, self.channels)
+
+    def get_poll_target(self):
+        """ 注册到 zmq.Poller 的对象
+        """
+        return self.socket
+
+    def match(self, topic):
+        return self.matcher.match(topic)
+
+    def drain(self, receiver, limit):
+        """ 取出最多 limit 条已经到达的消息并写入，返回取出的数量
+        """
+        count = 0
+        while count < limit:
+            try:
+                frames = self.socket.recv_multipart(zmq.NOBLOCK, copy=False)
+            except zmq.Again:
+                break
+            count += 1
+            self.received += 1
+            if len(frames) != 2:
+                receiver.logger.error('ZeroMQSource %s frames count: %s', self.name, len(frames))
+                continue
+            topic = frames[0].bytes.decode()
+            if self.match(topic):
+                receiver.write(topic, frames[1].bytes)
+        return count
+
+    def check(self, now):
+        pass
+
+    def close(self):
+        if self.socket is not None:
+            self.socket.close(0)
+            self.socket = None
+
+
+class RedisSource(object):
+    """ MultiReceiver 中的一个 Redis PUBLISH 数据源，配置与 RedisReceiver 相同
+    """
+    # [source:name] 中的 name
+    name = None
+
+    # redis 配置
+    host = None
+    port = None
+    password = None
+    db = 0
+    channels = None
+
+    r = None
+    pub = None
+
+    # 保活，每隔一定时间 ping 一次
+    ping_ts = 0
+    ping_interval = 60
+    tcp_keep = None
+
+    # 收到的消息数量和出错的次数
+    received = 0
+    errors = 0
+
+    def __init__(self, name, host='localhost', port=6379, password=None, db=0, channels=['pyzog.*']):
+        self.name = name
+        self.host = host
+        self.port = port
+        self.password = password
+        self.db = db
+        self.channels = channels
+
+    def open(self, receiver, ctx):
+        self.r = redis.Redis(host=self.host, port=self.port, password=self.password, db=self.db,
+            health_check_interval=self.ping_interval,
+            socket_keepalive=True,
+            socket_keepalive_options=self.tcp_keep,
+            redis_connect_func=receiver.on_redis_connect)
+        self.pub = self.r.pubsub(ignore_subscribe_messages=True)
+        self.pub.psubscribe(*self.channels)
+        receiver.logger.warn('MultiReceiver source %s: redis %s:%s/%s, channels is %s',
+            self.name, self.host, self.port, self.db, self.channels)
+
+    def get_poll_target(self):
+        """ 当前连接的 fd，连接断开时为 None。重连之后 fd 会改变，由 MultiReceiver 重新注册
+        """
+        conn = self.pub.connection if self.pub is not None else None
+        sock = getattr(conn, '_sock', None)
+        return None if sock is None else sock.fileno()
+
+    def drain(self, receiver, limit):
+        """ 取出最多 limit 条已经到达的消息并写入，返回取出的数量
+        """
+        count = 0
+        for _ in range(limit):
+            msg = self.pub.get_message(timeout=0)
+            if msg is None:
+                # 被忽略的订阅确认也返回 None，解析器的缓冲区中可能还有消息
+                if self.get_poll_target() is not None and self.pub.connection.can_read(0):
+                    continue
+                break
+            count += 1
+            self.received += 1
+            channel = msg.get('channel')
+            data = msg.get('data')
+            if isinstance(channel, bytes) and isinstance(data, bytes):
+                receiver.write(channel.decode(), data)
+            else:
+                receiver.logger.error('RedisSource %s channel: %s, data: %s, type: %s', self.name, channel, data, msg.get('type'))
+        return count
+
+    def check(self, now):
+        if now - self.ping_ts > self.ping_interval:
+            self.ping_ts = now
+            self.pub.check_health()
+
+    def close(self):
+        if self.pub is not None:
+            self.pub.close()
+            self.pub = None
+        if self.r is not None:
+            self.r.close()
+            self.r = None
+
+
+class MultiReceiver(Receiver):
+    """ 在一个进程中接收多个数据源的数据并写入 logpath 文件夹
+
+    所有数据源的 ZeroMQ socket 和 redis 连接的 fd 注册到同一个 zmq.Poller 中，
+    只有一个线程阻塞等待，唤醒后依次取出就绪的数据源中已经到达的消息。所有数据源共享一个 WriterManager，
+    不同数据源中同名的 channel 写入同一个文件。
+
+    一个数据源出错时只记录日志，每隔 retry_interval 秒重试，不影响其他数据源。
+    """
+    # ZeroMQSource 和 RedisSource 列表
+    sources = None
+
+    # 所有 ZeroMQ 数据源共享的上下文
+    ctx = None
+
+    poller = None
+
+    # 每次阻塞等待的最长时间（秒），超时后检查连接
+    poll_timeout = 1.0
+
+    # 数据源出错之后重试的间隔（秒）
+    retry_interval = 5.0
+
+    # 唤醒次数
+    poll_wakeups = 0
+
+    def __init__(self, logpath, sources, poll_timeout=1.0, **kwargs):
+        """
+        :param sources: ZeroMQSource 和 RedisSource 列表，name 不能重复
+        :param poll_timeout: 每次阻塞等待的最长时间（秒）
+        """
+        super().__init__(logpath, **kwargs)
+        names = [s.name for s in sources]
+        if not sources or len(set(names)) != len(names):
+            raise ValueError('sources must be non-empty with unique names!')
+        self.sources = sources
+        self.poll_timeout = float(poll_timeout)
+        # 出错的数据源，value 为出错的时间
+        self.failed = {}
+        self.stats.gauges['poll_wakeups'] = lambda: self.poll_wakeups
+        self.stats.gauges['sources_failed'] = lambda: len(self.failed)
+
+    def start(self):
+        """ 开始接收
+        """
+        try:
+            self.start_background()
+            self.open()
+            self.poll_sources()
+        except Exception as e:
+            self.close_writers()
+            self.logger.error('MultiReceiver.Exit:' + repr(e))
+            return e
+
+    def open(self):
+        self.ctx = zmq.Context()
+        self.poller = zmq.Poller()
+        for source in self.sources:
+            source.open(self, self.ctx)
+
+    def update_poller(self, targets):
+        """ redis 重连之后 fd 会改变，每次等待之前同步注册到 poller 的对象
+        :param targets: {注册的对象: source}
+        """
+        current = {}
+        for source in self.sources:
+            target = source.get_poll_target()
+            if target is not None and source not in self.failed:
+                current[target] = source
+        for target in targets.keys() - current.keys():
+            self.poller.unregister(target)
+        for target in current.keys() - targets.keys():
+            self.poller.register(target, zmq.POLLIN)
+        return current
+
+    def poll_sources(self):
+        targets = {}
+        # 第一次等待之前解析器中可能已经有数据，取出上限条数的数据源也需要立即再次处理
+        pending = set(self.sources)
+        next_check = 0
+        while True:
+            targets = self.update_poller(targets)
+            for target, _ in self.poller.poll(0 if pending else self.poll_timeout * 1000):
+                pending.add(targets[target])
+            if pending:
+                self.poll_wakeups += 1
+            ready = [s for s in self.sources if s in pending]
+            pending.clear()
+            for source in ready:
+                try:
+                    if source.drain(self, self.batch_size) >= self.batch_size:
+                        pending.add(source)
+                except (redis.RedisError, zmq.ZMQError, OSError) as e:
+                    self.on_source_error(source, e)
+            now = time.time()
+            if now < next_check:
+                continue
+            next_check = now + self.poll_timeout
+            for source in self.sources:
+                failed_ts = self.failed.get(source)
+                if failed_ts is not None:
+                    if now - failed_ts >= self.retry_interval:
+                        # 重新取出消息时会自动重连
+                        del self.failed[source]
+                        pending.add(source)
+                    continue
+                try:
+                    source.check(now)
+                except (redis.RedisError, zmq.ZMQError, OSError) as e:
+                    self.on_source_error(source, e)
+
+    def on_source_error(self, source, e):
+        source.errors += 1
+        self.failed[source] = time.time()
+        self.logger.error('MultiReceiver source %s error: %r, retry after %ss', source.name, e, self.retry_interval)
+
+    def close(self):
+        for source in self.sources:
+            source.close()
+        if self.ctx is not None:
+            self.ctx.term()
+            self.ctx = None
+        super().close()
+
+    def get_stats(self):
+        stats = super().get_stats()
+        for source in self.sources:
+            name = re.sub(r'\W', '_', source.name)
+            stats['source_%s_received' % name] = source.received
+            stats['source_%s_errors' % name] = source.errors
+        return stats
@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+"""
+接收端内置的日志切分
+@author zrong
+
+按照大小或者时间间隔切分日志文件，切分出的文件（segment）命名为 name.log.YYYYmmdd-HHMMSS，
+在进程池中压缩为 .gz（或者安装了 zstandard 时的 .zst），压缩完成后按照数量或者时间清理旧的 segment，
+还在等待压缩的 segment 不会被清理。压缩和清理都不在接收线程中进行，切分本身只是一次 rename 和 open。
+segment 的时间索引命名为 name.log.YYYYmmdd-HHMMSS.idx，压缩后保留，与 segment 一起清理。
+"""
+import gzip
+import multiprocessing
+import os
+import re
+import shutil
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from pyzog.index import index_path
+from pyzog.logging import get_logger
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# 压缩方式对应的扩展名
+COMPRESS_SUFFIXES = {
+    'gzip': '.gz',
+    'zstd': '.zst',
+}
+
+# segment 名称中的时间戳，可能带有 -N 后缀以避免重名
+SEGMENT_RE = re.compile(r'\.(\d{8}-\d{6}(?:-\d+)?)(\.gz|\.zst)?$')
+
+
+def list_segments(path):
+    """ 列出某个日志文件所有切分出的 segment，按照时间从旧到新排列
+    :param path: 日志文件的 Path
+    """
+    segments = []
+    for p in path.parent.glob(path.name + '.*'):
+        matchobj = SEGMENT_RE.match(p.name[len(path.name):])
+        if matchobj is not None:
+            segments.append((matchobj.group(1), p))
+    return [p for _, p in sorted(segments)]
+
+
+def compress_segment(segment, method):
+    """ 压缩一个 segment 并删除原文件
+    :return: 压缩后的 Path
+    """
+    target = segment.with_name(segment.name + COMPRESS_SUFFIXES[method])
+    tmp = target.with_name(target.name + '.tmp')
+    with open(segment, 'rb') as src:
+        if method == 'zstd':
+            with open(tmp, 'wb') as dst:
+                zstandard.ZstdCompressor().copy_stream(src, dst)
+        else:
+            with gzip.open(tmp, 'wb') as dst:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+    os.replace(tmp, target)
+    segment.unlink()
+    return target
+
+
+def cleanup_segments(path, backup_count=0, max_age=0, pending=()):
+    """ 删除多余或者过期的 segment
+    :param path: 日志文件的 Path
+    :param backup_count: 最多保留的 segment 数量，为 0 代表不限制
+    :param max_age: segment 最长保留时间（秒），为 0 代表不限制
+    :param pending: 还在等待压缩的 segment，计入数量但不删除
+    """
+    segments = list_segments(path)
+    removed = []
+    if backup_count > 0 and len(segments) > backup_count:
+        removed = segments[:len(segments) - backup_count]
+        segments = segments[len(segments) - backup_count:]
+    if max_age > 0:
+        expire = time.time() - max_age
+        for p in segments:
+            try:
+                if p.stat().st_mtime < expire:
+                    removed.append(p)
+            except FileNotFoundError:
+                pass
+    if pending:
+        pending = set(pending)
+        removed = [p for p in removed if SEGMENT_RE.sub(lambda m: '.' + m.group(1), p.name) not in pending]
+    for p in removed:
+        for f in (p, index_path(p)):
+            try:
+                f.unlink()
+            except FileNotFoundError:
+                pass
+    return removed
+
+
+def process_segment(segment, method):
+    """ 在进程池中运行：压缩 segment
+    """
+    if method in COMPRESS_SUFFIXES:
+        compress_segment(segment, method)
+
+
+class Rotator(object):
+    """ 日志切分策略，由 WriterManager 调用
+    """
+    # 文件达到这个大小（字节）时切分，为 0 代表不按大小切分
+    rotate_bytes = 0
+
+    # 每隔这个时间（秒）切分一次，按照本地时间对齐，例如 86400 代表每天零点，为 0 代表不按时间切分
+    rotate_interval = 0
+
+    # 压缩方式 none/gzip/zstd，zstd 需要安装 zstandard，没有安装时使用 gzip
+    compress = 'gzip'
+
+    # 保留的 segment 数量和时间（秒），为 0 代表不限制
+    backup_count = 0
+    max_age = 0
+
+    # 压缩使用的进程池
+    pool = None
+    compress_workers = 1
+
+    COMPRESS_METHODS = ('none', 'gzip', 'zstd')
+
+    def __init__(self, rotate_bytes=0, rotate_interval=0, compress='gzip', backup_count=0, max_age=0, compress_workers=1):
+        if compress not in self.COMPRESS_METHODS:
+            raise ValueError('compress must be one of %s!' % '/'.join(self.COMPRESS_METHODS))
+        if compress == 'zstd' and zstandard is None:
+            compress = 'gzip'
+        self.rotate_bytes = int(rotate_bytes)
+        self.rotate_interval = float(rotate_interval)
+        self.compress = compress
+        self.backup_count = int(backup_count)
+        self.max_age = float(max_age)
+        self.compress_workers = int(compress_workers)
+        # 多个写入线程可能同时切分不同的文件，进程池只创建一个
+        self.lock = threading.Lock()
+        # 已经提交但还没有压缩完成的 segment 名称，清理时跳过
+        self.pending = set()
+        self.errors = 0
+        self.logger = get_logger('pyzog', type_='stream', fmt='text')
+
+    @property
+    def enabled(self):
+        return self.rotate_bytes > 0 or self.rotate_interval > 0
+
+    def next_rotate_ts(self, now):
+        """ 计算下一次按时间切分的时间戳，按照本地时间对齐
+        """
+        if self.rotate_interval <= 0:
+            return 0
+        offset = time.localtime(now).tm_gmtoff
+        local = now + offset
+        return (local // self.rotate_interval + 1) * self.rotate_interval - offset
+
+    def should_rotate(self, writer, now):
+        if self.rotate_bytes > 0 and writer.size >= self.rotate_bytes:
+            return True
+        if self.rotate_interval > 0 and now >= writer.rotate_ts:
+            # 这个时间段内没有写入时不切分，避免产生空的 segment
+            if writer.size == 0:
+                writer.rotate_ts = self.next_rotate_ts(now)
+                return False
+            return True
+        return False
+
+    def segment_path(self, path):
+        name = path.name + '.' + time.strftime('%Y%m%d-%H%M%S')
+        segment = path.with_name(name)
+        n = 0
+        while any(p.exists() for p in [segment] + [segment.with_name(segment.name + s) for s in COMPRESS_SUFFIXES.values()]):
+            n += 1
+            segment = path.with_name('%s-%s' % (name, n))
+        return segment
+
+    def rotate(self, writer):
+        """ 将当前文件改名为 segment 并打开新文件，压缩交给进程池
+        """
+        writer.flush()
+        os.close(writer.fd)
+        segment = self.segment_path(writer.path)
+        os.rename(str(writer.path), str(segment))
+        if writer.index is not None:
+            writer.index.move(index_path(segment))
+        writer.open()
+        writer.rotate_ts = self.next_rotate_ts(time.time())
+        if self.compress not in COMPRESS_SUFFIXES:
+            # 不需要压缩时直接清理，清理只是删除文件，不需要进程池
+            self.cleanup(writer.path)
+            return segment
+        with self.lock:
+            if self.pool is None:
+                # 接收进程中有多个线程，使用 spawn 避免 fork 带来的锁问题
+                self.pool = ProcessPoolExecutor(self.compress_workers, mp_context=multiprocessing.get_context('spawn'))
+            pool = self.pool
+            self.pending.add(segment.name)
+        future = pool.submit(process_segment, segment, self.compress)
+        future.add_done_callback(lambda f: self.on_processed(f, writer.path, segment))
+        return segment
+
+    def on_processed(self, future, path, segment):
+        """ 压缩完成（或者失败）之后清理旧的 segment，在进程池的管理线程中调用
+        """
+        with self.lock:
+            self.pending.discard(segment.name)
+        try:
+            future.result()
+        except Exception as e:
+            self.errors += 1
+            self.logger.error('Rotator.process_segment %s error: %s', segment, repr(e))
+        self.cleanup(path)
+
+    def cleanup(self, path):
+        """ 清理旧的 segment，跳过还在等待压缩的 segment
+        """
+        with self.lock:
+            pending = list(self.pending)
+        try:
+            cleanup_segments(path, self.backup_count, self.max_age, pending)
+        except Exception as e:
+            self.errors += 1
+            self.logger.error('Rotator.cleanup_segments %s error: %s', path, repr(e))
+
+    def close(self):
+        """ 等待所有压缩任务完成
+        """
+        with self.lock:
+            pool, self.pool = self.pool, None
+        if pool is not None:
+            pool.shutdown(wait=True)
@@ -0,0 +1,332 @@
+# -*- coding: utf-8 -*-
+"""
+接收端的路由规则
+@author zrong
+
+默认每个 channel 写入同名的文件。提供路由规则后，每条日志按照规则的顺序匹配，
+匹配的规则决定写入哪些文件，或者丢弃这条日志。规则的条件包括：
+
+- channel 的通配符，例如 app.*
+- 日志的级别范围，例如 WARNING 及以上
+- JSON 字段的条件，例如 status >= 500、user.name ~ ^admin
+
+规则在启动时编译一次。channel 通配符第一个通配符之前的部分插入前缀树，查找时沿着 channel 名称
+走一遍前缀树即可得到候选规则，结果按 channel 名称缓存；字段条件预先解析为 (路径, 比较函数, 值)。
+级别和字段条件需要日志为 fmt json 或者 msgpack，只有候选规则中有这类条件时才会解析日志。
+"""
+import json
+import logging
+import operator
+import re
+import threading
+from fnmatch import fnmatchcase
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+WILDCARD = re.compile(r'[\*\?\[]')
+
+PREDICATE = re.compile(r'^\s*([\w\.\-]+)\s*(==|!=|>=|<=|!~|~|>|<)\s*(.*?)\s*$')
+
+OPERATORS = {
+    '==': operator.eq,
+    '!=': operator.ne,
+    '>=': operator.ge,
+    '<=': operator.le,
+    '>': operator.gt,
+    '<': operator.lt,
+}
+
+
+def get_level(level):
+    """ 将 level 名称或者数值转换为数值，无法识别时返回 None
+    """
+    if isinstance(level, int) and not isinstance(level, bool):
+        return level
+    if isinstance(level, str):
+        value = logging.getLevelName(level.upper())
+        if isinstance(value, int):
+            return value
+    return None
+
+
+class Predicate(object):
+    """ 一个 JSON 字段的条件，形如 status >= 500
+    """
+    def __init__(self, expr):
+        """
+        :param expr: 字段 运算符 值。字段可以使用 . 访问嵌套的字段；运算符为 == != >= <= > < ~ !~，
+            ~ 和 !~ 的值为正则表达式，其它运算符的值按照 JSON 解析，解析失败时作为字符串
+        """
+        matchobj = PREDICATE.match(expr)
+        if matchobj is None:
+            raise ValueError('invalid predicate %s!' % expr)
+        field, op, value = matchobj.groups()
+        self.expr = expr.strip()
+        self.path = tuple(field.split('.'))
+        self.op = op
+        if op in ('~', '!~'):
+            self.value = re.compile(value)
+        else:
+            try:
+                self.value = json.loads(value)
+            except ValueError:
+                self.value = value
+            self.compare = OPERATORS[op]
+
+    def get_field(self, record):
+        value = record
+        for key in self.path:
+            if not isinstance(value, dict) or key not in value:
+                raise KeyError(key)
+            value = value[key]
+        return value
+
+    def match(self, record):
+        """ 字段不存在或者类型无法比较时不匹配
+        """
+        try:
+            value = self.get_field(record)
+        except KeyError:
+            return False
+        if self.op == '~':
+            return self.value.search(value if isinstance(value, str) else json.dumps(value)) is not None
+        if self.op == '!~':
+            return self.value.search(value if isinstance(value, str) else json.dumps(value)) is None
+        try:
+            return self.compare(value, self.value)
+        except TypeError:
+            return False
+
+
+class Rule(object):
+    """ 一条路由规则
+    """
+    # 规则名称，即 [route:name] 中的 name
+    name = None
+
+    # channel 通配符
+    channels = None
+
+    # 级别范围，为 None 代表不限制
+    level = None
+    max_level = None
+
+    # Predicate 列表，全部满足才匹配
+    predicates = None
+
+    # 写入的文件名，可以使用 {channel} 代表 channel 名称
+    to = None
+
+    # 匹配后丢弃
+    drop = False
+
+    # 匹配后继续匹配后面的规则，没有其它规则匹配时仍然写入 channel 同名的文件
+    continue_ = False
+
+    # 匹配的次数
+    matched = 0
+
+    def __init__(self, name, channels=('*',), level=None, max_level=None, match=(), to=(), drop=False, continue_=False):
+        """
+        :param channels: channel 通配符列表
+        :param level: 最低级别，例如 WARNING
+        :param max_level: 最高级别，例如 INFO
+        :param match: 字段条件的列表，见 Predicate
+        :param to: 写入的文件名列表，可以使用 {channel}
+        :param drop: 匹配后丢弃，不能与 to 同时提供
+        :param continue_: 匹配后继续匹配后面的规则
+        """
+        self.name = name
+        self.channels = list(channels) or ['*']
+        self.level = self.parse_level(level)
+        self.max_level = self.parse_level(max_level)
+        self.predicates = [p if isinstance(p, Predicate) else Predicate(p) for p in match]
+        self.drop = bool(drop)
+        self.continue_ = bool(continue_)
+        if self.drop == bool(to):
+            raise ValueError('route %s must provide either to or drop!' % name)
+        self.to = list(to)
+        for dest in self.to:
+            try:
+                formatted = dest.format(channel='channel')
+            except (KeyError, IndexError, ValueError):
+                raise ValueError('route %s: only {channel} is allowed in %s!' % (name, dest))
+            if '/' in formatted or formatted.startswith('.'):
+                raise ValueError('route %s: invalid file name %s!' % (name, dest))
+        # 没有 {channel} 的文件名不需要每次 format
+        self.static = all('{' not in dest for dest in self.to)
+
+    def __repr__(self):
+        return 'Rule(%s)' % self.name
+
+    def parse_level(self, level):
+        if level is None or level == '':
+            return None
+        value = get_level(level)
+        if value is None:
+            raise ValueError('route %s: unknown level %s!' % (self.name, level))
+        return value
+
+    @property
+    def needs_record(self):
+        """ 是否需要解析日志内容
+        """
+        return self.level is not None or self.max_level is not None or bool(self.predicates)
+
+    def match_record(self, record):
+        if self.level is not None or self.max_level is not None:
+            levelno = record.get('levelno')
+            if levelno is None:
+                levelno = get_level(record.get('levelname') or record.get('level'))
+            if levelno is None:
+                return False
+            if self.level is not None and levelno < self.level:
+                return False
+            if self.max_level is not None and levelno > self.max_level:
+                return False
+        for p in self.predicates:
+            if not p.match(record):
+                return False
+        return True
+
+    def get_dests(self, channel):
+        if self.static:
+            return self.to
+        return [dest.format(channel=channel) for dest in self.to]
+
+
+class PrefixTrie(object):
+    """ 前缀树，查找时返回所有是 key 的前缀的项目
+    """
+    # 节点中保存项目的 key
+    ITEMS = None
+
+    def __init__(self):
+        self.root = {}
+
+    def add(self, prefix, item):
+        node = self.root
+        for ch in prefix:
+            node = node.setdefault(ch, {})
+        node.setdefault(self.ITEMS, []).append(item)
+
+    def find(self, key):
+        node = self.root
+        result = list(node.get(self.ITEMS, ()))
+        for ch in key:
+            node = node.get(ch)
+            if node is None:
+                break
+            result.extend(node.get(self.ITEMS, ()))
+        return result
+
+
+class Router(object):
+    """ 编译后的路由表
+    """
+    # Rule 列表，按照顺序匹配
+    rules = None
+
+    # 缓存每个 channel 的候选规则，超过 cache_size 后清空
+    cache_size = 10000
+
+    # 被丢弃的日志数量
+    dropped = 0
+
+    def __init__(self, rules, cache_size=10000):
+        self.rules = list(rules)
+        names = [rule.name for rule in self.rules]
+        if len(set(names)) != len(names):
+            raise ValueError('route names must be unique!')
+        self.cache_size = int(cache_size)
+        self.cache = {}
+        # 使用写入线程池时多个线程同时调用 route，计数在锁中更新
+        self.lock = threading.Lock()
+        self.trie = PrefixTrie()
+        for index, rule in enumerate(self.rules):
+            for pattern in rule.channels:
+                matchobj = WILDCARD.search(pattern)
+                if matchobj is None:
+                    # 没有通配符，必须完全相同
+                    self.trie.add(pattern, (index, pattern, 'exact'))
+                    continue
+                prefix = pattern[:matchobj.start()]
+                # prefix* 只需要比较前缀
+                kind = 'prefix' if pattern == prefix + '*' else 'glob'
+                self.trie.add(prefix, (index, pattern, kind))
+        self.needs_record = any(rule.needs_record for rule in self.rules)
+
+    def get_rules(self, channel):
+        """ channel 通配符匹配的规则，按照顺序排列
+        """
+        rules = self.cache.get(channel)
+        if rules is not None:
+            return rules
+        indexes = set()
+        for index, pattern, kind in self.trie.find(channel):
+            if index in indexes:
+                continue
+            if kind == 'prefix' or (kind == 'exact' and channel == pattern) or \
+                (kind == 'glob' and fnmatchcase(channel, pattern)):
+                indexes.add(index)
+        rules = tuple(self.rules[i] for i in sorted(indexes))
+        if len(self.cache) >= self.cache_size:
+            self.cache.clear()
+        self.cache[channel] = rules
+        return rules
+
+    def route(self, channel, data, record=None):
+        """ 返回这条日志需要写入的文件名列表，为空代表丢弃
+        :param channel: channel 名称
+        :param data: 日志内容 bytes，规则需要时按照 JSON 解析
+        :param record: 已经解析的日志，例如 msgpack 解包后的 dict
+        """
+        dests = []
+        matched = []
+        loaded = record is not None
+        for rule in self.get_rules(channel):
+            if rule.needs_record:
+                if not loaded:
+                    loaded = True
+                    record = self.load(data)
+                if record is None or not rule.match_record(record):
+                    continue
+            matched.append(rule)
+            if rule.drop:
+                break
+            for dest in rule.get_dests(channel):
+                if dest not in dests:
+                    dests.append(dest)
+            if not rule.continue_:
+                break
+        else:
+            # 没有终止的规则匹配，写入 channel 同名的文件
+            if channel not in dests:
+                dests.append(channel)
+        if matched or not dests:
+            with self.lock:
+                for rule in matched:
+                    rule.matched += 1
+                if not dests:
+                    self.dropped += 1
+        return dests
+
+    @staticmethod
+    def load(data):
+        if not data.startswith(b'{'):
+            return None
+        try:
+            record = orjson.loads(data) if orjson is not None else json.loads(data)
+        except ValueError:
+            return None
+        return record if isinstance(record, dict) else None
+
+    def get_stats(self):
+        stats = {'route_dropped': self.dropped}
+        for rule in self.rules:
+            stats['route_%s_matched' % re.sub(r'\W', '_', rule.name)] = rule.matched
+        return stats
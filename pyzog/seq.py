@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""
+发送端和接收端之间的序号
+@author zrong
+
+pubsub 在缓冲区满或者重连时会静默丢弃消息，接收端无法知道是否有日志丢失。
+handler 提供 sequence=True 时，每条日志的前面加上一个信封::
+
+    [MAGIC 4 字节][发送端 id 8 字节][序号 uint64]
+
+发送端 id 在每个 handler 创建时随机生成，fork 之后重新生成；序号按照 channel（zmq 的 topic、redis 的频道）
+从 1 开始递增。序号在日志格式化之后、交给 socket 或者 redis 之前分配，之后的丢失（包括 handler 的 drop 策略、
+HWM、pubsub 断开）都会被接收端发现；异步模式下在队列中被丢弃的日志还没有序号，只计入 handler 自己的统计。
+
+接收端按照 (发送端 id, channel) 跟踪下一个期望的序号，写入文件之前去掉信封：
+
+- 序号大于期望值，中间的序号计为丢失（gap）
+- 序号小于期望值，如果是之前计为丢失的序号则为乱序到达，从丢失中扣除；否则为重复
+- 每个发送端的第一条日志只作为起点，接收端启动之前以及最后一条之后的丢失无法发现
+"""
+import os
+import re
+import struct
+import threading
+
+
+MAGIC = b'\x00pzs'
+HEADER = struct.Struct('<4s8sQ')
+
+
+def is_sequenced(data):
+    """ 是否为带信封的日志，以 MAGIC 开头但长度不足的日志当作普通日志
+    """
+    return len(data) >= HEADER.size and data[:4] == MAGIC
+
+
+def split_envelope(data):
+    """ 拆分信封
+    :return: (发送端 id, 序号, 日志内容)
+    """
+    _, sender, seq = HEADER.unpack_from(data)
+    return sender, seq, data[HEADER.size:]
+
+
+class SequenceStamper(object):
+    """ 发送端，为每条日志加上信封。调用者需要保证同一个 handler 中不会并发调用
+    """
+    # 发送端 id
+    sender = None
+
+    # 创建 sender 的进程，fork 之后重新生成
+    pid = None
+
+    def __init__(self):
+        self.counters = {}
+        self.reset()
+
+    def reset(self):
+        self.sender = os.urandom(8)
+        self.pid = os.getpid()
+        self.counters.clear()
+
+    def stamp(self, channel, msg):
+        """ 返回加上信封的 bytes
+        :param channel: zmq 的 topic 或者 redis 的频道
+        :param msg: 格式化之后的日志，str 或者 bytes
+        """
+        if os.getpid() != self.pid:
+            self.reset()
+        seq = self.counters.get(channel, 0) + 1
+        self.counters[channel] = seq
+        return HEADER.pack(MAGIC, self.sender, seq) + (msg if isinstance(msg, bytes) else msg.encode())
+
+
+class SequenceTracker(object):
+    """ 接收端，按照 (发送端 id, channel) 检查序号。feed 在接收线程中调用，
+    get_stats 可能在统计线程中调用，两者通过 self.lock 互斥
+    """
+    # 最多跟踪的 (发送端, channel) 数量，超出后丢弃最早出现的
+    max_streams = 10000
+
+    # 每个 (发送端, channel) 最多记住的丢失序号，用于识别乱序到达，超出的部分不再记录
+    max_missing = 1000
+
+    # 计数的顺序
+    FIELDS = ('received', 'lost', 'gaps', 'duplicates', 'reordered')
+
+    def __init__(self, max_streams=10000, max_missing=1000):
+        self.max_streams = int(max_streams)
+        self.max_missing = int(max_missing)
+        # {(sender, channel): [下一个期望的序号, 丢失的序号 set]}
+        self.streams = {}
+        # {channel: [received, lost, gaps, duplicates, reordered]}
+        self.channels = {}
+        # feed 和 get_stats 可能在不同的线程中调用
+        self.lock = threading.Lock()
+
+    def feed(self, channel, data):
+        """ 检查一条带信封的日志
+        :return: 去掉信封之后的日志内容
+        """
+        sender, seq, payload = split_envelope(data)
+        with self.lock:
+            self.check(sender, channel, seq)
+        return payload
+
+    def check(self, sender, channel, seq):
+        """ 更新计数，在持有 self.lock 时调用
+        """
+        counter = self.channels.get(channel)
+        if counter is None:
+            counter = self.channels[channel] = [0, 0, 0, 0, 0]
+        counter[0] += 1
+        key = (sender, channel)
+        state = self.streams.get(key)
+        if state is None:
+            if len(self.streams) >= self.max_streams:
+                del self.streams[next(iter(self.streams))]
+            self.streams[key] = [seq + 1, set()]
+            return
+        expected, missing = state
+        if seq == expected:
+            state[0] = seq + 1
+        elif seq > expected:
+            counter[1] += seq - expected
+            counter[2] += 1
+            if len(missing) + seq - expected <= self.max_missing:
+                missing.update(range(expected, seq))
+            state[0] = seq + 1
+        elif seq in missing:
+            missing.discard(seq)
+            counter[1] -= 1
+            counter[4] += 1
+        else:
+            counter[3] += 1
+
+    @staticmethod
+    def loss_rate(received, lost):
+        total = received + lost
+        return lost / total if total else 0
+
+    def get_stats(self):
+        """ 汇总以及每个 channel 的丢失率，没有收到带信封的日志时为空
+        """
+        with self.lock:
+            channels = {k: list(v) for k, v in self.channels.items()}
+            senders = len(set(sender for sender, _ in self.streams))
+        if not channels:
+            return {}
+        totals = [sum(v[i] for v in channels.values()) for i in range(len(self.FIELDS))]
+        stats = {'seq_' + k: v for k, v in zip(self.FIELDS, totals)}
+        stats['seq_loss_rate'] = self.loss_rate(totals[0], totals[1])
+        stats['seq_senders'] = senders
+        for channel, counter in channels.items():
+            prefix = 'seq_%s_' % re.sub(r'\W', '_', channel)
+            stats[prefix + 'lost'] = counter[1]
+            stats[prefix + 'loss_rate'] = self.loss_rate(counter[0], counter[1])
+        return stats
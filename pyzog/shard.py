@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+"""
+多进程接收器
+@author zrong
+
+将配置中的 channels 使用一致性哈希分配到多个子进程，每个子进程运行一个 Receiver，
+只订阅分配给自己的 channels，写入自己的那部分日志文件。
+ShardSupervisor 负责启动子进程、重启退出的子进程，并汇总子进程上报的统计信息。
+"""
+import bisect
+import hashlib
+import multiprocessing
+import os
+import queue
+import signal
+import threading
+import time
+
+from pyzog.logging import get_logger
+from pyzog.stats import StatsExporter, render_prometheus
+
+
+def _hash(key):
+    return int(hashlib.md5(key.encode()).hexdigest()[:16], 16)
+
+
+class HashRing(object):
+    """ 一致性哈希环，worker 数量变化时只有少量 channel 需要迁移
+    """
+    # 每个 worker 在环上的虚拟节点数量
+    replicas = 100
+
+    def __init__(self, workers, replicas=100):
+        self.replicas = replicas
+        self.ring = sorted((_hash('%s-%s' % (worker, i)), worker) for worker in range(workers) for i in range(replicas))
+        self.keys = [k for k, _ in self.ring]
+
+    def get_worker(self, key):
+        idx = bisect.bisect(self.keys, _hash(key)) % len(self.keys)
+        return self.ring[idx][1]
+
+
+def assign_channels(channels, workers):
+    """ 将 channels 分配给 workers 个子进程
+    channels 可以是通配符，分配的单位是 channel 而不是具体的频道，所以 workers 不能大于 channels 的数量。
+    哈希之后没有分到 channel 的子进程，从分到最多的子进程中取出一个，保证每个子进程都有 channel
+    :return: 一个 list，第 i 项为第 i 个子进程的 channels
+    """
+    if workers > len(channels):
+        raise ValueError('workers %s is greater than channels %s!' % (workers, len(channels)))
+    ring = HashRing(workers)
+    shards = [[] for _ in range(workers)]
+    for ch in channels:
+        shards[ring.get_worker(ch)].append(ch)
+    for shard in shards:
+        if not shard:
+            shard.append(max(shards, key=len).pop())
+    return shards
+
+
+def run_shard(receiver_class, logpath, kwargs, index, stats_queue, stats_interval):
+    """ 子进程入口，启动一个 Receiver 并定时上报统计信息
+    """
+    # SIGINT 由 supervisor 统一处理
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    r = receiver_class(logpath, **kwargs)
+    r.install_signals()
+
+    def report():
+        while True:
+            time.sleep(stats_interval)
+            try:
+                stats_queue.put_nowait((index, os.getpid(), r.get_stats()))
+            except queue.Full:
+                pass
+            except Exception as e:
+                # 统计出错时继续上报，不能让线程退出
+                r.logger.error('run_shard.report shard %s error: %s', index, repr(e))
+    threading.Thread(target=report, name='pyzog.shard.report', daemon=True).start()
+    try:
+        err = r.start()
+    finally:
+        r.close()
+    raise SystemExit(str(err))
+
+
+class ShardSupervisor(object):
+    """ 管理多个运行 Receiver 的子进程
+    """
+    # 子进程运行的 Receiver 类，需要支持 channels 参数
+    receiver_class = None
+
+    # 日志存储文件夹
+    logpath = None
+
+    # 传递给 Receiver 的参数，channels 会被替换成分配给子进程的部分
+    kwargs = None
+
+    # 每个子进程的 channels
+    shards = None
+
+    # 子进程列表，与 shards 一一对应
+    processes = None
+
+    # 各个子进程最近一次上报的统计信息
+    stats = None
+
+    # 检查子进程是否存活的间隔（秒）
+    check_interval = 1.0
+
+    # 子进程退出后等待多久重启（秒）
+    restart_delay = 1.0
+
+    # 子进程上报统计信息，以及 supervisor 输出汇总信息的间隔（秒）
+    stats_interval = 60
+
+    def __init__(self, receiver_class, logpath, channels, workers, check_interval=1.0, restart_delay=1.0, stats_interval=60,
+        stats_addr=None, stats_file=None, **kwargs):
+        """
+        :param receiver_class: Receiver 的子类，例如 RedisReceiver
+        :param logpath: 日志存储文件夹
+        :param channels: 所有的 channels
+        :param workers: 子进程数量
+        :param stats_addr: 与 Receiver 相同，由 supervisor 提供汇总后的统计信息，子进程不再单独提供
+        :param stats_file: 与 Receiver 相同
+        :param kwargs: 传递给 receiver_class 的其他参数
+        """
+        if workers < 1:
+            raise ValueError('workers must be greater than 0!')
+        self.receiver_class = receiver_class
+        self.logpath = logpath
+        self.kwargs = kwargs
+        self.check_interval = check_interval
+        self.restart_delay = restart_delay
+        self.stats_interval = float(stats_interval)
+        self.exporter = StatsExporter(lambda: render_prometheus(None, self.get_stats()), self.get_stats,
+            addr=stats_addr, stats_file=stats_file, interval=self.stats_interval)
+        self.shards = assign_channels(channels, workers)
+        self.processes = [None] * len(self.shards)
+        self.restart_ts = [0] * len(self.shards)
+        self.restarts = [0] * len(self.shards)
+        self.stats = {}
+        self.stats_queue = multiprocessing.Queue(1000)
+        self.logger = get_logger('pyzog', type_='stream', fmt='text')
+
+    def spawn(self, index):
+        kwargs = dict(self.kwargs)
+        kwargs['channels'] = self.shards[index]
+        p = multiprocessing.Process(target=run_shard, name='pyzog.shard.%s' % index,
+            args=(self.receiver_class, self.logpath, kwargs, index, self.stats_queue, self.stats_interval))
+        p.start()
+        self.processes[index] = p
+        self.logger.warn('ShardSupervisor.spawn shard %s pid %s channels is %s', index, p.pid, self.shards[index])
+
+    def check_processes(self):
+        """ 重启已经退出的子进程
+        """
+        now = time.monotonic()
+        for index, p in enumerate(self.processes):
+            if p.is_alive():
+                continue
+            if self.restart_ts[index] == 0:
+                self.logger.error('ShardSupervisor shard %s pid %s exit code %s', index, p.pid, p.exitcode)
+                self.restart_ts[index] = now + self.restart_delay
+            elif now >= self.restart_ts[index]:
+                self.restart_ts[index] = 0
+                self.restarts[index] += 1
+                self.spawn(index)
+
+    def collect_stats(self):
+        while True:
+            try:
+                index, pid, stats = self.stats_queue.get_nowait()
+            except queue.Empty:
+                break
+            self.stats[index] = stats
+
+    def get_stats(self):
+        """ 汇总所有子进程的统计信息，数值相加
+        """
+        total = {'workers': len(self.processes), 'restarts': sum(self.restarts)}
+        for stats in self.stats.values():
+            for k, v in stats.items():
+                if isinstance(v, (int, float)):
+                    total[k] = total.get(k, 0) + v
+        return total
+
+    def forward_signal(self, signum, frame):
+        for p in self.processes:
+            if p is not None and p.is_alive():
+                os.kill(p.pid, signum)
+
+    def on_sigterm(self, signum, frame):
+        raise SystemExit(0)
+
+    def stop(self):
+        self.exporter.stop()
+        for p in self.processes:
+            if p is not None and p.is_alive():
+                p.terminate()
+        for p in self.processes:
+            if p is not None:
+                p.join(5)
+
+    def start(self):
+        """ 启动所有子进程并一直监控，直到收到退出信号
+        """
+        try:
+            # logrotate 发来的 SIGHUP 转发给所有子进程
+            signal.signal(signal.SIGHUP, self.forward_signal)
+            signal.signal(signal.SIGTERM, self.on_sigterm)
+            signal.signal(signal.SIGQUIT, self.on_sigterm)
+            for index in range(len(self.shards)):
+                self.spawn(index)
+            if self.exporter.enabled:
+                self.exporter.start()
+            stats_ts = time.monotonic()
+            while True:
+                time.sleep(self.check_interval)
+                self.check_processes()
+                self.collect_stats()
+                if time.monotonic() - stats_ts >= self.stats_interval:
+                    stats_ts = time.monotonic()
+                    self.logger.warn('ShardSupervisor stats: %s', self.get_stats())
+        except BaseException as e:
+            self.stop()
+            self.logger.error('ShardSupervisor.Exit:' + repr(e))
+            return e
@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+"""
+发送端的磁盘缓冲
+@author zrong
+
+redis 或者 ZeroMQ 的接收端不可用时，handler 将无法发送的日志追加到本地磁盘上的一个环形文件中，
+恢复之后由后台线程按照写入顺序重新发送，并限制重发的速度，避免压垮接收器。
+
+环形文件使用 mmap 读写，大小固定，写满之后覆盖最旧的日志。文件头中保存读写位置，
+进程重启后可以继续重发上次没有发送的日志。每条日志的格式为::
+
+    [topic 长度 uint16][payload 长度 uint32][topic][payload]
+"""
+import fcntl
+import mmap
+import os
+import struct
+import threading
+import time
+from pathlib import Path
+
+from pyzog.filter import TokenBucket
+
+
+SPOOL_MAGIC = b'PZSP'
+SPOOL_VERSION = 1
+
+# magic, version, capacity, head, tail, count，head 和 tail 是单调递增的绝对位置
+HEADER = struct.Struct('<4sIQQQQ')
+HEADER_SIZE = 64
+
+RECORD_HEADER = struct.Struct('<HI')
+
+
+class DiskSpool(object):
+    """ 基于 mmap 的环形文件，线程安全
+    """
+    # 文件路径
+    path = None
+
+    # 可以存放日志的字节数，不包括文件头
+    capacity = 0
+
+    # 下一条要读取和写入的位置
+    head = 0
+    tail = 0
+
+    # 文件中的日志数量
+    count = 0
+
+    # 因为空间不足被覆盖或者过大而丢弃的日志数量
+    dropped = 0
+
+    def __init__(self, path, capacity=64 * 1024 * 1024):
+        """
+        :param path: 环形文件的路径，同一个文件只能被一个 handler 使用
+        :param capacity: 环形文件的大小（字节）
+        """
+        self.path = Path(path)
+        self.capacity = int(capacity)
+        if self.capacity <= RECORD_HEADER.size:
+            raise ValueError('capacity is too small!')
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.fd = os.open(str(self.path), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(self.fd)
+            raise ValueError('spool %s is used by another process!' % self.path)
+        size = HEADER_SIZE + self.capacity
+        if os.fstat(self.fd).st_size != size:
+            os.ftruncate(self.fd, size)
+        self.mm = mmap.mmap(self.fd, size)
+        self.lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        """ 读取文件头，文件头不正确时清空
+        """
+        magic, version, capacity, head, tail, count = HEADER.unpack_from(self.mm, 0)
+        if magic != SPOOL_MAGIC or version != SPOOL_VERSION or capacity != self.capacity \
+            or not head <= tail <= head + capacity:
+            head = tail = count = 0
+        self.head, self.tail, self.count = head, tail, count
+        self.save()
+
+    def save(self):
+        HEADER.pack_into(self.mm, 0, SPOOL_MAGIC, SPOOL_VERSION, self.capacity, self.head, self.tail, self.count)
+
+    def __len__(self):
+        return self.count
+
+    def _write(self, pos, data):
+        offset = pos % self.capacity
+        first = min(len(data), self.capacity - offset)
+        self.mm[HEADER_SIZE + offset:HEADER_SIZE + offset + first] = data[:first]
+        if first < len(data):
+            self.mm[HEADER_SIZE:HEADER_SIZE + len(data) - first] = data[first:]
+
+    def _read(self, pos, size):
+        offset = pos % self.capacity
+        first = min(size, self.capacity - offset)
+        data = self.mm[HEADER_SIZE + offset:HEADER_SIZE + offset + first]
+        if first < size:
+            data += self.mm[HEADER_SIZE:HEADER_SIZE + size - first]
+        return data
+
+    def _record_size(self, pos):
+        topic_len, payload_len = RECORD_HEADER.unpack(self._read(pos, RECORD_HEADER.size))
+        return RECORD_HEADER.size + topic_len + payload_len
+
+    def append(self, topic, payload):
+        """ 在末尾追加一条日志，空间不足时覆盖最旧的日志
+        :param topic: bytes 或者 str
+        :param payload: bytes 或者 str
+        :return: 是否写入成功，日志本身大于 capacity 时返回 False
+        """
+        if isinstance(topic, str):
+            topic = topic.encode()
+        if isinstance(payload, str):
+            payload = payload.encode()
+        data = RECORD_HEADER.pack(len(topic), len(payload)) + topic + payload
+        with self.lock:
+            if len(data) > self.capacity:
+                self.dropped += 1
+                return False
+            while self.tail + len(data) - self.head > self.capacity:
+                self.head += self._record_size(self.head)
+                self.count -= 1
+                self.dropped += 1
+            self._write(self.tail, data)
+            self.tail += len(data)
+            self.count += 1
+            self.save()
+        return True
+
+    def peek(self, limit=100):
+        """ 从头部读取最多 limit 条日志，不移除
+        :return: [(topic, payload, 下一条的位置), ...]，处理完成后将最后一项的位置传给 commit
+        """
+        result = []
+        with self.lock:
+            pos = self.head
+            while pos < self.tail and len(result) < limit:
+                topic_len, payload_len = RECORD_HEADER.unpack(self._read(pos, RECORD_HEADER.size))
+                data = self._read(pos + RECORD_HEADER.size, topic_len + payload_len)
+                pos += RECORD_HEADER.size + topic_len + payload_len
+                result.append((data[:topic_len], data[topic_len:], pos))
+        return result
+
+    def commit(self, pos):
+        """ 移除 pos 之前的日志
+        """
+        with self.lock:
+            # peek 之后旧的日志可能已经被覆盖，覆盖时已经减去了计数，只计算 head 到 pos 之间剩余的日志
+            if pos > self.head:
+                removed = 0
+                while self.head < pos:
+                    self.head += self._record_size(self.head)
+                    removed += 1
+                self.count = max(self.count - removed, 0)
+                if self.head == self.tail:
+                    self.count = 0
+                self.save()
+
+    def get_stats(self):
+        return {
+            'disk_spooled': self.count,
+            'disk_spool_bytes': self.tail - self.head,
+            'disk_spool_dropped': self.dropped,
+        }
+
+    def close(self):
+        with self.lock:
+            if self.mm is None:
+                return
+            self.mm.flush()
+            self.mm.close()
+            self.mm = None
+            os.close(self.fd)
+
+
+class SpoolReplayer(object):
+    """ 后台线程，在传输恢复后按顺序重发 DiskSpool 中的日志
+    """
+    # 重发使用的 DiskSpool
+    spool = None
+
+    # 重发函数，参数为 [(topic, payload), ...]，返回成功发送的数量，失败时返回 0
+    send_batch = None
+
+    # 每秒最多重发的日志数量，为 0 代表不限制
+    rate = 1000
+
+    # 每次重发的最大数量
+    batch_size = 100
+
+    # 发送失败或者没有日志时等待的时间（秒）
+    retry_interval = 1.0
+
+    # 重发成功的数量
+    replayed = 0
+
+    def __init__(self, spool, send_batch, rate=1000, batch_size=100, retry_interval=1.0, name='pyzog.SpoolReplayer'):
+        self.spool = spool
+        self.send_batch = send_batch
+        self.rate = float(rate)
+        self.batch_size = int(batch_size)
+        self.retry_interval = float(retry_interval)
+        self.bucket = TokenBucket(self.rate, max(self.rate, 1.0)) if self.rate > 0 else None
+        self.wakeup = threading.Event()
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, name=name, daemon=True)
+        self.thread.start()
+
+    def notify(self):
+        """ 有新的日志写入 spool 时调用
+        """
+        self.wakeup.set()
+
+    def take_tokens(self):
+        """ 等待令牌，返回本次可以发送的数量
+        """
+        if self.bucket is None:
+            return self.batch_size
+        while not self.stopped:
+            if self.bucket.consume(time.monotonic()):
+                n = 1 + min(int(self.bucket.tokens), self.batch_size - 1)
+                self.bucket.tokens -= n - 1
+                return n
+            time.sleep(1.0 / self.rate)
+        return 0
+
+    def run(self):
+        while not self.stopped:
+            if len(self.spool) == 0:
+                self.wakeup.wait(self.retry_interval)
+                self.wakeup.clear()
+                continue
+            limit = self.take_tokens()
+            items = self.spool.peek(limit)
+            if not items:
+                continue
+            try:
+                sent = self.send_batch([(topic, payload) for topic, payload, _ in items])
+            except Exception:
+                sent = 0
+            if sent > 0:
+                self.spool.commit(items[sent - 1][2])
+                self.replayed += sent
+            if sent < len(items):
+                # 没有用完的令牌不退还，失败时等待一段时间再重试
+                time.sleep(self.retry_interval)
+
+    def stop(self):
+        self.stopped = True
+        self.wakeup.set()
+        self.thread.join(max(self.retry_interval * 2, 1))
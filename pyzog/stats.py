@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+"""
+接收端的统计信息
+@author zrong
+
+每个 channel 的计数在锁中更新，输出时先在锁中复制一份，后台线程读取时接收线程可能正在加入新的 channel。
+统计信息可以通过本地的 HTTP 接口以 Prometheus 文本格式获取，或者定期写入一个 JSON 文件，两者都在后台线程中完成。
+"""
+import bisect
+import json
+import os
+import threading
+import traceback
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+from pyzog.logging import get_logger
+
+
+# 写入耗时和端到端延迟的直方图分桶（秒）
+WRITE_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0)
+
+
+class Histogram(object):
+    """ Prometheus 风格的累积直方图
+    """
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """ 返回 [(le, 累积数量), ...]，最后一项的 le 为 +Inf
+        """
+        result = []
+        total = 0
+        for le, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            result.append((le, total))
+        return result
+
+    def to_dict(self):
+        return {'buckets': [[str(le), n] for le, n in self.cumulative()], 'sum': self.sum, 'count': self.count}
+
+
+class Stats(object):
+    """ 接收器的计数器
+    """
+    # 每个 channel 的消息数量和字节数，value 为 [messages, bytes]
+    channels = None
+
+    # 写入耗时
+    write_latency = None
+
+    # 发送端时间戳到写入时的延迟，只有数据中带有时间戳（例如 fmt 为 msgpack）时才会统计
+    lag = None
+
+    # 与服务器建立连接的次数，第一次之后的都是重连
+    connects = 0
+
+    # 无法解码而被跳过的数据数量，例如损坏的 msgpack
+    decode_errors = 0
+
+    # 实时获取的数值，例如队列深度，value 为无参数的函数
+    gauges = None
+
+    def __init__(self):
+        self.channels = {}
+        self.write_latency = Histogram(WRITE_BUCKETS)
+        self.lag = Histogram(LAG_BUCKETS)
+        self.gauges = {}
+        self.lock = threading.Lock()
+
+    @property
+    def reconnects(self):
+        return max(self.connects - 1, 0)
+
+    def on_message(self, channel, size, write_seconds):
+        with self.lock:
+            counter = self.channels.get(channel)
+            if counter is None:
+                counter = self.channels[channel] = [0, 0]
+            counter[0] += 1
+            counter[1] += size
+            self.write_latency.observe(write_seconds)
+
+    def on_lag(self, seconds):
+        with self.lock:
+            self.lag.observe(seconds)
+
+    def on_decode_error(self):
+        with self.lock:
+            self.decode_errors += 1
+
+    def get_channels(self):
+        """ 返回每个 channel 计数的副本 [(channel, messages, bytes), ...]
+        """
+        with self.lock:
+            return [(k, v[0], v[1]) for k, v in self.channels.items()]
+
+    def get_gauges(self):
+        return {k: f() for k, f in self.gauges.items()}
+
+    def summary(self):
+        """ 汇总的数值，不包括每个 channel 的计数和直方图
+        """
+        channels = self.get_channels()
+        result = {
+            'messages': sum(v[1] for v in channels),
+            'bytes': sum(v[2] for v in channels),
+            'reconnects': self.reconnects,
+            'decode_errors': self.decode_errors,
+        }
+        result.update(self.get_gauges())
+        return result
+
+    def to_dict(self):
+        return {
+            'channels': {k: {'messages': messages, 'bytes': size} for k, messages, size in self.get_channels()},
+            'write_seconds': self.write_latency.to_dict(),
+            'lag_seconds': self.lag.to_dict(),
+            'reconnects': self.reconnects,
+            'decode_errors': self.decode_errors,
+            'gauges': self.get_gauges(),
+        }
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render_prometheus(stats=None, extra=None, prefix='pyzog'):
+    """ 生成 Prometheus 文本格式
+    :param stats: Stats 实例
+    :param extra: 其他数值，dict，非数值的 value 以及 stats 中已经包含的 key 会被忽略
+    """
+    lines = []
+    skip = set()
+    if stats is not None:
+        skip = set(stats.summary())
+        channels = stats.get_channels()
+        lines.append('# TYPE %s_messages_total counter' % prefix)
+        for ch, messages, _ in channels:
+            lines.append('%s_messages_total{channel="%s"} %s' % (prefix, _escape(ch), messages))
+        lines.append('# TYPE %s_bytes_total counter' % prefix)
+        for ch, _, size in channels:
+            lines.append('%s_bytes_total{channel="%s"} %s' % (prefix, _escape(ch), size))
+        for name, hist in (('write_seconds', stats.write_latency), ('lag_seconds', stats.lag)):
+            lines.append('# TYPE %s_%s histogram' % (prefix, name))
+            for le, n in hist.cumulative():
+                lines.append('%s_%s_bucket{le="%s"} %s' % (prefix, name, le, n))
+            lines.append('%s_%s_sum %s' % (prefix, name, hist.sum))
+            lines.append('%s_%s_count %s' % (prefix, name, hist.count))
+        lines.append('# TYPE %s_reconnects_total counter' % prefix)
+        lines.append('%s_reconnects_total %s' % (prefix, stats.reconnects))
+        lines.append('# TYPE %s_decode_errors_total counter' % prefix)
+        lines.append('%s_decode_errors_total %s' % (prefix, stats.decode_errors))
+        for k, v in stats.get_gauges().items():
+            lines.append('# TYPE %s_%s gauge' % (prefix, k))
+            lines.append('%s_%s %s' % (prefix, k, v))
+    for k, v in (extra or {}).items():
+        if k not in skip and isinstance(v, (int, float)) and not isinstance(v, bool):
+            lines.append('# TYPE %s_%s gauge' % (prefix, k))
+            lines.append('%s_%s %s' % (prefix, k, v))
+    return '\n'.join(lines) + '\n'
+
+
+class StatsExporter(object):
+    """ 在后台线程中提供 HTTP 接口，或者定期写入统计文件
+    """
+    # 返回 Prometheus 文本的函数
+    render_text = None
+
+    # 返回可以序列化为 JSON 的统计信息的函数
+    render_json = None
+
+    # HTTP 接口监听的地址，形如 127.0.0.1:9108
+    addr = None
+
+    # 统计文件的路径，以及写入的间隔（秒）
+    stats_file = None
+    interval = 10
+
+    server = None
+
+    # 输出统计信息出错的次数
+    errors = 0
+
+    def __init__(self, render_text, render_json, addr=None, stats_file=None, interval=10):
+        self.render_text = render_text
+        self.render_json = render_json
+        self.addr = addr
+        self.stats_file = Path(stats_file) if stats_file else None
+        self.interval = float(interval)
+        self.stopped = threading.Event()
+
+    @property
+    def enabled(self):
+        return bool(self.addr or self.stats_file)
+
+    def start(self):
+        if self.addr:
+            host, _, port = self.addr.rpartition(':')
+            exporter = self
+
+            class MetricsHandler(BaseHTTPRequestHandler):
+                def do_GET(self):
+                    if self.path.split('?')[0] not in ('/', '/metrics'):
+                        self.send_error(404)
+                        return
+                    try:
+                        body = exporter.render_text().encode()
+                    except Exception:
+                        exporter.on_error()
+                        self.send_error(500)
+                        return
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+                def log_message(self, format, *args):
+                    pass
+
+            self.server = ThreadingHTTPServer((host or '127.0.0.1', int(port)), MetricsHandler)
+            self.server.daemon_threads = True
+            threading.Thread(target=self.server.serve_forever, name='pyzog.stats.http', daemon=True).start()
+        if self.stats_file:
+            threading.Thread(target=self._write_loop, name='pyzog.stats.file', daemon=True).start()
+
+    def write_file(self):
+        tmp = self.stats_file.with_name(self.stats_file.name + '.tmp')
+        tmp.write_text(json.dumps(self.render_json(), ensure_ascii=False, indent=2))
+        os.replace(str(tmp), str(self.stats_file))
+
+    def on_error(self):
+        """ 输出统计信息出错时不能让后台线程退出，只记录错误
+        """
+        self.errors += 1
+        get_logger('pyzog', type_='stream', fmt='text').error('StatsExporter error: %s', traceback.format_exc())
+
+    def _write_loop(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                self.write_file()
+            except Exception:
+                self.on_error()
+
+    def stop(self):
+        self.stopped.set()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+        if self.stats_file:
+            # 在接收器退出时调用，出错时不能覆盖原来的退出原因
+            try:
+                self.write_file()
+            except Exception:
+                self.on_error()
@@ -0,0 +1,406 @@
+# -*- coding: utf-8 -*-
+"""
+接收端专用的文件写入器
+@author zrong
+
+接收到的 payload 以 bytes 形式直接追加到每个文件自己的缓冲区，
+缓冲区达到 buffer_size 或者距离上次写入超过 flush_interval 秒时写入磁盘。
+不再经过 logging.Logger/LogRecord/Formatter，也不会在每次写入时 os.stat。
+
+打开的文件保存在 LRU 中，超过 max_open_files 或者空闲超过 idle_timeout 秒的文件
+会被写入磁盘并关闭，下次收到该文件的日志时重新打开。
+
+提供 rotate_bytes 或者 rotate_interval 时使用内置的切分（见 pyzog.rotate），
+切分出的文件在进程池中压缩，不影响当前文件的写入。
+
+配合 logrotate 使用时，由后台线程每隔 rotate_check_interval 秒检查一次文件是否被改名，
+或者在收到 SIGHUP 信号后立即检查，发现改名后重新打开文件。
+
+WriterManager 的锁只保护 LRU，每个 FileWriter 有自己的锁，写入磁盘和 fsync 时只持有这个文件的锁，
+多个写入线程（见 pyzog.pool）写入不同的文件时不会互相阻塞。被移出 LRU 的文件在关闭完成之前不会被重新打开，
+保证缓冲区中的数据先写入磁盘。
+
+每个文件还维护一个 name.log.idx 时间索引（见 pyzog.index），用于按照接收时间查询。
+"""
+import os
+import signal
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+from pyzog.index import TimeIndex, index_path
+from pyzog.rotate import Rotator
+
+
+class FileWriter(object):
+    """ 单个日志文件的缓冲写入器
+    """
+    # 日志文件路径
+    path = None
+
+    # 不带扩展名的文件名
+    name = None
+
+    # 每次 write 之后追加的分隔符，文本日志为换行符，msgpack 等自带长度的数据为空
+    separator = b'\n'
+
+    # 打开的文件描述符
+    fd = None
+
+    # 写入缓冲区
+    buffer = None
+
+    # 缓冲区达到这个字节数时写入磁盘，为 0 代表每次都直接写入
+    buffer_size = 65536
+
+    # fsync 策略 none/flush/interval
+    fsync = 'none'
+    fsync_interval = 1.0
+
+    # 最近一次写入磁盘和 fsync 的时间
+    flush_ts = 0
+    fsync_ts = 0
+
+    # 最近一次调用 write 的时间
+    write_ts = 0
+
+    # 文件大小（包括缓冲区中的数据），用于按大小切分
+    size = 0
+
+    # 下一次按时间切分的时间戳
+    rotate_ts = 0
+
+    # 时间索引，index_every 和 index_interval 都为 0 时不使用
+    index = None
+    index_every = 0
+    index_interval = 0
+
+    def __init__(self, path, buffer_size=65536, fsync='none', fsync_interval=1.0, name=None, separator=b'\n',
+        index_every=0, index_interval=0):
+        """
+        :param index_every: 每隔多少条日志记录一次索引
+        :param index_interval: 每隔多少秒记录一次索引
+        """
+        self.path = path
+        self.name = name or path.stem
+        self.separator = separator
+        self.buffer = bytearray()
+        self.buffer_size = buffer_size
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.index_every = index_every
+        self.index_interval = index_interval
+        self.lock = threading.Lock()
+        self.open()
+
+    def open(self):
+        self.fd = os.open(str(self.path), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666)
+        self.flush_ts = self.fsync_ts = self.write_ts = time.monotonic()
+        self.size = os.fstat(self.fd).st_size
+        if self.index_every > 0 or self.index_interval > 0:
+            # 日志文件为空时，已有的索引属于被 logrotate 改名的旧文件
+            self.index = TimeIndex(index_path(self.path), self.index_every, self.index_interval, truncate=self.size == 0)
+
+    def write(self, data):
+        """ 写入一条数据，data 为 bytes，自动加上分隔符
+        """
+        if self.index is not None:
+            self.index.add(self.size)
+        self.buffer += data
+        self.buffer += self.separator
+        self.size += len(data) + len(self.separator)
+        self.write_ts = time.monotonic()
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            view = memoryview(self.buffer)
+            while view:
+                written = os.write(self.fd, view)
+                view = view[written:]
+            view.release()
+            self.buffer.clear()
+        if self.index is not None:
+            self.index.flush()
+        now = time.monotonic()
+        self.flush_ts = now
+        if self.fsync == 'flush' or (self.fsync == 'interval' and now - self.fsync_ts >= self.fsync_interval):
+            os.fsync(self.fd)
+            self.fsync_ts = now
+
+    def is_rotated(self):
+        """ 文件是否已经被删除或者改名，logrotate 的 create 模式会改名后创建新文件
+        """
+        try:
+            st = os.stat(str(self.path))
+        except FileNotFoundError:
+            return True
+        fst = os.fstat(self.fd)
+        return st.st_dev != fst.st_dev or st.st_ino != fst.st_ino
+
+    def reopen(self):
+        """ 将缓冲区写入旧文件后打开新文件
+        """
+        self.flush()
+        os.close(self.fd)
+        if self.index is not None:
+            self.index.close()
+        self.open()
+
+    def close(self):
+        if self.fd is None:
+            return
+        self.flush()
+        os.close(self.fd)
+        self.fd = None
+        if self.index is not None:
+            self.index.close()
+
+
+class WriterManager(object):
+    """ 管理 logpath 下所有的 FileWriter
+    """
+    # 日志存储文件夹
+    logpath = None
+
+    # 所有打开的 FileWriter，key 为带扩展名的文件名，按照最近使用的顺序排列，最后一个是最近使用的
+    writers = None
+
+    # 最多同时打开的文件数量
+    max_open_files = 1024
+
+    # 超过这个时间（秒）没有写入的文件会被关闭，为 0 代表不关闭
+    idle_timeout = 300
+
+    # LRU 统计计数
+    hits = 0
+    misses = 0
+    evictions = 0
+
+    # FileWriter 的参数
+    buffer_size = 65536
+    flush_interval = 0.5
+    fsync = 'none'
+    fsync_interval = 1.0
+
+    # 时间索引的采样间隔，条数和秒数
+    index_every = 1000
+    index_interval = 1.0
+
+    # 检查 logrotate 的时间间隔
+    rotate_check_interval = 1.0
+    rotate_check_ts = 0
+
+    # 收到 SIGHUP 后设置为 True，在下一次检查时重新打开所有被改名的文件
+    rotate_requested = False
+
+    # 后台刷新线程
+    thread = None
+
+    # 内置的日志切分
+    rotator = None
+
+    FSYNC_POLICIES = ('none', 'flush', 'interval')
+
+    def __init__(self, logpath, buffer_size=65536, flush_interval=0.5, fsync='none', fsync_interval=1.0, rotate_check_interval=1.0,
+        max_open_files=1024, idle_timeout=300, index_every=1000, index_interval=1.0, **kwargs):
+        """
+        :param logpath: 日志存储文件夹
+        :param buffer_size: 每个文件的缓冲区大小（字节）
+        :param flush_interval: 缓冲区最长的停留时间（秒）
+        :param fsync: fsync 策略，none 交给操作系统；flush 每次写入磁盘后 fsync；interval 每隔 fsync_interval 秒 fsync
+        :param fsync_interval: fsync 为 interval 时的间隔（秒）
+        :param rotate_check_interval: 检查文件是否被 logrotate 改名的间隔（秒）
+        :param max_open_files: 最多同时打开的文件数量
+        :param idle_timeout: 关闭空闲文件的时间（秒），为 0 代表不关闭
+        :param index_every: 时间索引每隔多少条日志记录一次，为 0 代表不按条数记录
+        :param index_interval: 时间索引每隔多少秒记录一次，为 0 代表不按时间记录，两者都为 0 时不生成索引
+        :param kwargs: 传递给 Rotator，例如 rotate_bytes/rotate_interval/compress/backup_count/max_age
+        """
+        if fsync not in self.FSYNC_POLICIES:
+            raise ValueError('fsync must be one of %s!' % '/'.join(self.FSYNC_POLICIES))
+        self.logpath = logpath if isinstance(logpath, Path) else Path(logpath)
+        self.buffer_size = int(buffer_size)
+        self.flush_interval = float(flush_interval)
+        self.fsync = fsync
+        self.fsync_interval = float(fsync_interval)
+        self.rotate_check_interval = float(rotate_check_interval)
+        self.rotate_check_ts = time.monotonic()
+        self.max_open_files = int(max_open_files)
+        if self.max_open_files < 1:
+            raise ValueError('max_open_files must be greater than 0!')
+        self.idle_timeout = float(idle_timeout)
+        self.index_every = int(index_every)
+        self.index_interval = float(index_interval)
+        self.rotator = Rotator(**kwargs)
+        self.writers = OrderedDict()
+        # 已经移出 LRU、正在关闭的文件，value 为关闭完成后设置的 Event
+        self.closing = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def open_writer(self, name, ext='.log', separator=b'\n'):
+        """ 创建一个 FileWriter，文件名为 name + ext
+        """
+        # 创建或者设置 logs 文件夹的权限，让其他 user 也可以写入（例如nginx）
+        if self.logpath.exists():
+            self.logpath.chmod(0o40777)
+        else:
+            self.logpath.mkdir(mode=0o40777)
+        writer = FileWriter(self.logpath.joinpath(name + ext),
+            buffer_size=self.buffer_size, fsync=self.fsync, fsync_interval=self.fsync_interval,
+            name=name, separator=separator, index_every=self.index_every, index_interval=self.index_interval)
+        # 重新打开已有的文件时，按照文件最后修改的时间计算，避免上一个时间段的数据没有被切分
+        mtime = os.fstat(writer.fd).st_mtime if writer.size > 0 else time.time()
+        writer.rotate_ts = self.rotator.next_rotate_ts(mtime)
+        return writer
+
+    def write(self, name, data, ext='.log', separator=b'\n'):
+        """ 将 data 写入 name 对应的文件
+        :param name: 文件名，不要带扩展名
+        :param data: bytes
+        :param ext: 文件的扩展名
+        :param separator: 每条数据之后追加的分隔符
+        """
+        filename = name + ext
+        while True:
+            evicted = []
+            with self.lock:
+                writer = self.writers.get(filename)
+                pending = self.closing.get(filename) if writer is None else None
+                if pending is None and writer is None:
+                    self.misses += 1
+                    if len(self.writers) >= self.max_open_files:
+                        evicted.append(self.evict())
+                    writer = self.open_writer(name, ext, separator)
+                    self.writers[filename] = writer
+                elif writer is not None:
+                    self.hits += 1
+                    self.writers.move_to_end(filename)
+            if pending is not None:
+                # 等待这个文件之前的 FileWriter 关闭后再重新打开
+                pending.wait()
+                continue
+            self.close_evicted(evicted)
+            with writer.lock:
+                # 在取得锁之前可能已经被其它线程关闭，重新获取
+                if writer.fd is None:
+                    continue
+                writer.write(data)
+                if self.rotator.enabled and self.rotator.should_rotate(writer, time.time()):
+                    self.rotator.rotate(writer)
+            return
+
+    def evict(self):
+        """ 移出最久未使用的文件，在持有 self.lock 时调用，之后需要调用 close_evicted
+        """
+        filename, writer = self.writers.popitem(last=False)
+        self.closing[filename] = threading.Event()
+        self.evictions += 1
+        return filename, writer
+
+    def close_evicted(self, evicted):
+        """ 关闭移出 LRU 的文件，然后允许重新打开
+        """
+        for filename, writer in evicted:
+            with writer.lock:
+                writer.close()
+            with self.lock:
+                self.closing.pop(filename).set()
+
+    def tick(self):
+        """ 写入超时的缓冲区，关闭空闲的文件，并在需要的时候检查 logrotate
+        """
+        now = time.monotonic()
+        closed = []
+        with self.lock:
+            if self.idle_timeout > 0:
+                # 从最久未使用的开始检查
+                while self.writers:
+                    writer = next(iter(self.writers.values()))
+                    if now - writer.write_ts < self.idle_timeout:
+                        break
+                    closed.append(self.evict())
+            writers = list(self.writers.values())
+            check_rotated = self.rotate_requested or now - self.rotate_check_ts >= self.rotate_check_interval
+            if check_rotated:
+                self.rotate_requested = False
+                self.rotate_check_ts = now
+        self.close_evicted(closed)
+        wall = time.time()
+        for writer in writers:
+            with writer.lock:
+                if writer.fd is None:
+                    continue
+                if writer.buffer and now - writer.flush_ts >= self.flush_interval:
+                    writer.flush()
+                if self.rotator.enabled and self.rotator.should_rotate(writer, wall):
+                    self.rotator.rotate(writer)
+                if check_rotated and writer.is_rotated():
+                    writer.reopen()
+
+    def start(self):
+        """ 启动后台刷新线程
+        """
+        if self.thread is not None:
+            return
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self._run, name='pyzog.WriterManager', daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        interval = min(self.flush_interval, self.rotate_check_interval) / 2
+        while not self.stopped.wait(interval):
+            self.tick()
+
+    def install_sighup(self):
+        """ 收到 SIGHUP 时检查 logrotate，只能在主线程中调用
+        """
+        def on_sighup(signum, frame):
+            self.rotate_requested = True
+        signal.signal(signal.SIGHUP, on_sighup)
+
+    def get_buffered_bytes(self):
+        """ 所有缓冲区中还没有写入磁盘的字节数
+        """
+        return sum(len(writer.buffer) for writer in list(self.writers.values()))
+
+    def get_stats(self):
+        """ 返回 LRU 的统计计数
+        """
+        return {
+            'open_files': len(self.writers),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+    def flush(self, names=None):
+        """ 将缓冲区写入磁盘
+        :param names: 只写入这些文件（不带扩展名），不提供则写入所有文件
+        """
+        with self.lock:
+            if names is None:
+                writers = list(self.writers.values())
+            else:
+                names = set(names)
+                writers = [writer for writer in self.writers.values() if writer.name in names]
+        for writer in writers:
+            with writer.lock:
+                if writer.fd is not None:
+                    writer.flush()
+
+    def close(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        with self.lock:
+            writers = list(self.writers.values())
+            self.writers.clear()
+        for writer in writers:
+            with writer.lock:
+                writer.close()
+        self.rotator.close()
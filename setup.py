@@ -26,7 +26,7 @@ def find_requires(*file_paths):
     return require_file.splitlines()
 
 classifiers = [
-    'Programming Language :: Python :: 3.6',
+    'Programming Language :: Python :: 3.7',
     'Development Status :: 4 - Beta',
     'Environment :: Console',
     'Operating System :: POSIX :: Linux',
@@ -54,7 +54,7 @@ setup(
     url = "https://zengrong.net",
     license = "BSD 3",
     keywords = "development zrong zmq logging",
-    python_requires='>=3.6, <4',
+    python_requires='>=3.7, <4',
     packages = find_packages(exclude=['test*', 'doc*', 'fabric']),
     install_requires=find_requires('requirements.txt'),
     entry_points=entry_points,
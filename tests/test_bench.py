@@ -0,0 +1,21 @@
+from pyzog.bench import percentiles
+from pyzog.cli import parse_options
+
+
+def test_percentiles():
+    result = percentiles([i / 1000 for i in range(1, 1001)])
+    assert result['p50'] == 0.501
+    assert result['p99'] == 0.991
+    assert result['p999'] == 1.0
+    assert percentiles([]) == {}
+
+
+def test_parse_options():
+    assert parse_options(['async_=true', 'sndhwm=1000', 'policy=spool']) == {'async_': True, 'sndhwm': 1000, 'policy': 'spool'}
+
+
+def test_bench_formatter():
+    from pyzog.bench import bench_formatter
+    result = bench_formatter(100)
+    assert 'fast_json' in result['formatters']
+    assert result['formatters']['fast_json']['records_per_second'] > 0
@@ -0,0 +1,36 @@
+import threading
+import time
+
+import zmq
+
+from pyzog.broker import Broker
+
+
+def test_broker_pubsub():
+    b = Broker('inproc://front', 'inproc://back', capture='inproc://capture')
+    b.open()
+    b.thread = threading.Thread(target=b.run_proxy, daemon=True)
+    b.thread.start()
+    ctx = b.ctx
+    sub = ctx.socket(zmq.SUB)
+    sub.setsockopt(zmq.SUBSCRIBE, b'app.')
+    sub.connect('inproc://back')
+    tap = ctx.socket(zmq.SUB)
+    tap.setsockopt(zmq.SUBSCRIBE, b'app.')
+    tap.connect('inproc://capture')
+    pub = ctx.socket(zmq.PUB)
+    pub.connect('inproc://front')
+    # 等待订阅经过 broker 转发给发送端
+    time.sleep(0.3)
+    for i in range(3):
+        pub.send_multipart([b'app.a', b'msg%d' % i])
+    pub.send_multipart([b'other', b'filtered'])
+    assert [sub.recv_multipart()[1] for _ in range(3)] == [b'msg0', b'msg1', b'msg2']
+    assert tap.poll(1000) and tap.recv_multipart() == [b'app.a', b'msg0']
+    stats = b.get_stats()
+    assert stats['frontend_frames_in'] == 6
+    assert stats['backend_frames_out'] == 6
+    for sock in (sub, tap, pub):
+        sock.close(0)
+    b.stop()
+    assert b.ctx is None
@@ -0,0 +1,67 @@
+import gzip
+import json
+
+import pytest
+
+from pyzog.compact import Archive, compact, count_by
+
+
+def make_lines(start, n, step=1.0):
+    lines = []
+    for i in range(n):
+        lines.append(json.dumps({
+            'levelname': 'ERROR' if i % 5 == 0 else 'INFO',
+            'module': 'mod%d' % (i % 3),
+            'funcName': 'func',
+            'lineno': i,
+            'created': start + i * step,
+            'message': 'msg %d 中文' % i,
+        }))
+    return '\n'.join(lines) + '\nnot json\n'
+
+
+def test_compact(tmp_path):
+    numpy = pytest.importorskip('numpy')
+    tmp_path.joinpath('app.log.20200101-000000').write_text(make_lines(0, 300))
+    tmp_path.joinpath('app.log.20200101-000500.gz').write_bytes(gzip.compress(make_lines(300, 300).encode()))
+    tmp_path.joinpath('app.log').write_text(make_lines(600, 10))
+    tmp_path.joinpath('other.log.20200101-000000').write_text(make_lines(0, 60))
+
+    results = list(compact(tmp_path, workers=2, block_rows=100, remove=True))
+    assert sorted(target.name for _, target, _, _ in results) == [
+        'app.log.20200101-000000.pzc', 'app.log.20200101-000500.pzc', 'other.log.20200101-000000.pzc']
+    assert all(skipped == 1 for _, _, _, skipped in results)
+    assert not tmp_path.joinpath('app.log.20200101-000000').exists()
+    # 当前文件不转换，已经转换的 segment 不重复转换
+    assert tmp_path.joinpath('app.log').exists()
+    assert list(compact(tmp_path, workers=1)) == []
+
+    archive = Archive(tmp_path.joinpath('app.log.20200101-000500.pzc'))
+    assert archive.rows == 300
+    data = list(archive.scan(['created', 'message'], since=350, until=359))
+    assert numpy.concatenate([d['created'] for d in data]).tolist() == list(range(350, 360))
+    assert data[0]['message'][0] == 'msg 50 中文'
+    # 只有中间的一个 block 与时间范围重合
+    assert archive.skipped_blocks == 2
+
+    counts, skipped = count_by(tmp_path, by=('channel', 'level'))
+    assert counts == {('app', 'ERROR'): 120, ('app', 'INFO'): 480, ('other', 'ERROR'): 12, ('other', 'INFO'): 48}
+    assert skipped == 0
+    counts, skipped = count_by(tmp_path, by=('time', 'module'), channel='app', level='ERROR', until=119)
+    assert counts == {(0, 'mod0'): 4, (0, 'mod1'): 4, (0, 'mod2'): 4, (60, 'mod0'): 4, (60, 'mod1'): 4, (60, 'mod2'): 4}
+    assert skipped == 4
+    counts, _ = count_by(tmp_path, by=(), module='mod1', since=590)
+    assert counts == {(): 3}
+
+
+def test_archive_writer_out_of_range(tmp_path):
+    from pyzog.compact import ArchiveWriter
+
+    writer = ArchiveWriter(tmp_path.joinpath('a.pzc'), 'a', codec='zlib')
+    assert writer.add_line(b'{"created": 1, "levelno": 100000, "message": "x"}') is False
+    assert writer.add_line(b'{"created": 1, "levelno": 20, "lineno": 4294967296, "message": "x"}') is False
+    assert writer.add_line(b'{"created": 2, "levelno": 20, "lineno": 3, "message": "ok"}') is True
+    # 超出范围的行不会写入任何一列
+    assert writer.skipped == 2
+    assert all(len(column) == 1 for column in writer.columns.values())
+    writer.close()
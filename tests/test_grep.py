@@ -0,0 +1,60 @@
+import gzip
+import json
+
+from pyzog.grep import grep
+
+
+def test_grep_chunks(tmp_path):
+    lines = [b'line %d %s' % (i, b'ERROR' if i % 7 == 0 else b'INFO') for i in range(200)]
+    tmp_path.joinpath('app.log').write_bytes(b'\n'.join(lines) + b'\n')
+    segment = tmp_path.joinpath('app.log.20200101-000000.gz')
+    segment.write_bytes(gzip.compress(b'old ERROR\nold INFO\n'))
+    tmp_path.joinpath('other.log').write_bytes(b'other ERROR\n')
+
+    expected = [b'old ERROR'] + [line for line in lines if b'ERROR' in line]
+    # chunk_size 很小，边界落在行中间
+    for workers in (1, 2):
+        result = list(grep(tmp_path, 'ERROR', channel='app', workers=workers, chunk_size=100))
+        assert [p.name for p, _, _ in result] == ['app.log.20200101-000000.gz', 'app.log']
+        assert [line for _, _, matched in result for line in matched] == expected
+    counts = {p.name: n for p, n, _ in grep(tmp_path, 'error', ignore_case=True, count_only=True, workers=1)}
+    assert counts == {'app.log.20200101-000000.gz': 1, 'app.log': 29, 'other.log': 1}
+
+
+def test_grep_json_field(tmp_path):
+    records = [{'levelname': level, 'message': 'ERROR in message'} for level in ('INFO', 'ERROR', 'INFO')]
+    tmp_path.joinpath('app.log').write_text('\n'.join(json.dumps(r) for r in records) + '\nnot json\n')
+    result = list(grep(tmp_path, '^ERROR$', field='levelname', workers=1))
+    assert [json.loads(line)['levelname'] for line in result[0][2]] == ['ERROR']
+
+
+def test_grep_bounded_chunks(tmp_path):
+    from pyzog.grep import Matcher, make_tasks, scan_buffer
+
+    lines = [b'line %06d INFO' % i for i in range(20000)]
+    lines[3] = b'line 000003 ERROR'
+    data = b'\n'.join(lines) + b'\n'
+    path = tmp_path.joinpath('app.log')
+    path.write_bytes(data)
+    result = list(grep(tmp_path, 'ERROR', workers=2, chunk_size=4096))
+    assert result[0][2] == [b'line 000003 ERROR']
+
+    class Regex(object):
+        """ 记录每次搜索的范围
+        """
+        def __init__(self, regex):
+            self.regex = regex
+            self.endpos = []
+
+        def search(self, buf, pos, endpos=None):
+            self.endpos.append(len(buf) if endpos is None else endpos)
+            return self.regex.search(buf, pos, len(buf) if endpos is None else endpos)
+
+    tasks = make_tasks([(path, 0)], 4096)
+    assert len(tasks) > 50
+    for _, start, end in tasks:
+        matcher = Matcher('ERROR')
+        matcher.regex = Regex(matcher.regex)
+        scan_buffer(data, start, end, matcher, False)
+        # 没有匹配的任务不会扫描到下一行之后
+        assert max(matcher.regex.endpos) <= end + len(lines[0])
@@ -0,0 +1,301 @@
+import logging
+
+import zmq
+
+from pyzog.logging import RedisHandler, ZeroMQHandler
+
+
+class FakePipeline(object):
+    def __init__(self, published):
+        self.published = published
+        self.pending = []
+
+    def publish(self, channel, msg):
+        self.pending.append((channel, msg))
+
+    def execute(self):
+        self.published.append(self.pending)
+
+
+class FakeRedis(object):
+    def __init__(self):
+        self.published = []
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self.published)
+
+
+def make_record(msg):
+    return logging.LogRecord('pyzog.test', logging.INFO, __file__, 1, msg, None, None)
+
+
+def stop_thread(hdr):
+    hdr.queue.put(hdr._STOP)
+    hdr.thread.join()
+
+
+def test_redis_handler_async_batch():
+    hdr = RedisHandler('redis://localhost:6379/0', 'pyzog.test', async_=True, batch_size=3, flush_interval=0.05)
+    hdr.r = FakeRedis()
+    for i in range(7):
+        hdr.handle(make_record('msg%s' % i))
+    hdr.close()
+    msgs = [msg for batch in hdr.r.published for _, msg in batch]
+    assert msgs == ['msg%s' % i for i in range(7)]
+    assert max(len(batch) for batch in hdr.r.published) <= 3
+    assert hdr.get_stats()['sent'] == 7
+
+
+def test_redis_handler_overflow():
+    hdr = RedisHandler('redis://localhost:6379/0', 'pyzog.test', async_=True, queue_size=2, overflow='drop_newest')
+    # 先停止后台线程，队列中的 record 不会被消费
+    stop_thread(hdr)
+    for i in range(3):
+        hdr.enqueue(make_record('msg%s' % i))
+    assert hdr.dropped_newest == 1
+    assert [r.msg for r in hdr.queue.queue] == ['msg0', 'msg1']
+
+    hdr = RedisHandler('redis://localhost:6379/0', 'pyzog.test', async_=True, queue_size=2, overflow='drop_oldest')
+    stop_thread(hdr)
+    for i in range(3):
+        hdr.enqueue(make_record('msg%s' % i))
+    assert hdr.dropped_oldest == 1
+    assert [r.msg for r in hdr.queue.queue] == ['msg1', 'msg2']
+
+    # close 时后台线程已经退出，队列中剩余的 record 计入 failed；之后 block 策略也不会阻塞
+    hdr = RedisHandler('redis://localhost:6379/0', 'pyzog.test', async_=True, queue_size=2, overflow='block')
+    stop_thread(hdr)
+    for i in range(2):
+        hdr.enqueue(make_record('msg%s' % i))
+    hdr.close()
+    hdr.handle(make_record('late'))
+    stats = hdr.get_stats()
+    assert stats['failed'] == 2 and stats['dropped_closed'] == 1 and stats['queued'] == 0
+
+
+def test_zmq_handler_policy():
+    # PUSH socket 的对端不存在，超过 SNDHWM 后 NOBLOCK 发送会得到 zmq.Again
+    hdr = ZeroMQHandler('tcp://127.0.0.1:5999', socket_type=zmq.PUSH, sndhwm=1, linger=0, policy='drop')
+    for i in range(5):
+        hdr.handle(make_record('msg%s' % i))
+    stats = hdr.get_stats()
+    assert stats['dropped'] > 0
+    assert stats['sent'] + stats['dropped'] == 5
+
+    hdr = ZeroMQHandler('tcp://127.0.0.1:5999', socket_type=zmq.PUSH, sndhwm=1, linger=0, policy='spool', spool_size=2)
+    for i in range(5):
+        hdr.handle(make_record('msg%s' % i))
+    assert len(hdr.spool) == 2
+    assert hdr.spool[-1] == [b'pyzog.test', b'msg4']
+
+
+def test_fast_json_formatter():
+    import json
+    import sys
+    from pythonjsonlogger import jsonlogger
+    from pyzog.formatter import FastJsonFormatter, JSON_ENCODERS
+    from pyzog.logging import JSON_LOG_FORMAT
+    origin = jsonlogger.JsonFormatter(JSON_LOG_FORMAT, timestamp=False)
+    try:
+        raise ValueError('boom')
+    except ValueError:
+        exc_info = sys.exc_info()
+    records = [
+        make_record('hi ü'),
+        logging.LogRecord('a', logging.ERROR, '/a/b.py', 3, 'failed %s', ('x',), exc_info, func='f'),
+        logging.LogRecord('a', logging.INFO, '/a/b.py', 3, {'k': 1, 'n': [1, 2]}, None, None),
+    ]
+    records[0].user = 'zrong'
+    records[0]._private = 1
+    for record in records:
+        expected = origin.format(record)
+        assert FastJsonFormatter(JSON_LOG_FORMAT, encoder='json').format(record) == expected
+        # 默认的输出与 json.dumps 逐字节相同
+        output = FastJsonFormatter(JSON_LOG_FORMAT).format(record)
+        assert output == expected
+        assert output == json.dumps(json.loads(output))
+        for encoder in JSON_ENCODERS:
+            try:
+                formatter = FastJsonFormatter(JSON_LOG_FORMAT, encoder=encoder)
+            except ImportError:
+                continue
+            assert json.loads(formatter.format(record)) == json.loads(expected)
+
+
+def test_throttle_filter():
+    from pyzog.filter import ThrottleFilter
+
+    class ListHandler(logging.Handler):
+        def __init__(self):
+            logging.Handler.__init__(self)
+            self.records = []
+
+        def emit(self, record):
+            self.records.append(record)
+
+    hdr = ListHandler()
+    throttle = ThrottleFilter(hdr, rate_limit={'ERROR': 1}, rate_burst=5, sample={'DEBUG': 0}, dedup_window=60)
+    hdr.addFilter(throttle)
+    for i in range(10):
+        hdr.handle(make_record('same'))
+    for i in range(10):
+        record = make_record('error %s' % i)
+        record.levelno = logging.ERROR
+        hdr.handle(record)
+    debug = make_record('debug')
+    debug.levelno = logging.DEBUG
+    hdr.handle(debug)
+    throttle.flush()
+    messages = [r.getMessage() for r in hdr.records]
+    assert messages[0] == 'same'
+    assert messages[1:6] == ['error %s' % i for i in range(5)]
+    assert messages[6].startswith('same (repeated 9 times')
+    assert throttle.get_stats() == {'rate_limited': 5, 'sampled_out': 1, 'deduplicated': 9, 'summaries': 1}
+    assert throttle.timer is None
+
+    # 没有新的日志时，窗口结束后由定时器补发汇总日志
+    import time
+    hdr = ListHandler()
+    throttle = ThrottleFilter(hdr, dedup_window=0.05)
+    hdr.addFilter(throttle)
+    for i in range(3):
+        hdr.handle(make_record('same'))
+    deadline = time.time() + 5
+    while len(hdr.records) < 2 and time.time() < deadline:
+        time.sleep(0.01)
+    assert hdr.records[1].getMessage().startswith('same (repeated 2 times')
+    assert throttle.timer is None
+
+
+def test_disk_spool(tmp_path):
+    from pyzog.spool import DiskSpool
+    spool = DiskSpool(tmp_path / 'a.spool', capacity=64)
+    for i in range(10):
+        spool.append('t', 'msg%s' % i)
+    # 每条 12 字节，只能保存 5 条，旧的被覆盖
+    assert len(spool) == 5
+    assert spool.dropped == 5
+    items = spool.peek(2)
+    assert [payload for _, payload, _ in items] == [b'msg5', b'msg6']
+    spool.commit(items[-1][2])
+    spool.close()
+
+    spool = DiskSpool(tmp_path / 'a.spool', capacity=64)
+    assert [payload for _, payload, _ in spool.peek()] == [b'msg7', b'msg8', b'msg9']
+    # peek 之后被覆盖的日志不会在 commit 时重复扣除
+    items = spool.peek(2)
+    for i in range(10, 13):
+        spool.append('t', 'msg%s' % i)
+    spool.commit(items[-1][2])
+    assert [payload for _, payload, _ in spool.peek()] == [b'msg9', b'msg10', b'msg11', b'msg12']
+    assert len(spool) == 4
+    spool.close()
+
+
+def test_zmq_handler_disk_monitor(tmp_path):
+    import time
+    ctx = zmq.Context()
+    push = ctx.socket(zmq.PUSH)
+    hdr = ZeroMQHandler(push, policy='disk', spool_path=tmp_path / 'zmq.spool')
+    # 传入的 socket 也跟踪连接状态
+    assert hdr.monitor is not None and not hdr.update_peers()
+    pull = ctx.socket(zmq.PULL)
+    port = pull.bind_to_random_port('tcp://127.0.0.1')
+    push.connect('tcp://127.0.0.1:%s' % port)
+    deadline = time.time() + 5
+    while not hdr.update_peers() and time.time() < deadline:
+        time.sleep(0.01)
+    assert hdr.peers == 1
+    hdr.close()
+    push.close(0)
+    pull.close(0)
+    ctx.term()
+
+
+def test_redis_handler_disk_spool(tmp_path):
+    import time
+    import redis
+
+    class BrokenRedis(object):
+        def publish(self, channel, msg):
+            raise redis.ConnectionError('down')
+
+    hdr = RedisHandler('redis://localhost:6379/0', 'pyzog.test', spool_path=tmp_path / 'redis.spool', replay_rate=0)
+    hdr.replayer.retry_interval = 0.05
+    hdr.r = BrokenRedis()
+    for i in range(5):
+        hdr.handle(make_record('msg%s' % i))
+    assert hdr.get_stats()['disk_spooled'] == 5
+    hdr.r = FakeRedis()
+    hdr.replayer.notify()
+    deadline = time.time() + 5
+    while len(hdr.disk_spool) and time.time() < deadline:
+        time.sleep(0.01)
+    hdr.close()
+    msgs = [msg for batch in hdr.r.published for _, msg in batch]
+    assert msgs == [('msg%s' % i).encode() for i in range(5)]
+    assert hdr.get_stats()['replayed'] == 5
+
+
+def test_get_logger_shared(tmp_path):
+    from pyzog.logging import get_logger, get_zmq_context, close_all
+
+    a = get_logger('pyzog.shared.a', target='tcp://127.0.0.1:5998', type_='zmq', fmt='raw', linger=0)
+    get_logger('pyzog.shared.a', target='tcp://127.0.0.1:5998', type_='zmq', fmt='raw', linger=0)
+    b = get_logger('pyzog.shared.b', target='tcp://127.0.0.1:5998', type_='zmq', fmt='raw', linger=0)
+    assert len(a.handlers) == 1
+    # 同一个地址的所有 logger 共享一个 socket
+    hdr = a.handlers[0]
+    assert b.handlers == [hdr]
+    assert hdr.ctx is get_zmq_context()
+    # 参数改变时替换原来的 handler
+    get_logger('pyzog.shared.a', target='tcp://127.0.0.1:5998', type_='zmq', fmt='text', linger=0)
+    assert len(a.handlers) == 1 and a.handlers[0] is not hdr
+    # 被替换的 handler 在最后一个 logger 不再使用时关闭
+    get_logger('pyzog.shared.b', target='tcp://127.0.0.1:5998', type_='zmq', fmt='text', linger=0)
+    assert b.handlers == a.handlers
+    assert hdr.socket.closed
+    hdr = a.handlers[0]
+    # 同一个 url 共享连接池
+    assert RedisHandler('redis://localhost:6379/1', 'a').r is RedisHandler('redis://localhost:6379/1', 'b').r
+    f = get_logger('pyzog.shared.f', target=tmp_path, type_='file')
+    get_logger('pyzog.shared.f', target=str(tmp_path), type_='file')
+    assert len(f.handlers) == 1
+    close_all()
+    assert a.handlers == [] and b.handlers == [] and f.handlers == []
+    assert hdr.socket.closed
+
+
+def test_zmq_handler_pub_backpressure():
+    # XPUB_NODROP 让 SUB 端阻塞时返回 zmq.Again，dropped 计数准确
+    ctx = zmq.Context()
+    xpub = ctx.socket(zmq.XPUB)
+    hdr = ZeroMQHandler(xpub, sndhwm=1, linger=0, policy='drop')
+    xpub.bind('inproc://pyzog.test.pub')
+    sub = ctx.socket(zmq.SUB)
+    sub.setsockopt(zmq.RCVHWM, 1)
+    sub.setsockopt(zmq.SUBSCRIBE, b'')
+    sub.connect('inproc://pyzog.test.pub')
+    # 等待订阅到达 XPUB
+    assert xpub.poll(1000)
+    for i in range(10):
+        hdr.handle(make_record('msg%s' % i))
+    stats = hdr.get_stats()
+    assert stats['dropped'] > 0
+    assert stats['sent'] + stats['dropped'] == 10
+    sub.close(0)
+    xpub.close(0)
+    ctx.term()
+
+    # 默认的 PUB 实际创建 XPUB；传入的 PUB 不能使用依赖 zmq.Again 的策略
+    hdr = ZeroMQHandler('inproc://pyzog.test.pub2', linger=0)
+    assert hdr.socket.type == zmq.XPUB
+    hdr.close()
+    pub = zmq.Context.instance().socket(zmq.PUB)
+    try:
+        ZeroMQHandler(pub, policy='spool')
+        assert False
+    except TypeError:
+        pass
+    finally:
+        pub.close(0)
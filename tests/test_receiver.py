@@ -2,4 +2,218 @@ import pytest
 
 
 def test_receiverstart(receiver):
-    assert True
\ No newline at end of file
+    assert True
+
+def test_zmq_receiver_route(tmp_path):
+    import zmq
+    from pyzog.receiver import ZeroMQReceiver
+
+    r = ZeroMQReceiver(tmp_path, 'tcp://127.0.0.1', 5011, channels=['app.*', 'req.?'])
+    assert r.get_prefix('app.*') == 'app.'
+    assert r.match('app.user')
+    assert r.match('req.a')
+    assert not r.match('req.ab')
+    r.on_receive([zmq.Frame(b'app.user'), zmq.Frame(b'hello')])
+    r.on_receive([zmq.Frame(b'req.ab'), zmq.Frame(b'dropped')])
+    r.writers.flush()
+    assert tmp_path.joinpath('app.user.log').read_text() == 'hello\n'
+    assert not tmp_path.joinpath('req.ab.log').exists()
+
+    # 完整名称只匹配自身，不能当作前缀
+    r = ZeroMQReceiver(tmp_path, 'tcp://127.0.0.1', 5011, channels=['pyzog.app', 'web.*'])
+    assert r.match('pyzog.app')
+    assert not r.match('pyzog.application')
+    assert r.match('web.user')
+
+    # PULL 没有订阅，prefix* 也需要在 python 中匹配
+    from pyzog.receiver import ZeroMQSource
+    r = ZeroMQReceiver(tmp_path, 'tcp://127.0.0.1', 5011, socket_type=zmq.PULL, channels=['app.*'])
+    assert r.match('app.user')
+    assert not r.match('web.user')
+    source = ZeroMQSource('zmq-a', 'tcp://127.0.0.1', 5011, socket_type=zmq.PULL, channels=['app.*', 'pyzog.app'])
+    assert source.match('app.user') and source.match('pyzog.app')
+    assert not source.match('web.user') and not source.match('pyzog.application')
+    assert ZeroMQSource('zmq-b', 'tcp://127.0.0.1', 5011, socket_type=zmq.PULL).match('web.user')
+
+
+def test_zmq_receiver_asyncio(tmp_path):
+    import threading
+    import time
+    import zmq
+    from pyzog.receiver import ZeroMQReceiver
+
+    r = ZeroMQReceiver(tmp_path, 'tcp://127.0.0.1', 5012, channels=['app.*'], get_message_type='asyncio', buffer_size=0)
+    threading.Thread(target=r.start, daemon=True).start()
+    sock = zmq.Context.instance().socket(zmq.PUB)
+    sock.connect('tcp://127.0.0.1:5012')
+    logfile = tmp_path.joinpath('app.async.log')
+    for i in range(50):
+        sock.send_multipart([b'app.async', b'msg'])
+        sock.send_multipart([b'other', b'msg'])
+        time.sleep(0.02)
+        if logfile.exists() and logfile.read_bytes():
+            break
+    sock.close(0)
+    assert logfile.read_bytes().startswith(b'msg\n')
+    assert not tmp_path.joinpath('other.log').exists()
+
+
+def test_redis_stream_receiver_ack(tmp_path):
+    from pyzog.receiver import RedisStreamReceiver
+
+    class FakePipeline(object):
+        def __init__(self, acks):
+            self.acks = acks
+
+        def xack(self, name, group, *ids):
+            # 确认之前数据必须已经写入文件
+            assert tmp_path.joinpath(name + '.log').read_bytes() == b'm1\nm2\n'
+            self.acks.append((name, group, ids))
+
+        def execute(self):
+            pass
+
+    class FakeRedis(object):
+        acks = []
+
+        def pipeline(self, transaction=True):
+            return FakePipeline(self.acks)
+
+    r = RedisStreamReceiver(tmp_path, channels=['app'], group='g')
+    r.r = FakeRedis()
+    r.on_receive([(b'app', [(b'1-0', {b'data': b'm1'}), (b'2-0', {b'data': b'm2'}), (b'3-0', None)])])
+    assert r.r.acks == [('app', 'g', (b'1-0', b'2-0', b'3-0'))]
+    assert r.get_stats()['acked'] == 3
+
+
+def test_receiver_msgpack(tmp_path):
+    import json
+    import logging
+    msgpack = pytest.importorskip('msgpack')
+    from pyzog.formatter import MsgpackFormatter
+    from pyzog.receiver import Receiver
+
+    record = logging.LogRecord('app', logging.WARNING, __file__, 10, 'hello %s', ('world',), None)
+    data = MsgpackFormatter().format(record)
+    assert isinstance(data, bytes)
+
+    r = Receiver(tmp_path.joinpath('json'))
+    r.write('app', data)
+    r.close()
+    obj = json.loads(tmp_path.joinpath('json', 'app.log').read_text())
+    assert obj['message'] == 'hello world'
+    assert obj['levelname'] == 'WARNING'
+    assert obj['lineno'] == 10
+
+    r = Receiver(tmp_path.joinpath('text'), msgpack_render='text')
+    r.write('app', data)
+    r.close()
+    assert 'WARNING in test_receiver' in tmp_path.joinpath('text', 'app.log').read_text()
+
+    r = Receiver(tmp_path.joinpath('raw'), msgpack_render='raw')
+    r.write('app', data)
+    r.write('app', data)
+    r.close()
+    unpacker = msgpack.Unpacker()
+    unpacker.feed(tmp_path.joinpath('raw', 'app.msgpack').read_bytes())
+    assert [obj[-1] for obj in unpacker] == ['hello world', 'hello world']
+
+    # 损坏的数据被跳过并计数，接收器继续工作
+    r = Receiver(tmp_path.joinpath('bad'))
+    r.write('app', b'\xc1\xff\x00garbage')
+    r.write('app', b'\xc1' + msgpack.packb(1))
+    r.write('app', data)
+    r.close()
+    assert len(tmp_path.joinpath('bad', 'app.log').read_text().splitlines()) == 1
+    assert r.get_stats()['decode_errors'] == 2
+
+
+def test_redis_receiver_poll(tmp_path):
+    from pyzog.receiver import RedisReceiver
+
+    class FakePubSub(object):
+        def __init__(self, messages):
+            self.messages = messages
+            self.timeouts = []
+
+        def psubscribe(self, *channels):
+            pass
+
+        def check_health(self):
+            pass
+
+        def get_message(self, timeout=0.0):
+            self.timeouts.append(timeout)
+            if not self.messages:
+                raise KeyboardInterrupt()
+            return self.messages.pop(0)
+
+    r = RedisReceiver(tmp_path, channels=['app.*'], buffer_size=0)
+    msgs = [{'type': 'pmessage', 'channel': b'app.a', 'data': b'msg%d' % i} for i in range(3)]
+    r.pub = FakePubSub(msgs[:2] + [None] + msgs[2:] + [None])
+    with pytest.raises(KeyboardInterrupt):
+        r.sub_poll()
+    assert tmp_path.joinpath('app.a.log').read_text() == 'msg0\nmsg1\nmsg2\n'
+    # 每次唤醒之后使用 timeout=0 取出所有消息，然后再阻塞等待
+    assert r.pub.timeouts == [1.0, 0, 0, 1.0, 0, 1.0]
+    assert r.poll_wakeups == 2
+    assert r.get_stats()['poll_wakeups'] == 2
+
+
+def test_multi_receiver(tmp_path):
+    import socket
+    import time
+    import zmq
+    from pyzog.receiver import MultiReceiver, ZeroMQSource, RedisSource
+
+    # redis 的连接使用 socketpair 代替，写入一个字节让 fd 一直可读
+    rsock, wsock = socket.socketpair()
+    wsock.send(b'x')
+
+    class FakeConnection(object):
+        _sock = rsock
+
+        def can_read(self, timeout=0):
+            return False
+
+    class FakePubSub(object):
+        connection = FakeConnection()
+
+        def __init__(self, messages):
+            self.messages = messages
+            self.deadline = time.time() + 5
+
+        def get_message(self, timeout=0.0):
+            if self.messages:
+                return self.messages.pop(0)
+            if r.stats.channels.get('app.z', [0])[0] == 3 or time.time() > self.deadline:
+                raise KeyboardInterrupt()
+            return None
+
+        def check_health(self):
+            pass
+
+        def close(self):
+            pass
+
+    zsource = ZeroMQSource('zmq-a', 'tcp://127.0.0.1', 5013, socket_type=zmq.PULL)
+    rsource = RedisSource('redis-b', channels=['app.*'])
+    rsource.open = lambda receiver, ctx: None
+    r = MultiReceiver(tmp_path, [zsource, rsource], buffer_size=0)
+    r.open()
+    rsource.pub = FakePubSub([{'type': 'pmessage', 'channel': b'app.r', 'data': b'msg%d' % i} for i in range(2)])
+    push = r.ctx.socket(zmq.PUSH)
+    push.connect('tcp://127.0.0.1:5013')
+    for i in range(3):
+        push.send_multipart([b'app.z', b'msg%d' % i])
+    with pytest.raises(KeyboardInterrupt):
+        r.poll_sources()
+    push.close(0)
+    r.close()
+    rsock.close()
+    wsock.close()
+    assert tmp_path.joinpath('app.z.log').read_text() == 'msg0\nmsg1\nmsg2\n'
+    assert tmp_path.joinpath('app.r.log').read_text() == 'msg0\nmsg1\n'
+    stats = r.get_stats()
+    assert stats['source_zmq_a_received'] == 3
+    assert stats['source_redis_b_received'] == 2
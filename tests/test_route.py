@@ -0,0 +1,68 @@
+import configparser
+import json
+
+import pytest
+
+from pyzog.route import Rule, Router, Predicate
+from pyzog.cli import create_routes
+
+
+def make_line(**kwargs):
+    return json.dumps(kwargs).encode()
+
+
+def test_router():
+    router = Router([
+        Rule('errors', channels=['app.*'], level='WARNING', to=['{channel}.error'], continue_=True),
+        Rule('http', channels=['http.?'], match=['status >= 500', 'req.path ~ ^/api/'], to=['http.5xx', '{channel}']),
+        Rule('debug', max_level='DEBUG', drop=True),
+        Rule('audit', channels=['audit'], to=['audit.all']),
+    ])
+    assert router.route('app.a', make_line(levelname='ERROR')) == ['app.a.error', 'app.a']
+    assert router.route('app.a', make_line(levelname='INFO')) == ['app.a']
+    assert router.route('app.a', make_line(levelname='DEBUG')) == []
+    assert router.route('http.a', make_line(levelname='INFO', status=502, req={'path': '/api/x'})) == ['http.5xx', 'http.a']
+    assert router.route('http.a', make_line(levelname='INFO', status=200, req={'path': '/api/x'})) == ['http.a']
+    # 不是 JSON 的日志不匹配需要解析的规则
+    assert router.route('http.ab', b'plain text') == ['http.ab']
+    assert router.route('audit', b'x') == ['audit.all']
+    assert router.route('auditx', b'x') == ['auditx']
+    assert [r.name for r in router.get_rules('app.b')] == ['errors', 'debug']
+    stats = router.get_stats()
+    assert stats['route_dropped'] == 1
+    assert stats['route_errors_matched'] == 1
+    assert Predicate('user.id != 3').match({'user': {'id': 4}})
+    assert not Predicate('count > 1').match({'count': 'x'})
+    with pytest.raises(ValueError):
+        Rule('bad', to=['{name}'])
+    with pytest.raises(ValueError):
+        Rule('bad')
+
+
+def test_receiver_route(tmp_path):
+    from pyzog.receiver import ZeroMQReceiver
+
+    conf = configparser.ConfigParser(inline_comment_prefixes=('#', ';'))
+    conf.read_string('''
+[pyzog]
+logpath=%s
+
+[route:errors]
+level=ERROR
+to={channel}.error
+continue=true
+
+[route:noise]
+channels=app.noise
+drop=true
+''' % tmp_path)
+    routes = create_routes(conf)
+    r = ZeroMQReceiver(tmp_path, 'tcp://127.0.0.1', 5014, routes=routes, buffer_size=0)
+    r.write('app.a', make_line(levelname='ERROR', message='boom'))
+    r.write('app.a', make_line(levelname='INFO', message='ok'))
+    r.write('app.noise', b'dropped')
+    r.close()
+    assert tmp_path.joinpath('app.a.log').read_bytes().count(b'\n') == 2
+    assert b'boom' in tmp_path.joinpath('app.a.error.log').read_bytes()
+    assert not tmp_path.joinpath('app.noise.log').exists()
+    assert r.get_stats()['route_dropped'] == 1
@@ -0,0 +1,85 @@
+import logging
+
+from pyzog.logging import RedisHandler
+from pyzog.receiver import ZeroMQReceiver
+from pyzog.seq import SequenceStamper, SequenceTracker, split_envelope
+
+
+def test_sequence_tracker():
+    stamper = SequenceStamper()
+    msgs = [stamper.stamp('app', 'msg%d' % i) for i in range(10)]
+    assert split_envelope(msgs[0])[1:] == (1, b'msg0')
+    tracker = SequenceTracker()
+    # msg2、msg3、msg6 丢失，之后 msg6 乱序到达，msg4 重复
+    for i in (0, 1, 4, 5, 7, 4, 8, 9):
+        assert tracker.feed('app', msgs[i]) == b'msg%d' % i
+    assert tracker.feed('app', msgs[6]) == b'msg6'
+    stats = tracker.get_stats()
+    assert stats['seq_received'] == 9
+    assert stats['seq_lost'] == 2
+    assert stats['seq_gaps'] == 2
+    assert stats['seq_duplicates'] == 1
+    assert stats['seq_reordered'] == 1
+    assert stats['seq_app_loss_rate'] == 2 / 11
+    # 另一个发送端单独计算序号
+    other = SequenceStamper()
+    tracker.feed('app', other.stamp('app', 'x'))
+    assert tracker.get_stats()['seq_senders'] == 2
+    assert tracker.get_stats()['seq_lost'] == 2
+
+
+def test_sequence_tracker_concurrent():
+    import threading
+
+    tracker = SequenceTracker()
+    stamper = SequenceStamper()
+    stopped = threading.Event()
+
+    def receive():
+        for i in range(5000):
+            if stopped.is_set():
+                break
+            tracker.feed('ch%d' % i, stamper.stamp('ch%d' % i, 'x'))
+
+    t = threading.Thread(target=receive)
+    t.start()
+    try:
+        # 统计线程读取时接收线程不断加入新的 channel
+        for _ in range(50):
+            tracker.get_stats()
+    finally:
+        stopped.set()
+        t.join()
+    assert tracker.get_stats()['seq_received'] == len(tracker.channels)
+
+
+def test_is_sequenced():
+    from pyzog.seq import MAGIC, HEADER, is_sequenced
+
+    # 以 MAGIC 开头但是长度不足的日志不是带信封的日志
+    assert not is_sequenced(MAGIC + b'short')
+    assert is_sequenced(SequenceStamper().stamp('app', b''))
+    assert len(SequenceStamper().stamp('app', b'')) == HEADER.size
+
+
+def test_receiver_sequence(tmp_path):
+    published = []
+
+    class FakeRedis(object):
+        def publish(self, channel, msg):
+            published.append((channel, msg))
+
+    hdr = RedisHandler('redis://localhost:6379/0', 'app.seq', sequence=True)
+    hdr.r = FakeRedis()
+    hdr.setFormatter(logging.Formatter())
+    for i in range(5):
+        hdr.handle(logging.LogRecord('app', logging.INFO, __file__, 1, 'msg%d' % i, None, None))
+    r = ZeroMQReceiver(tmp_path, 'tcp://127.0.0.1', 5016, buffer_size=0)
+    for i, (channel, msg) in enumerate(published):
+        if i != 2:
+            r.write(channel, msg)
+    r.close()
+    assert tmp_path.joinpath('app.seq.log').read_text().split() == ['msg0', 'msg1', 'msg3', 'msg4']
+    stats = r.get_stats()
+    assert stats['seq_lost'] == 1
+    assert stats['seq_loss_rate'] == 0.2
@@ -0,0 +1,24 @@
+import pytest
+
+from pyzog.shard import assign_channels
+
+
+def test_assign_channels():
+    channels = ['app%s.*' % i for i in range(100)]
+    shards = assign_channels(channels, 4)
+    assert sorted(ch for shard in shards for ch in shard) == sorted(channels)
+    assert all(shards)
+    # 一致性哈希：增加一个 worker 后，原有分配中只有一部分 channel 发生迁移
+    owner = {ch: i for i, shard in enumerate(shards) for ch in shard}
+    new_owner = {ch: i for i, shard in enumerate(assign_channels(channels, 5)) for ch in shard}
+    moved = [ch for ch in channels if owner[ch] != new_owner[ch]]
+    assert all(new_owner[ch] == 4 for ch in moved)
+    assert len(moved) < 50
+
+
+def test_assign_channels_small():
+    # 每个子进程都会分到 channel，workers 大于 channels 的数量时报错
+    shards = assign_channels(['a.*', 'b.*', 'c.*'], 3)
+    assert sorted(len(shard) for shard in shards) == [1, 1, 1]
+    with pytest.raises(ValueError):
+        assign_channels(['pyzog.*'], 4)
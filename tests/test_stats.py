@@ -0,0 +1,75 @@
+import json
+from urllib.request import urlopen
+
+from pyzog.receiver import Receiver
+
+
+def test_receiver_stats(tmp_path):
+    stats_file = tmp_path.joinpath('stats.json')
+    r = Receiver(tmp_path.joinpath('logs'), stats_addr='127.0.0.1:9118', stats_file=stats_file)
+    r.start_background()
+    r.write('app', b'hello')
+    r.write('app', b'world')
+    r.write('req', b'x')
+    text = urlopen('http://127.0.0.1:9118/metrics').read().decode()
+    assert 'pyzog_messages_total{channel="app"} 2' in text
+    assert 'pyzog_bytes_total{channel="req"} 1' in text
+    assert 'pyzog_write_seconds_count 3' in text
+    assert 'pyzog_open_files 2' in text
+    r.close()
+    stats = json.loads(stats_file.read_text())
+    assert stats['summary']['messages'] == 3
+    assert stats['channels']['app'] == {'messages': 2, 'bytes': 10}
+
+
+def test_stats_concurrent(tmp_path):
+    import threading
+    import time
+    from pyzog.stats import Stats, StatsExporter, render_prometheus
+
+    stats = Stats()
+    stopped = threading.Event()
+
+    def receive():
+        for i in range(5000):
+            if stopped.is_set():
+                break
+            stats.on_message('ch%d' % i, 1, 0.0)
+
+    t = threading.Thread(target=receive)
+    t.start()
+    try:
+        for _ in range(50):
+            render_prometheus(stats)
+            stats.to_dict()
+    finally:
+        stopped.set()
+        t.join()
+
+    # 输出出错时写入线程继续运行
+    calls = []
+
+    def render_json():
+        calls.append(1)
+        if len(calls) == 1:
+            raise RuntimeError('boom')
+        return {'ok': True}
+
+    stats_file = tmp_path.joinpath('stats.json')
+    exporter = StatsExporter(lambda: '', render_json, stats_file=stats_file, interval=0.01)
+    exporter.start()
+    deadline = time.time() + 5
+    while not stats_file.exists() and time.time() < deadline:
+        time.sleep(0.01)
+    exporter.stop()
+    assert exporter.errors == 1
+    assert json.loads(stats_file.read_text()) == {'ok': True}
+
+    # stop 时写入出错只记录，不抛出
+    exporter = StatsExporter(lambda: '', lambda: 1 / 0, stats_file=stats_file, interval=60)
+    exporter.stop()
+    assert exporter.errors == 1
+
+    # extra 中的数值也有 TYPE 行
+    text = render_prometheus(None, {'workers': 2, 'name': 'x'})
+    assert text == '# TYPE pyzog_workers gauge\npyzog_workers 2\n'
@@ -0,0 +1,243 @@
+from pyzog.writer import WriterManager
+
+
+def test_writer_buffer(tmp_path):
+    wm = WriterManager(tmp_path, buffer_size=16, flush_interval=10)
+    wm.write('app', b'hello')
+    logfile = tmp_path.joinpath('app.log')
+    assert logfile.read_bytes() == b''
+    wm.write('app', b'0123456789')
+    assert logfile.read_bytes() == b'hello\n0123456789\n'
+    wm.write('app', b'tail')
+    wm.close()
+    assert logfile.read_bytes() == b'hello\n0123456789\ntail\n'
+
+
+def test_writer_rotate(tmp_path):
+    wm = WriterManager(tmp_path, buffer_size=0, rotate_check_interval=10)
+    wm.write('app', b'before')
+    logfile = tmp_path.joinpath('app.log')
+    rotated = tmp_path.joinpath('app.log.1')
+    logfile.rename(rotated)
+    # 还未到检查时间，继续写入被改名的文件
+    wm.write('app', b'still old')
+    wm.rotate_requested = True
+    wm.tick()
+    wm.write('app', b'after')
+    wm.close()
+    assert rotated.read_bytes() == b'before\nstill old\n'
+    assert logfile.read_bytes() == b'after\n'
+
+
+def test_writer_lru(tmp_path):
+    wm = WriterManager(tmp_path, buffer_size=1024, max_open_files=2)
+    wm.write('a', b'a1')
+    wm.write('b', b'b1')
+    wm.write('a', b'a2')
+    # b 是最久未使用的，会被关闭
+    wm.write('c', b'c1')
+    assert list(wm.writers) == ['a.log', 'c.log']
+    assert tmp_path.joinpath('b.log').read_bytes() == b'b1\n'
+    wm.write('b', b'b2')
+    assert wm.get_stats() == {'open_files': 2, 'hits': 1, 'misses': 4, 'evictions': 2}
+    wm.close()
+    assert tmp_path.joinpath('b.log').read_bytes() == b'b1\nb2\n'
+    assert tmp_path.joinpath('a.log').read_bytes() == b'a1\na2\n'
+
+
+def test_writer_rotate_compress(tmp_path):
+    import gzip
+    from pyzog.rotate import list_segments
+
+    wm = WriterManager(tmp_path, buffer_size=0, rotate_bytes=10, compress='gzip', backup_count=2)
+    for i in range(4):
+        wm.write('app', b'0123456789')
+    wm.write('app', b'active')
+    wm.close()
+    segments = list_segments(tmp_path.joinpath('app.log'))
+    assert len(segments) == 2
+    assert all(p.name.endswith('.gz') for p in segments)
+    assert gzip.decompress(segments[-1].read_bytes()) == b'0123456789\n'
+    assert tmp_path.joinpath('app.log').read_bytes() == b'active\n'
+
+    # 不压缩时不创建进程池，直接清理
+    wm = WriterManager(tmp_path, buffer_size=0, rotate_bytes=10, compress='none', backup_count=1)
+    for i in range(3):
+        wm.write('web', b'0123456789')
+    assert wm.rotator.pool is None
+    wm.close()
+    assert len(list_segments(tmp_path.joinpath('web.log'))) == 1
+
+
+def test_rotator_skip_empty_and_pending(tmp_path):
+    import time
+    from pyzog.rotate import Rotator, cleanup_segments, list_segments
+
+    # 按时间切分时，空文件不切分，只推迟下一次切分的时间
+    wm = WriterManager(tmp_path, buffer_size=0, rotate_interval=3600, compress='none')
+    wm.write('app', b'hello')
+    writer = wm.writers['app.log']
+    with writer.lock:
+        writer.rotate_ts = 0
+        assert wm.rotator.should_rotate(writer, time.time())
+        wm.rotator.rotate(writer)
+        assert writer.size == 0
+        writer.rotate_ts = 0
+        assert not wm.rotator.should_rotate(writer, time.time())
+        assert writer.rotate_ts > time.time()
+    wm.close()
+    assert len(list_segments(tmp_path.joinpath('app.log'))) == 1
+
+    # 等待压缩的 segment 不会被清理
+    path = tmp_path.joinpath('web.log')
+    for name in ('web.log.20240101-000000.gz', 'web.log.20240101-000001', 'web.log.20240101-000002.gz'):
+        tmp_path.joinpath(name).write_bytes(b'x')
+    removed = cleanup_segments(path, backup_count=1, pending=['web.log.20240101-000001'])
+    assert [p.name for p in removed] == ['web.log.20240101-000000.gz']
+    assert [p.name for p in list_segments(path)] == ['web.log.20240101-000001', 'web.log.20240101-000002.gz']
+
+    # 压缩失败时记录错误
+    rotator = Rotator(rotate_interval=3600, compress='gzip')
+    missing = tmp_path.joinpath('none.log.20240101-000000')
+    rotator.pending.add(missing.name)
+    rotator.on_processed(rotator_future(FileNotFoundError(str(missing))), tmp_path.joinpath('none.log'), missing)
+    assert rotator.errors == 1 and not rotator.pending
+
+
+def rotator_future(e):
+    from concurrent.futures import Future
+    f = Future()
+    f.set_exception(e)
+    return f
+
+
+def test_rotator_next_rotate_ts():
+    from pyzog.rotate import Rotator
+
+    rotator = Rotator(rotate_interval=3600)
+    now = 1700000000.0
+    ts = rotator.next_rotate_ts(now)
+    assert now < ts <= now + 3600
+    assert rotator.next_rotate_ts(ts) == ts + 3600
+
+
+def test_writer_time_index(tmp_path):
+    import gzip
+    import time
+    from pyzog.index import index_path, query_channel, query_file
+    from pyzog.rotate import list_segments
+
+    wm = WriterManager(tmp_path, buffer_size=0, index_every=2, index_interval=0, rotate_bytes=20, compress='none')
+    start = time.time()
+    for i in range(4):
+        wm.write('app', b'old%d' % i)
+    # 写入第 4 条之后达到 rotate_bytes
+    middle = time.time()
+    time.sleep(0.01)
+    for i in range(3):
+        wm.write('app', b'new%d' % i)
+    wm.close()
+    segment = list_segments(tmp_path.joinpath('app.log'))[0]
+    assert index_path(segment).exists()
+    assert b''.join(query_channel(tmp_path, 'app', start, time.time())) == b'old0\nold1\nold2\nold3\nnew0\nnew1\nnew2\n'
+    # 精度为一个采样间隔，segment 中最后一个索引项之后的日志也会被包括
+    assert b''.join(query_channel(tmp_path, 'app', middle + 0.005, time.time())) == b'old2\nold3\nnew0\nnew1\nnew2\n'
+
+    # 压缩后使用解压后的偏移
+    gz = segment.with_name(segment.name + '.gz')
+    gz.write_bytes(gzip.compress(segment.read_bytes()))
+    segment.unlink()
+    assert b''.join(query_file(gz, start, middle)) == b'old0\nold1\nold2\nold3\n'
+
+
+def test_writer_pool(tmp_path):
+    import threading
+    from pyzog.pool import WriterPool
+
+    gate = threading.Event()
+    written = []
+
+    def handle(name, data):
+        gate.wait()
+        written.append((name, data))
+
+    pool = WriterPool(handle, workers=2, queue_size=2, spill_bytes=8, overflow='drop')
+    pool.start()
+    results = [pool.submit('app.a', b'%d' % i) for i in range(10)]
+    # 写入线程被阻塞时：队列中 2 条，溢出 4 条（每个队列 4 字节），其余丢弃
+    assert results.count(False) >= 1
+    stats = pool.get_stats()
+    assert stats['write_spilled'] >= 1
+    assert stats['write_dropped'] == results.count(False)
+    gate.set()
+    assert pool.wait(5)
+    pool.close()
+    # 同一个 channel 保持顺序
+    assert [d for _, d in written] == [b'%d' % i for i, ok in enumerate(results) if ok]
+    assert pool.get_stats()['write_spill_bytes'] == 0
+
+
+def test_receiver_write_workers(tmp_path):
+    from pyzog.receiver import ZeroMQReceiver
+
+    r = ZeroMQReceiver(tmp_path, 'tcp://127.0.0.1', 5015, write_workers=3, buffer_size=0)
+    r.start_background()
+    for i in range(300):
+        r.write('app.%d' % (i % 3), b'msg%d' % i)
+    r.close()
+    for ch in range(3):
+        lines = tmp_path.joinpath('app.%d.log' % ch).read_text().split()
+        assert lines == ['msg%d' % i for i in range(ch, 300, 3)]
+    assert r.get_stats()['write_queue_high_water'] > 0
+
+
+def test_writer_evict_order(tmp_path, monkeypatch):
+    import threading
+    from pyzog.writer import FileWriter
+
+    wm = WriterManager(tmp_path, buffer_size=1 << 20, max_open_files=1)
+    wm.write('a', b'1')
+    close = FileWriter.close
+    closing, proceed = threading.Event(), threading.Event()
+
+    def slow_close(self):
+        if self.name == 'a' and not proceed.is_set():
+            closing.set()
+            proceed.wait(5)
+        close(self)
+
+    monkeypatch.setattr(FileWriter, 'close', slow_close)
+    # 写入 b 时移出 a，a 的关闭被阻塞
+    t1 = threading.Thread(target=wm.write, args=('b', b'x'))
+    t1.start()
+    assert closing.wait(5)
+    # a 关闭完成之前重新写入 a，不能先于旧的缓冲区写入磁盘
+    t2 = threading.Thread(target=wm.write, args=('a', b'2'))
+    t2.start()
+    t2.join(0.2)
+    wm.flush()
+    proceed.set()
+    t1.join()
+    t2.join()
+    wm.close()
+    assert tmp_path.joinpath('a.log').read_text().split() == ['1', '2']
+    assert not wm.closing
+
+
+def test_router_threads():
+    import threading
+    from pyzog.route import Router, Rule
+
+    router = Router([Rule('all', channels=['app.*'], to=['all'], continue_=True), Rule('drop', channels=['tmp'], drop=True)])
+
+    def run():
+        for i in range(5000):
+            router.route('app.%d' % (i % 50), b'x')
+            router.route('tmp', b'x')
+
+    threads = [threading.Thread(target=run) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert router.get_stats() == {'route_dropped': 20000, 'route_all_matched': 20000, 'route_drop_matched': 20000}